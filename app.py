@@ -84,7 +84,7 @@ with col1:
 
 with col2:
     st.markdown("#### 🧷 Tình trạng QC gần đây")
-    summary_df = cur_state.get("summary_df")
+    summary_df = qc.get_derived(cur_state, "summary_df")
     if isinstance(summary_df, pd.DataFrame) and not summary_df.empty:
         st.dataframe(summary_df.tail(10), use_container_width=True, height=260)
     else:
@@ -102,3 +102,21 @@ with col2:
         - Xem hướng dẫn chi tiết → trang **4 – Hướng dẫn & About**.
         """
     )
+
+st.markdown("### 🏥 Tổng quan toàn phòng xét nghiệm")
+
+lab_overview, _ = qc.lab_westgard_overview()
+if lab_overview.empty:
+    st.caption(
+        "Chưa có xét nghiệm nào có z-score. "
+        "Vào trang **2_Ghi_nhan_va_danh_gia** để nhập và đánh giá."
+    )
+else:
+    rejected = lab_overview[lab_overview["Trạng thái lần cuối"] == "Không đạt (Reject QC)"]
+    m1, m2 = st.columns(2)
+    m1.metric("Số xét nghiệm", len(lab_overview))
+    m2.metric("Reject ở lần chạy cuối", len(rejected))
+    st.dataframe(lab_overview, use_container_width=True, hide_index=True)
+
+# Ghi gộp các thay đổi state của lượt chạy này (tối đa 1 upsert / xét nghiệm)
+qc.flush_state_saves()
@@ -0,0 +1,156 @@
+"""
+Xuất Word hàng loạt (nhiều xét nghiệm) song song bằng ProcessPoolExecutor, ghi dần vào 1 file ZIP.
+
+python-docx + matplotlib tốn CPU và giữ GIL -> mỗi báo cáo dựng trong 1 process riêng;
+process chính chỉ ghi file .docx xong vào ZIP và báo tiến độ.
+"""
+import multiprocessing
+import os
+import re
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .report_meta import ReportMeta
+
+# Số báo cáo đang dựng / worker: giới hạn bộ nhớ chờ ghi vào ZIP
+JOBS_IN_FLIGHT_PER_WORKER = 2
+
+
+@dataclass
+class ReportJob:
+    """1 file trong ZIP: build(**kwargs) -> BytesIO (build là hàm cấp module để pickle được)."""
+
+    file_name: str
+    build: Callable
+    kwargs: dict = field(default_factory=dict)
+
+
+def safe_file_name(name) -> str:
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("_") or "Xet_nghiem"
+
+
+def so_gn_dg_meta(cfg: dict) -> ReportMeta:
+    """Thông tin biểu mẫu 'Sổ ghi nhận & đánh giá' từ config của 1 xét nghiệm."""
+    return ReportMeta(
+        don_vi=cfg.get("don_vi", "") or "{DON_VI}",
+        phien_ban=(f'Phiên bản: {cfg.get("phien_ban","")}' if cfg.get("phien_ban", "") else "Phiên bản: {PHIEN_BAN}"),
+        ngay_hieu_luc=(f'Ngày hiệu lực: {cfg.get("ngay_hieu_luc","")}' if cfg.get("ngay_hieu_luc", "") else "Ngày hiệu lực: {NGAY_HIEU_LUC}"),
+        ten_xet_nghiem=cfg.get("test_name", ""),
+        thiet_bi_phuong_phap=f'{cfg.get("device","")} / {cfg.get("method","")}'.strip(" /"),
+        lo_qc_han_dung=f'Lô: {cfg.get("qc_lot","")}  |  HSD: {cfg.get("qc_expiry","")}'.strip(),
+        thang_nam=cfg.get("report_period", ""),
+    )
+
+
+def so_gn_dg_job(state: dict, name: str = "") -> ReportJob | None:
+    """Job 'Sổ ghi nhận & đánh giá' của 1 state xét nghiệm (như nút xuất Word trang 2); None nếu chưa có z-score."""
+    from iqc.derived import get_derived
+
+    from .export_so_gn_dg_word import export_so_gn_dg
+
+    summary_df = get_derived(state, "summary_df")
+    if summary_df is None:
+        return None
+    cfg = state.get("config") or {}
+    num_levels = int(cfg.get("num_levels", 3))
+    base_df = summary_df.copy()
+    if "Người thực hiện" not in base_df.columns:
+        base_df["Người thực hiện"] = ""
+    return ReportJob(
+        file_name=f"So_ghi_nhan_danh_gia_{num_levels}muc_{safe_file_name(cfg.get('test_name') or name)}.docx",
+        build=export_so_gn_dg,
+        kwargs=dict(
+            meta=so_gn_dg_meta(cfg),
+            export_df=base_df,
+            z_df=get_derived(state, "z_df"),
+            point_df=get_derived(state, "point_df"),
+            violations=get_derived(state, "violations"),
+            num_levels=num_levels,
+        ),
+    )
+
+
+def so_gn_dg_jobs(states: dict) -> tuple[list, list]:
+    """Job 'Sổ ghi nhận & đánh giá' của mọi xét nghiệm; kèm danh sách xét nghiệm chưa có z-score (bỏ qua)."""
+    jobs, no_data = [], []
+    for key, state in states.items():
+        job = so_gn_dg_job(state, key)
+        if job is None:
+            no_data.append(key)
+        else:
+            jobs.append(job)
+    return jobs, no_data
+
+
+def _build_job(build, kwargs) -> bytes:
+    return build(**kwargs).getvalue()
+
+
+def _unique_name(name: str, used: set) -> str:
+    stem, ext = os.path.splitext(name)
+    k, out = 1, name
+    while out in used:
+        k += 1
+        out = f"{stem}_{k}{ext}"
+    used.add(out)
+    return out
+
+
+def export_zip(jobs, dest, workers: int | None = None, progress=None, mp_context: str = "spawn") -> dict:
+    """
+    Dựng các ReportJob song song và ghi từng file xong vào ZIP `dest` (đường dẫn hoặc file-like).
+    Tên trùng được đánh số theo thứ tự job (a.docx, a_2.docx...) -> không phụ thuộc thứ tự dựng xong.
+    progress(done, total, tên trong ZIP) được gọi ở process chính sau mỗi file.
+    workers <= 1 -> dựng tuần tự trong process hiện tại. Trả về {tên trong ZIP: lỗi} của các job hỏng.
+    mp_context "spawn": an toàn khi gọi từ server Streamlit nhiều thread (fork có thể treo).
+    """
+    jobs = list(jobs)
+    total = len(jobs)
+    workers = min(workers or os.cpu_count() or 1, max(total, 1))
+    used = set()
+    names = [_unique_name(job.file_name, used) for job in jobs]
+    failures = {}
+    done = 0
+
+    # .docx đã nén sẵn -> lưu thẳng, không nén lại
+    with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_STORED) as zf:
+
+        def finish(i, data=None, error=None):
+            nonlocal done
+            done += 1
+            if error is None:
+                zf.writestr(names[i], data)
+            else:
+                failures[names[i]] = f"{type(error).__name__}: {error}"
+            if progress is not None:
+                progress(done, total, names[i])
+
+        if workers <= 1:
+            for i, job in enumerate(jobs):
+                try:
+                    data = _build_job(job.build, job.kwargs)
+                except Exception as e:
+                    finish(i, error=e)
+                else:
+                    finish(i, data)
+            return failures
+
+        ctx = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            pending, queue = {}, iter(enumerate(jobs))
+            limit = workers * JOBS_IN_FLIGHT_PER_WORKER
+            while True:
+                for i, job in queue:
+                    pending[pool.submit(_build_job, job.build, job.kwargs)] = i
+                    if len(pending) >= limit:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    i = pending.pop(fut)
+                    err = fut.exception()
+                    finish(i, None if err else fut.result(), err)
+    return failures
@@ -3,9 +3,15 @@ Export Phiếu thiết lập CSTK ra Word (A4), gồm header/footer theo form.
 """
 from io import BytesIO
 import pandas as pd
-from .word_reports import ReportMeta, build_cstk_3muc_docx, build_cstk_2muc_docx
+from utils.statistics import column_stats
+from .report_meta import ReportMeta
 
 def export_cstk(meta: ReportMeta, stats_df: pd.DataFrame, raw_df=None, num_levels: int = 3) -> BytesIO:
+    if stats_df is None and raw_df is not None:
+        # Chưa có bảng CSTK -> tính từ dữ liệu thô (cùng kernel với trang 1)
+        stats_df = column_stats(raw_df).to_frame()
+    # python-docx chỉ nạp khi thực sự xuất file
+    from .word_reports import build_cstk_3muc_docx, build_cstk_2muc_docx
     if int(num_levels) == 2:
         return build_cstk_2muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df)
     return build_cstk_3muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df)
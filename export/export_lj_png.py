@@ -4,11 +4,14 @@ Export biểu đồ Levey–Jennings thành PNG (bytes).
 """
 from io import BytesIO
 import pandas as pd
-from .word_reports import build_lj_figure_from_z
 
-def export_lj_png(z_df: pd.DataFrame, point_df=None) -> BytesIO:
-    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df)
+def export_lj_png(z_df: pd.DataFrame, point_df=None, violations=None) -> BytesIO:
+    from .word_reports import build_lj_figure_from_z
+    import matplotlib.pyplot as plt
+
+    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df, violations=violations)
     buf = BytesIO()
     fig.savefig(buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
+    plt.close(fig)
     buf.seek(0)
     return buf
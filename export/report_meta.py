@@ -0,0 +1,15 @@
+"""
+Thông tin header/footer của biểu mẫu Word – tách riêng để các trang import mà không kéo theo docx / matplotlib.
+"""
+from dataclasses import dataclass
+
+
+@dataclass
+class ReportMeta:
+    don_vi: str = "{{DON_VI}}"
+    phien_ban: str = "Phiên bản: {{PHIEN_BAN}}"
+    ngay_hieu_luc: str = "Ngày hiệu lực: {{NGAY_HIEU_LUC}}"
+    ten_xet_nghiem: str = ""
+    thiet_bi_phuong_phap: str = ""
+    lo_qc_han_dung: str = ""
+    thang_nam: str = ""
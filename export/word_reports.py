@@ -1,7 +1,6 @@
 
 import io
-from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -11,20 +10,12 @@ from docx.shared import Cm, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_TABLE_ALIGNMENT
 
-import matplotlib.pyplot as plt
-
 from export.docx_layout import apply_header_footer
+from export.report_meta import ReportMeta
+from iqc.westgard import westgard_point_codes
 
-
-@dataclass
-class ReportMeta:
-    don_vi: str = "{{DON_VI}}"
-    phien_ban: str = "Phiên bản: {{PHIEN_BAN}}"
-    ngay_hieu_luc: str = "Ngày hiệu lực: {{NGAY_HIEU_LUC}}"
-    ten_xet_nghiem: str = ""
-    thiet_bi_phuong_phap: str = ""
-    lo_qc_han_dung: str = ""
-    thang_nam: str = ""
+if TYPE_CHECKING:  # matplotlib chỉ nạp khi vẽ biểu đồ
+    from matplotlib.figure import Figure
 
 
 def _safe_str(x) -> str:
@@ -37,15 +28,18 @@ def _safe_str(x) -> str:
 
 def build_lj_figure_from_z(z_df: pd.DataFrame,
                            point_df: Optional[pd.DataFrame] = None,
-                           title: str = "Levey–Jennings (Z-score)") -> plt.Figure:
+                           title: str = "Levey–Jennings (Z-score)",
+                           violations: Optional[pd.DataFrame] = None) -> "Figure":
     """
     Vẽ Levey–Jennings kiểu giống chart trong app:
     - 3 mức QC là 3 đường
     - đường ngang 0, ±1, ±2, ±3
     - khoanh đỏ các điểm có rule_codes (vi phạm/cảnh báo)
+    - nếu có violations (bảng vi phạm của qc_core): join theo (run_idx, level_idx), kèm mã quy tắc ngắn
     """
     if z_df is None or z_df.empty:
         raise ValueError("z_df is empty")
+    import matplotlib.pyplot as plt
 
     runs = z_df["Ngày/Lần"].astype(str).tolist()
     z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
@@ -54,20 +48,26 @@ def build_lj_figure_from_z(z_df: pd.DataFrame,
     Z = z_df[z_cols].to_numpy(dtype=float)
     n_runs, n_levels = Z.shape
 
-    # build long for violations
+    # build long for violations – khoá (run_idx, level_idx)
     viol = set()
     short_map = {}
-    if point_df is not None and not point_df.empty:
+    if violations is not None:
+        for key, (_, short) in westgard_point_codes(violations).items():
+            viol.add(key)
+            short_map[key] = short
+    elif point_df is not None and not point_df.empty:
+        run_pos = {run: i for i, run in enumerate(runs)}
         for _, r in point_df.iterrows():
-            run = str(r.get("Ngày/Lần", ""))
+            i = run_pos.get(str(r.get("Ngày/Lần", "")))
             ctrl = str(r.get("Control", ""))
             codes = _safe_str(r.get("rule_codes", "")).strip()
-            if codes:
-                viol.add((run, ctrl))
+            if i is not None and ctrl.startswith("Ctrl ") and codes:
+                key = (i, int(ctrl.split("Ctrl ")[1]) - 1)
+                viol.add(key)
                 # short already computed in app chart (rule_short)
                 s = _safe_str(r.get("rule_short", "")).strip()
                 if s:
-                    short_map[(run, ctrl)] = s
+                    short_map[key] = s
 
     fig = plt.figure(figsize=(8.2, 4.6), dpi=200)  # ~ 3/4 A4 when inserted
     ax = fig.add_subplot(111)
@@ -79,8 +79,7 @@ def build_lj_figure_from_z(z_df: pd.DataFrame,
 
         # red rings for viol points
         for i in range(n_runs):
-            run = runs[i]
-            key = (run, f"Ctrl {lvl+1}")
+            key = (i, lvl)
             if key in viol:
                 ax.scatter([x[i]], [np.clip(y[i], -3, 3)], s=120,
                            facecolors="none", edgecolors="red", linewidths=2.2, zorder=5)
@@ -136,7 +135,8 @@ def _replace_placeholders_in_doc(doc: Document, mapping: dict):
 def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
                                z_df: pd.DataFrame,
                                point_df: Optional[pd.DataFrame],
-                               meta: ReportMeta) -> io.BytesIO:
+                               meta: ReportMeta,
+                               violations: Optional[pd.DataFrame] = None) -> io.BytesIO:
     """
     Tạo Word A4 cho 'Sổ ghi nhận & đánh giá 3 mức' + chèn biểu đồ L-J (ảnh).
     export_df: đã merge summary_df (có Trạng thái, Vi phạm loại bỏ, Người thực hiện)
@@ -207,9 +207,11 @@ def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
     p.runs[0].bold = True
 
     fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df,
-                                 title=f"{meta.ten_xet_nghiem} – Levey–Jennings (Z-score)")
+                                 title=f"{meta.ten_xet_nghiem} – Levey–Jennings (Z-score)",
+                                 violations=violations)
     img_buf = io.BytesIO()
     fig.savefig(img_buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
+    import matplotlib.pyplot as plt
     plt.close(fig)
     img_buf.seek(0)
 
@@ -237,7 +239,8 @@ def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
 def build_so_ghi_nhan_2muc_docx(export_df: pd.DataFrame,
                                z_df: pd.DataFrame,
                                point_df: Optional[pd.DataFrame],
-                               meta: ReportMeta) -> io.BytesIO:
+                               meta: ReportMeta,
+                               violations: Optional[pd.DataFrame] = None) -> io.BytesIO:
     """
     Tạo Word A4 cho 'Sổ ghi nhận & đánh giá 2 mức' + chèn biểu đồ L-J (ảnh).
     export_df: đã merge summary_df (có Trạng thái, Vi phạm loại bỏ, Người thực hiện)
@@ -299,9 +302,11 @@ def build_so_ghi_nhan_2muc_docx(export_df: pd.DataFrame,
     doc.add_paragraph("")
     doc.add_paragraph("BIỂU ĐỒ LEVEY–JENNINGS (Z-SCORE)").runs[0].bold = True
 
-    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df, title="Levey–Jennings (Z-score)")
+    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df, title="Levey–Jennings (Z-score)",
+                                 violations=violations)
     img_buf = io.BytesIO()
     fig.savefig(img_buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
+    import matplotlib.pyplot as plt
     plt.close(fig)
     img_buf.seek(0)
     # width ~ 3/4 A4 printable (approx 12.5cm)
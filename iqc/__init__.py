@@ -0,0 +1,37 @@
+"""
+Engine nội kiểm IQC không phụ thuộc Streamlit: z-score, quy tắc Westgard, bảng dẫn xuất.
+
+Dùng được từ job batch / worker process mà không phải import Streamlit;
+qc_core (giao diện) chỉ là lớp mỏng gọi vào đây.
+
+    import iqc
+    sigma_cat, rules, summary_df, point_df = iqc.evaluate_westgard(z_df, num_levels=3, sigma=4.5)
+"""
+from utils.statistics import ColumnStats, RollingStats, RunningStats, column_stats, mean_sd_cv
+
+from .derived import (
+    DERIVED_STATE_KEYS,
+    RUNNING_WINDOW,
+    get_derived,
+    performers_from_df,
+    running_qc_targets,
+)
+from .westgard import (
+    RULE_CODES,
+    RULE_NAMES,
+    SEVERITY_LABELS,
+    WestgardRule,
+    WestgardStream,
+    cached_westgard_stream,
+    clear_westgard_cache,
+    evaluate_westgard,
+    evaluate_westgard_batch,
+    evaluate_westgard_violations,
+    extract_rule_short,
+    get_sigma_category_and_rules,
+    render_westgard_frames,
+    westgard_cache_stats,
+    westgard_long_df,
+    westgard_point_codes,
+)
+from .zscore import compute_stats, compute_zscore, compute_zscores
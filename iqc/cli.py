@@ -0,0 +1,238 @@
+"""
+Đánh giá nội kiểm cả PXN từ dòng lệnh (không cần Streamlit).
+
+    python -m iqc evaluate runs.csv --stats stats.csv -o ket_qua/ [--workers 4] [--excel] [--word]
+
+- runs (CSV/XLSX): mỗi dòng 1 kết quả – cột analyte, run, level, value.
+- stats (CSV/XLSX): Mean/SD mục tiêu – cột analyte, level, mean, sd (tuỳ chọn sigma).
+  level nhận 1 / 2 / 3 hoặc "Ctrl 1"...
+
+Kết quả trong thư mục -o: overview.csv (1 dòng / xét nghiệm), summary.csv (giá trị, z-score,
+trạng thái từng run), points.csv (từng điểm); --excel / --word thêm file báo cáo từng xét nghiệm
+như trên app. Các xét nghiệm được chia nhóm cho nhiều process; in ra số xét nghiệm / giây.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .derived import _prime_z_dfs, get_derived
+from .westgard import evaluate_westgard_batch
+
+RUN_COLUMNS = ("analyte", "run", "level", "value")
+STATS_COLUMNS = ("analyte", "level", "mean", "sd")
+DEFAULT_SIGMA = 6.0
+# Số nhóm xét nghiệm / worker: đủ nhỏ để chia đều tải, đủ lớn để z-score tính chung 1 lần
+CHUNKS_PER_WORKER = 4
+
+
+def read_table(path: str) -> pd.DataFrame:
+    """Đọc CSV / XLSX, tên cột về chữ thường."""
+    if os.path.splitext(path)[1].lower() in (".xlsx", ".xlsm", ".xls"):
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df
+
+
+def _require_columns(df: pd.DataFrame, columns, path: str):
+    missing = [c for c in columns if c not in df.columns]
+    if missing:
+        raise ValueError(f"{path}: thiếu cột {', '.join(missing)}")
+
+
+def _level_number(level) -> int:
+    m = re.search(r"\d+", str(level))
+    if m is None:
+        raise ValueError(f"Mức QC không hợp lệ: {level!r}")
+    return int(m.group())
+
+
+def build_states(runs: pd.DataFrame, stats: pd.DataFrame, sigma: float = DEFAULT_SIGMA):
+    """
+    Dạng dài (analyte, run, level, value) + Mean/SD -> {xét nghiệm: state} cùng cấu trúc state của app
+    (daily_df "Ngày/Lần" + "Ctrl k", qc_stats, config). Trả về (states, danh sách xét nghiệm thiếu Mean/SD).
+    """
+    runs = runs.assign(
+        analyte=runs["analyte"].astype(str).str.strip(),
+        level=runs["level"].map(_level_number),
+        value=pd.to_numeric(runs["value"], errors="coerce"),
+    )
+    stats = stats.assign(
+        analyte=stats["analyte"].astype(str).str.strip(),
+        level=stats["level"].map(_level_number),
+    )
+    stats_by = dict(tuple(stats.drop_duplicates(["analyte", "level"], keep="last").groupby("analyte", sort=False)))
+
+    states, missing = {}, []
+    for analyte, g in runs.groupby("analyte", sort=False):
+        s = stats_by.get(analyte)
+        if s is None:
+            missing.append(analyte)
+            continue
+        num_levels = int(max(g["level"].max(), s["level"].max()))
+        levels = range(1, num_levels + 1)
+        # Giữ thứ tự run như trong file (ngày / lần chạy); trùng (run, level) -> lấy dòng sau
+        wide = (
+            g.drop_duplicates(["run", "level"], keep="last")
+            .pivot(index="run", columns="level", values="value")
+            .reindex(index=pd.unique(g["run"]), columns=levels)
+        )
+        daily_df = pd.DataFrame({"Ngày/Lần": wide.index.to_numpy()})
+        for lvl in levels:
+            daily_df[f"Ctrl {lvl}"] = wide[lvl].to_numpy(dtype=float)
+        qc_stats = pd.DataFrame(
+            {
+                "Control": [f"Ctrl {lvl}" for lvl in s["level"]],
+                "Mean_X": pd.to_numeric(s["mean"], errors="coerce").to_numpy(),
+                "SD_empirical": pd.to_numeric(s["sd"], errors="coerce").to_numpy(),
+            }
+        )
+        sig = sigma
+        if "sigma" in s.columns and pd.to_numeric(s["sigma"], errors="coerce").notna().any():
+            sig = float(pd.to_numeric(s["sigma"], errors="coerce").dropna().iloc[-1])
+        states[analyte] = {
+            "config": {"test_name": analyte, "num_levels": num_levels, "sigma_value": sig},
+            "daily_df": daily_df,
+            "qc_stats": qc_stats,
+            "sd_mode": "SD thực nghiệm",
+        }
+    return states, missing
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", str(name), flags=re.UNICODE).strip("_") or "Xet_nghiem"
+
+
+def write_reports(analyte: str, state: dict, out_dir: str, excel: bool = False, word: bool = False):
+    """File Excel 'Sổ theo dõi KQ NK' / Word 'Sổ ghi nhận & đánh giá' của 1 xét nghiệm (như trang 2)."""
+    export_df = get_derived(state, "export_df")
+    if export_df is None:
+        return
+    name = _safe_name(analyte)
+    if excel:
+        with pd.ExcelWriter(os.path.join(out_dir, f"So_theo_doi_KQ_NK_{name}.xlsx"), engine="openpyxl") as writer:
+            export_df.to_excel(writer, sheet_name="So theo doi KQ NK", index=False)
+    if word:
+        from export.bulk_word import so_gn_dg_job
+
+        job = so_gn_dg_job(state, analyte)
+        with open(os.path.join(out_dir, job.file_name), "wb") as f:
+            f.write(job.build(**job.kwargs).getvalue())
+
+
+def evaluate_chunk(states: dict, out_dir: str | None = None, excel: bool = False, word: bool = False) -> dict:
+    """Đánh giá 1 nhóm xét nghiệm (chạy trong worker): {xét nghiệm: (z_df, export_df, point_df)}."""
+    _prime_z_dfs(states)  # z-score cả nhóm trong 1 phép toán mảng
+    out = {}
+    for analyte, state in states.items():
+        if out_dir and (excel or word):
+            write_reports(analyte, state, out_dir, excel=excel, word=word)
+        out[analyte] = (
+            get_derived(state, "z_df"),
+            get_derived(state, "export_df"),
+            get_derived(state, "point_df"),
+        )
+    return out
+
+
+def _chunks(states: dict, n: int) -> list:
+    keys = list(states)
+    size = max(1, -(-len(keys) // n))
+    return [{k: states[k] for k in keys[i : i + size]} for i in range(0, len(keys), size)]
+
+
+def evaluate_states(states: dict, workers: int = 1, out_dir=None, excel=False, word=False) -> dict:
+    """Đánh giá mọi xét nghiệm; workers > 1 -> chia nhóm cho ProcessPoolExecutor."""
+    if workers <= 1 or len(states) <= 1:
+        return evaluate_chunk(states, out_dir, excel, word)
+    results = {}
+    chunks = _chunks(states, workers * CHUNKS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        futures = [pool.submit(evaluate_chunk, chunk, out_dir, excel, word) for chunk in chunks]
+        for fut in futures:
+            results.update(fut.result())
+    # Giữ thứ tự xét nghiệm như trong file
+    return {k: results[k] for k in states}
+
+
+def _stack(results: dict, idx: int) -> pd.DataFrame:
+    frames = [
+        df.assign(**{"Xét nghiệm": analyte})[["Xét nghiệm"] + list(df.columns)]
+        for analyte, parts in results.items()
+        if (df := parts[idx]) is not None
+    ]
+    if not frames:
+        return pd.DataFrame(columns=["Xét nghiệm"])
+    # Xét nghiệm 2 và 3 mức chung 1 bảng: theo thứ tự cột của bảng nhiều mức nhất
+    out = pd.concat(frames, ignore_index=True)
+    widest = list(max(frames, key=lambda df: df.shape[1]).columns)
+    return out[widest + [c for c in out.columns if c not in widest]]
+
+
+def cmd_evaluate(args) -> int:
+    t0 = time.perf_counter()
+    runs = read_table(args.runs)
+    stats = read_table(args.stats)
+    _require_columns(runs, RUN_COLUMNS, args.runs)
+    _require_columns(stats, STATS_COLUMNS, args.stats)
+    states, missing = build_states(runs, stats, sigma=args.sigma)
+    for analyte in missing:
+        print(f"Bỏ qua {analyte}: không có Mean/SD trong {args.stats}", file=sys.stderr)
+
+    os.makedirs(args.out, exist_ok=True)
+    t1 = time.perf_counter()
+    results = evaluate_states(states, workers=args.workers, out_dir=args.out, excel=args.excel, word=args.word)
+    t2 = time.perf_counter()
+
+    overview, _ = evaluate_westgard_batch(
+        {
+            analyte: (z_df, states[analyte]["config"]["num_levels"], states[analyte]["config"]["sigma_value"])
+            for analyte, (z_df, _, _) in results.items()
+            if z_df is not None
+        }
+    )
+    # utf-8-sig: Excel mở đúng tiếng Việt
+    overview.to_csv(os.path.join(args.out, "overview.csv"), index=False, encoding="utf-8-sig")
+    _stack(results, 1).to_csv(os.path.join(args.out, "summary.csv"), index=False, encoding="utf-8-sig")
+    _stack(results, 2).to_csv(os.path.join(args.out, "points.csv"), index=False, encoding="utf-8-sig")
+
+    n = len(states)
+    rejects = int((overview["Trạng thái lần cuối"].astype(str).str.startswith("Không đạt")).sum()) if n else 0
+    t3 = time.perf_counter()
+    print(
+        f"{n} xét nghiệm ({len(runs)} kết quả) -> {args.out}: đánh giá {t2 - t1:.2f} s "
+        f"({n / max(t2 - t1, 1e-9):.1f} xét nghiệm/s, {max(1, args.workers)} worker), "
+        f"tổng {t3 - t0:.2f} s; {rejects} xét nghiệm không đạt ở lần chạy cuối."
+    )
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m iqc", description="Công cụ IQC dòng lệnh.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ev = sub.add_parser("evaluate", help="z-score + Westgard cho mọi xét nghiệm trong file kết quả.")
+    ev.add_argument("runs", help="CSV/XLSX cột analyte, run, level, value")
+    ev.add_argument("--stats", required=True, help="CSV/XLSX cột analyte, level, mean, sd (tuỳ chọn sigma)")
+    ev.add_argument("-o", "--out", default="iqc_out", help="thư mục kết quả (mặc định: iqc_out)")
+    ev.add_argument("--sigma", type=float, default=DEFAULT_SIGMA, help="sigma khi file stats không có cột sigma")
+    ev.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="số process (1 = chạy tuần tự)")
+    ev.add_argument("--excel", action="store_true", help="xuất Excel 'Sổ theo dõi KQ NK' từng xét nghiệm")
+    ev.add_argument("--word", action="store_true", help="xuất Word 'Sổ ghi nhận & đánh giá' từng xét nghiệm")
+    ev.set_defaults(func=cmd_evaluate)
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
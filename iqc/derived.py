@@ -0,0 +1,304 @@
+"""
+Bảng dẫn xuất của state 1 xét nghiệm: z-score -> Westgard -> bảng xuất, CSTK chạy
+(không phụ thuộc Streamlit).
+"""
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from utils.statistics import RollingStats, RunningStats
+
+from .westgard import cached_westgard_stream
+from .zscore import _values_matrix, compute_zscores
+
+# Bảng dẫn xuất: tính lại từ dữ liệu thô khi cần (xem get_derived), không lưu / không giữ trong state
+DERIVED_STATE_KEYS = ("z_df", "summary_df", "point_df", "export_df", "violations", "chart_df")
+
+
+# =====================================================
+# DỮ LIỆU DẪN XUẤT (z-score -> Westgard -> bảng xuất)
+# Không lưu trong state: tính ở lần truy cập đầu, nhớ trong state["_derived"] theo
+# phiên bản dữ liệu thô (_rev, tăng khi update_current_analyte_state đổi dữ liệu) + số mức / sigma.
+# Chỉ dữ liệu thô (baseline_df, qc_stats, daily_df, sd_mode, performers, config) được lưu.
+# =====================================================
+def _run_label(run) -> str:
+    """Khoá 'Ngày/Lần' cho performers (1 và 1.0 là cùng 1 lần chạy)."""
+    try:
+        f = float(run)
+        if math.isfinite(f) and f == int(f):
+            return str(int(f))
+    except (TypeError, ValueError):
+        pass
+    return str(run)
+
+
+def performers_from_df(df) -> dict:
+    """Bảng có cột 'Ngày/Lần' + 'Người thực hiện' -> {lần chạy: người thực hiện} (bỏ ô trống)."""
+    if not isinstance(df, pd.DataFrame) or "Người thực hiện" not in df.columns:
+        return {}
+    return {
+        _run_label(run): name
+        for run, name in zip(df["Ngày/Lần"], df["Người thực hiện"])
+        if isinstance(name, str) and name.strip()
+    }
+
+
+def _strip_derived(state: dict) -> dict:
+    """Bản lưu cũ có bảng dẫn xuất: lấy 'Người thực hiện' từ summary_df rồi bỏ các bảng dẫn xuất."""
+    if "performers" not in state:
+        state["performers"] = performers_from_df(state.get("summary_df"))
+    for k in DERIVED_STATE_KEYS:
+        state.pop(k, None)
+    return state
+
+
+def _derived_memo(state: dict) -> dict:
+    cfg = state.get("config") or {}
+    key = (
+        state.get("_rev", 0),
+        int(cfg.get("num_levels", 2)),
+        float(cfg.get("sigma_value", 6.0)),
+        id(state.get("daily_df")),
+        id(state.get("qc_stats")),
+    )
+    memo = state.get("_derived")
+    if memo is None or memo["key"] != key:
+        memo = {"key": key}
+        state["_derived"] = memo
+    return memo
+
+
+def _z_inputs(state: dict):
+    """(bảng giá trị các mức, mean, sd) để tính z-score; None nếu chưa đủ dữ liệu."""
+    daily_df = state.get("daily_df")
+    qc_stats = state.get("qc_stats")
+    if not isinstance(daily_df, pd.DataFrame) or not isinstance(qc_stats, pd.DataFrame) or qc_stats.empty:
+        return None
+    num_levels = int((state.get("config") or {}).get("num_levels", 2))
+    sd_col = "SD_empirical" if state.get("sd_mode") == "SD thực nghiệm" else "SD_from_CVh"
+    stats = qc_stats.drop_duplicates("Control").set_index("Control")
+    ctrls = [f"Ctrl {lvl}" for lvl in range(1, num_levels + 1)]
+    means = stats["Mean_X"].reindex(ctrls)
+    sds = stats[sd_col].reindex(ctrls) if sd_col in stats.columns else pd.Series(np.nan, index=ctrls)
+    return daily_df.reindex(columns=ctrls), means, sds
+
+
+def _z_frame(state: dict, Z) -> pd.DataFrame:
+    z_df = pd.DataFrame({"Ngày/Lần": state["daily_df"]["Ngày/Lần"]})
+    for j in range(Z.shape[1]):
+        z_df[f"z_Ctrl {j + 1}"] = Z[:, j]
+    return z_df
+
+
+def _derive_z_df(state: dict):
+    inputs = _z_inputs(state)
+    if inputs is None:
+        return None
+    return _z_frame(state, compute_zscores(*inputs))
+
+
+def _prime_z_dfs(states) -> None:
+    """Tính z-score còn thiếu của nhiều xét nghiệm trong 1 lần compute_zscores (dashboard toàn PXN)."""
+    todo, inputs = {}, {}
+    for key, state in states.items():
+        memo = _derived_memo(state)
+        if "z_df" in memo:
+            continue
+        inp = _z_inputs(state)
+        if inp is None:
+            memo["z_df"] = None
+        else:
+            todo[key], inputs[key] = memo, inp
+    if not todo:
+        return
+    Zs = compute_zscores(
+        {k: v[0] for k, v in inputs.items()},
+        {k: v[1] for k, v in inputs.items()},
+        {k: v[2] for k, v in inputs.items()},
+    )
+    for key, memo in todo.items():
+        memo["z_df"] = _z_frame(states[key], Zs[key])
+
+
+def _derive_westgard(state: dict, z_df):
+    """(summary_df, point_df, violations) – WestgardStream giữ trong state để sửa / thêm run chỉ đánh giá phần đổi."""
+    if z_df is None or z_df.drop(columns=["Ngày/Lần"]).isna().all().all():
+        return None, None, None
+    cfg = state.get("config") or {}
+    num_levels = int(cfg.get("num_levels", 2))
+    sigma = float(cfg.get("sigma_value", 6.0))
+    stream = state.get("_wg_stream")
+    if stream is None or stream.num_levels != num_levels or stream.sigma != sigma:
+        # Chưa có stream (vừa tải / thu gọn / đổi cấu hình): bản đã đánh giá từ cache LRU theo nội dung
+        stream = cached_westgard_stream(z_df, num_levels, sigma)
+        state["_wg_stream"] = stream
+    else:
+        stream.sync(z_df)
+    _, _, summary_df, point_df = stream.result()
+    performers = state.get("performers") or {}
+    summary_df["Người thực hiện"] = [
+        performers.get(_run_label(run), "") for run in summary_df["Ngày/Lần"]
+    ]
+    return summary_df, point_df, stream.violations()
+
+
+def _derive_export_df(state: dict, z_df, summary_df):
+    """Bảng 'Sổ theo dõi KQ NK': giá trị + z-score + kết quả Westgard + người thực hiện."""
+    if summary_df is None:
+        return None
+    num_levels = int((state.get("config") or {}).get("num_levels", 2))
+    export_df = state["daily_df"].copy()
+    for col in z_df.columns:
+        if col != "Ngày/Lần":
+            export_df[col] = z_df[col]
+    export_df = export_df.merge(summary_df, on="Ngày/Lần", how="left")
+    ctrl_cols = [f"Ctrl {i}" for i in range(1, num_levels + 1) if f"Ctrl {i}" in export_df.columns]
+    z_cols_out = [f"z_Ctrl {i}" for i in range(1, num_levels + 1) if f"z_Ctrl {i}" in export_df.columns]
+    tail_cols = [
+        c for c in ["Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"] if c in export_df.columns
+    ]
+    return export_df[["Ngày/Lần"] + ctrl_cols + z_cols_out + tail_cols]
+
+
+def get_derived(state: dict, name: str):
+    """
+    Bảng dẫn xuất của 1 state: "z_df", "summary_df", "point_df", "violations", "export_df".
+    None nếu chưa đủ dữ liệu. Kết quả dùng chung giữa các lần gọi -> không sửa tại chỗ.
+    """
+    if state is None:
+        return None
+    memo = _derived_memo(state)
+    if name in memo:
+        return memo[name]
+    if "z_df" not in memo:
+        memo["z_df"] = _derive_z_df(state)
+    if name in ("summary_df", "point_df", "violations", "export_df") and "summary_df" not in memo:
+        memo["summary_df"], memo["point_df"], memo["violations"] = _derive_westgard(state, memo["z_df"])
+    if name == "export_df":
+        memo["export_df"] = _derive_export_df(state, memo["z_df"], memo["summary_df"])
+    if name not in memo:
+        raise KeyError(name)
+    return memo[name]
+
+
+# -----------------------------------------------------
+# CSTK chạy từ dữ liệu hằng ngày: Mean/SD/CV theo mức của các run đạt (không vi phạm
+# quy tắc loại bỏ) – cộng dồn toàn bộ và của RUNNING_WINDOW run đạt gần nhất.
+# Bộ cộng dồn (Welford) + cửa sổ giữ trong state["_running"]. WestgardStream.take_changes()
+# cho biết run đầu tiên có thể đã thêm / sửa / xoá / đổi trạng thái -> chỉ gỡ rồi cộng lại
+# phần đuôi từ run đó (thêm 1 run: O(1)), không quét lại lịch sử.
+# -----------------------------------------------------
+RUNNING_WINDOW = 20
+
+
+def _run_entries(state: dict, summary_df, start: int) -> list:
+    """Giá trị các mức của run >= start (ô trống -> None); None nếu run không đạt hoặc trống."""
+    num_levels = int((state.get("config") or {}).get("num_levels", 2))
+    ctrls = [f"Ctrl {lvl}" for lvl in range(1, num_levels + 1)]
+    X = _values_matrix(state["daily_df"].iloc[start:].reindex(columns=ctrls))
+    entries = []
+    for status, vec in zip(summary_df["Trạng thái"].iloc[start:].astype(str), X):
+        if status.startswith("Không đạt") or np.isnan(vec).all():
+            entries.append(None)
+        else:
+            # Ô trống -> None (NaN != NaN)
+            entries.append(tuple(None if np.isnan(v) else v for v in vec.tolist()))
+    return entries
+
+
+def _fill_window(rows: list, j: int, window: int):
+    """Cửa sổ `window` giá trị đạt gần nhất của mức j: lùi từ cuối tới khi đủ."""
+    picked = []
+    for i in range(len(rows) - 1, -1, -1):
+        if rows[i] is not None and rows[i][j] is not None:
+            picked.append(i)
+            if len(picked) == window:
+                break
+    picked.reverse()
+    return RollingStats(window, [rows[i][j] for i in picked]), deque(picked, maxlen=window)
+
+
+def _update_window(win: dict, rows: list, start: int, window: int):
+    for j in range(len(win["stats"])):
+        idx = win["idx"][j]
+        if idx and idx[-1] >= start:
+            # Run trong cửa sổ bị sửa / xoá / đổi trạng thái -> dựng lại riêng cửa sổ
+            win["stats"][j], win["idx"][j] = _fill_window(rows, j, window)
+            continue
+        stats = win["stats"][j]
+        for i in range(start, len(rows)):
+            if rows[i] is not None and rows[i][j] is not None:
+                stats.add(rows[i][j])
+                idx.append(i)
+
+
+def _running_update(state: dict, stream, summary_df) -> dict:
+    acc = state.get("_running")
+    n_levels = int((state.get("config") or {}).get("num_levels", 2))
+    if acc is None or acc["stream"] is not stream or acc["n_levels"] != n_levels:
+        stream.take_changes()
+        acc = {"stream": stream, "n_levels": n_levels, "rows": [], "cum": [RunningStats() for _ in range(n_levels)], "windows": {}}
+        state["_running"] = acc
+        start = 0
+    else:
+        start = min(stream.take_changes(), len(acc["rows"]))
+    rows = acc["rows"]
+    for vec in rows[start:]:
+        for stats, v in zip(acc["cum"], vec or ()):
+            if v is not None:
+                stats.remove(v)
+    new = _run_entries(state, summary_df, start)
+    for vec in new:
+        for stats, v in zip(acc["cum"], vec or ()):
+            if v is not None:
+                stats.add(v)
+    rows[start:] = new
+    for window, win in acc["windows"].items():
+        _update_window(win, rows, start, window)
+    return acc
+
+
+def running_qc_targets(state: dict, window: int = RUNNING_WINDOW):
+    """
+    Bảng CSTK chạy theo mức: N, Mean, SD, CV% cộng dồn và của `window` run đạt gần nhất.
+    None nếu chưa có run đạt nào.
+    """
+    memo = _derived_memo(state)
+    window = int(window)
+    key = ("running", window)
+    if key in memo:
+        return memo[key]
+    summary_df = get_derived(state, "summary_df")
+    stream = state.get("_wg_stream")
+    result = None
+    if summary_df is not None and stream is not None:
+        acc = _running_update(state, stream, summary_df)
+        win = acc["windows"].get(window)
+        if win is None:
+            filled = [_fill_window(acc["rows"], j, window) for j in range(acc["n_levels"])]
+            win = acc["windows"][window] = {"stats": [f[0] for f in filled], "idx": [f[1] for f in filled]}
+        cum = acc["cum"]
+        if any(stats.n for stats in cum):
+            out = []
+            for j in range(acc["n_levels"]):
+                roll = win["stats"][j]
+                mean, sd, cv = cum[j].result()
+                r_mean, r_sd, r_cv = roll.result()
+                out.append(
+                    {
+                        "Control": f"Ctrl {j + 1}",
+                        "N": cum[j].n,
+                        "Mean_X": mean,
+                        "SD": sd,
+                        "CV_%": cv,
+                        f"N_{window}": roll.n,
+                        f"Mean_{window}": r_mean,
+                        f"SD_{window}": r_sd,
+                        f"CV_{window}_%": r_cv,
+                    }
+                )
+            result = pd.DataFrame(out)
+    memo[key] = result
+    return result
@@ -0,0 +1,771 @@
+"""
+Quy tắc Westgard theo nhóm sigma và engine đánh giá vector hoá (không phụ thuộc Streamlit).
+"""
+import hashlib
+import math
+import threading
+from collections import OrderedDict, deque
+from enum import IntEnum
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import pandas as pd
+
+
+def extract_rule_short(text):
+    if not isinstance(text, str) or not text.strip():
+        return ""
+    codes = []
+    for part in text.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        token = part.split()[0]
+        if token not in codes:
+            codes.append(token)
+    return ", ".join(codes)
+
+
+def get_sigma_category_and_rules(sigma, num_levels):
+    if sigma is None or (isinstance(sigma, float) and math.isnan(sigma)) or sigma == 0:
+        cat = "<4"
+    else:
+        if sigma >= 6:
+            cat = "6"
+        elif sigma >= 5:
+            cat = "5"
+        elif sigma >= 4:
+            cat = "4"
+        else:
+            cat = "<4"
+
+    rules = {"1_3s"}  # luôn có 1_3s
+
+    if num_levels == 2:
+        if cat == "6":
+            pass
+        elif cat == "5":
+            rules.update(["R_4s", "2_2s"])
+        elif cat == "4":
+            rules.update(["R_4s", "2_2s", "4_1s"])
+        else:
+            rules.update(["R_4s", "2_2s", "4_1s", "10x"])
+    else:
+        if cat == "6":
+            pass
+        elif cat == "5":
+            rules.update(["R_4s", "2of3_2s"])
+        elif cat == "4":
+            rules.update(["R_4s", "2of3_2s", "3_1s"])
+        else:
+            rules.update(["R_4s", "2of3_2s", "3_1s", "9x"])
+
+    return cat, rules
+
+
+# =====================================================
+# ENGINE WESTGARD VECTOR HOÁ (NumPy)
+# - Mỗi quy tắc = phép toán trên toàn bộ ma trận Z (n_runs x n_levels).
+# - Kết quả là bảng vi phạm có cấu trúc (chỉ số nguyên); text chỉ dựng khi hiển thị/xuất.
+# =====================================================
+
+# Quy tắc nhìn lại xa nhất là 10x (10 run liên tiếp)
+WESTGARD_LOOKBACK = 10
+
+
+class WestgardRule(IntEnum):
+    R1_2S = 1
+    R1_3S = 2
+    R2_2S = 3
+    R2OF3_2S = 4
+    R4S = 5
+    R3_1S = 6
+    R4_1S = 7
+    R9X = 8
+    R10X = 9
+
+
+# Mã hiển thị (giống phần đầu message cũ)
+RULE_CODES = {
+    WestgardRule.R1_2S: "1_2s",
+    WestgardRule.R1_3S: "1_3s",
+    WestgardRule.R2_2S: "2_2s",
+    WestgardRule.R2OF3_2S: "2/3_2s",
+    WestgardRule.R4S: "R_4s",
+    WestgardRule.R3_1S: "3_1s",
+    WestgardRule.R4_1S: "4_1s",
+    WestgardRule.R9X: "9x",
+    WestgardRule.R10X: "10x",
+}
+
+SEVERITY_WARN = 1
+SEVERITY_REJECT = 2
+SEVERITY_LABELS = {
+    0: "Đạt",
+    SEVERITY_WARN: "Cảnh báo (1_2s)",
+    SEVERITY_REJECT: "Không đạt (Reject QC)",
+}
+
+# Phạm vi vi phạm: trong 1 mức QC (theo chuỗi run) hoặc giữa các mức QC
+SCOPE_LEVEL = 0
+SCOPE_RUN = 1
+
+# 1 dòng = 1 điểm (run, level) bị 1 quy tắc đánh dấu; window_start = run đầu cửa sổ
+VIOLATION_DTYPE = np.dtype(
+    [
+        ("run_idx", np.int32),
+        ("level_idx", np.int16),
+        ("rule", np.int8),
+        ("severity", np.int8),
+        ("window_start", np.int32),
+        ("scope", np.int8),
+        ("side", np.int8),
+    ]
+)
+
+# Message dạng "giữa các mức QC" (SCOPE_RUN)
+_RUN_SCOPE_TEMPLATES = {
+    WestgardRule.R2_2S: "2_2s (cùng lần chạy, {levels} cùng phía 2–3SD)",
+    WestgardRule.R2OF3_2S: "2/3_2s (run {run}, ≥2 mức QC cùng phía ≥2SD)",
+    WestgardRule.R4S: "R_4s (run {run}, chênh lệch ≥4SD giữa các mức QC)",
+    WestgardRule.R3_1S: "3_1s (run {run}, ≥3 mức QC cùng phía ≥1SD)",
+    WestgardRule.R4_1S: "4_1s (2 lần chạy x 2 mức QC, tất cả cùng phía ≥1SD)",
+    WestgardRule.R9X: "9x (3 lần chạy x 3 mức QC, tất cả cùng phía)",
+    WestgardRule.R10X: "10x (5 lần chạy x 2 mức QC, tất cả cùng phía)",
+}
+
+
+def _z_matrix(z_df):
+    """Tách (runs, Z) từ z_df; cột z_Ctrl sắp theo số mức."""
+    runs = z_df["Ngày/Lần"].tolist()
+    z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
+    z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
+    if not z_cols:
+        return runs, np.empty((len(runs), 0))
+    # Ghép từng cột nhanh hơn nhiều so với z_df[z_cols].to_numpy()
+    return runs, np.column_stack([z_df[c].to_numpy(dtype=float) for c in z_cols])
+
+
+# Tên quy tắc trong active_rules -> WestgardRule (1_2s là cảnh báo, luôn áp dụng)
+RULE_NAMES = {
+    "1_3s": WestgardRule.R1_3S,
+    "2_2s": WestgardRule.R2_2S,
+    "2of3_2s": WestgardRule.R2OF3_2S,
+    "R_4s": WestgardRule.R4S,
+    "3_1s": WestgardRule.R3_1S,
+    "4_1s": WestgardRule.R4_1S,
+    "9x": WestgardRule.R9X,
+    "10x": WestgardRule.R10X,
+}
+
+# Bảng vi phạm nhiều xét nghiệm: thêm chỉ số xét nghiệm trong lô
+BATCH_VIOLATION_DTYPE = np.dtype([("analyte_idx", np.int32)] + VIOLATION_DTYPE.descr)
+
+
+def _window_count(mask, k):
+    """out[..., i, l] = số ô True trong mask[..., i-k+1..i, l]; 0 khi chưa đủ k run."""
+    out = np.zeros(mask.shape, dtype=np.int32)
+    n = mask.shape[-2]
+    if n >= k:
+        if k <= 3:
+            out[..., k - 1:, :] = sliding_window_view(mask, k, axis=-2).sum(axis=-1)
+        else:
+            # Cửa sổ dài: hiệu tổng tích luỹ, O(n) bất kể k
+            csum = np.cumsum(mask, axis=-2, dtype=np.int32)
+            out[..., k - 1:, :] = csum[..., k - 1:, :]
+            out[..., k:, :] -= csum[..., : n - k, :]
+    return out
+
+
+def _window_all(mask, k):
+    """out[..., i, l] = True khi mask[..., i-k+1..i, l] đều True (cửa sổ trượt theo trục run)."""
+    return _window_count(mask, k) == k
+
+
+def _pick_side_levels(pos, neg, min_count):
+    """
+    Theo từng run: chọn các mức phía (+) nếu đủ min_count, ngược lại phía (−).
+    Trả về (mask mức phía +, mask mức phía −) – tương đương vòng `for s in (+1, -1): ... break`.
+    """
+    pos_hit = pos.sum(axis=-1, keepdims=True) >= min_count
+    neg_hit = ~pos_hit & (neg.sum(axis=-1, keepdims=True) >= min_count)
+    return pos & pos_hit, neg & neg_hit
+
+
+def _empty_violations():
+    return np.empty(0, dtype=VIOLATION_DTYPE)
+
+
+def _rule_mask(active_rules):
+    """Vector bool theo WestgardRule: quy tắc nào đang áp dụng."""
+    mask = np.zeros(len(WestgardRule) + 1, dtype=bool)
+    mask[WestgardRule.R1_2S] = True
+    for name in active_rules:
+        if name in RULE_NAMES:
+            mask[RULE_NAMES[name]] = True
+    return mask
+
+
+def _westgard_violations_batch(Z3, n_runs, n_levels, rule_mask):
+    """
+    Bảng vi phạm (mảng BATCH_VIOLATION_DTYPE) cho tensor Z3 (analyte x run x level).
+    - Z3 đệm NaN phía sau theo run và theo mức; n_runs / n_levels là kích thước thật từng xét nghiệm.
+    - rule_mask: (n_analytes, len(WestgardRule)+1) – bộ quy tắc riêng của từng xét nghiệm.
+    Mỗi vi phạm gắn vào run cuối của cửa sổ, nên thêm run mới không đổi kết quả run cũ.
+    """
+    n_batch, n_run_max, n_lvl_max = Z3.shape
+    n_runs = np.asarray(n_runs).reshape(-1, 1, 1)
+    n_levels = np.asarray(n_levels).reshape(-1, 1, 1)
+    run_real = np.arange(n_run_max).reshape(1, -1, 1) < n_runs
+    level_real = np.arange(n_lvl_max).reshape(1, 1, -1) < n_levels
+    parts = []
+
+    def emit(rule, severity, mask, span, side, scope=SCOPE_LEVEL):
+        mask = mask & run_real & rule_mask[:, rule].reshape(-1, 1, 1)
+        b, i, l = np.nonzero(mask)
+        if i.size == 0:
+            return
+        rec = np.empty(i.size, dtype=BATCH_VIOLATION_DTYPE)
+        rec["analyte_idx"] = b
+        rec["run_idx"] = i
+        rec["level_idx"] = l
+        rec["rule"] = rule
+        rec["severity"] = severity
+        rec["window_start"] = i - span + 1
+        rec["scope"] = scope
+        rec["side"] = side if np.isscalar(side) else side[b, i, l]
+        parts.append(rec)
+
+    def all_levels(m, k, when):
+        # Mọi mức QC thật của run đều thoả m trong k run liên tiếp (chỉ với xét nghiệm thoả `when`)
+        row = (m | ~level_real).all(axis=-1, keepdims=True)
+        return _window_all(row, k) & level_real & when
+
+    # Mask cơ bản (so sánh với NaN luôn False nên tự loại ô trống / ô đệm)
+    valid = ~np.isnan(Z3)
+    A = np.abs(Z3)
+    in_2_3 = (A >= 2) & (A < 3)
+    pos, neg = Z3 > 0, Z3 < 0
+    ge1p, ge1n = Z3 >= 1, Z3 <= -1
+    ge2p, ge2n = Z3 >= 2, Z3 <= -2
+    sign = np.sign(np.nan_to_num(Z3)).astype(np.int8)
+    lv2, lv3 = n_levels == 2, n_levels == 3
+
+    # 1_2s (quy tắc cảnh báo, luôn áp dụng)
+    emit(WestgardRule.R1_2S, SEVERITY_WARN, in_2_3, 1, sign)
+
+    # 1_3s
+    emit(WestgardRule.R1_3S, SEVERITY_REJECT, A >= 3, 1, sign)
+
+    # 2_2s
+    for s, side in ((1, in_2_3 & pos), (-1, in_2_3 & neg)):
+        # cùng lần chạy, 2 mức khác nhau
+        run_hit = side.sum(axis=-1, keepdims=True) >= 2
+        emit(WestgardRule.R2_2S, SEVERITY_REJECT, side & run_hit, 1, s, SCOPE_RUN)
+        # cùng mức, 2 lần liên tiếp
+        emit(WestgardRule.R2_2S, SEVERITY_REJECT, _window_all(side, 2), 2, s)
+
+    # 2/3_2s
+    # cùng mức, 3 lần liên tiếp
+    emit(WestgardRule.R2OF3_2S, SEVERITY_REJECT, _window_count(ge2p, 3) >= 2, 3, 1)
+    emit(WestgardRule.R2OF3_2S, SEVERITY_REJECT, _window_count(ge2n, 3) >= 2, 3, -1)
+    # cùng lần chạy, nhiều mức
+    lv_p, lv_n = _pick_side_levels(ge2p, ge2n, 2)
+    emit(WestgardRule.R2OF3_2S, SEVERITY_REJECT, lv_p, 1, 1, SCOPE_RUN)
+    emit(WestgardRule.R2OF3_2S, SEVERITY_REJECT, lv_n, 1, -1, SCOPE_RUN)
+
+    # R_4s
+    maxz = np.where(valid, Z3, -np.inf).max(axis=-1, keepdims=True, initial=-np.inf)
+    minz = np.where(valid, Z3, np.inf).min(axis=-1, keepdims=True, initial=np.inf)
+    with np.errstate(invalid="ignore"):
+        run_hit = (
+            (valid.sum(axis=-1, keepdims=True) >= 2)
+            & (maxz - minz >= 4)
+            & (maxz >= 2)
+            & (minz <= -2)
+        )
+    lvl_mask = valid & ((Z3 == maxz) | (Z3 == minz))
+    emit(WestgardRule.R4S, SEVERITY_REJECT, lvl_mask & run_hit, 1, 0, SCOPE_RUN)
+
+    # 3_1s
+    emit(WestgardRule.R3_1S, SEVERITY_REJECT, _window_all(ge1p, 3), 3, 1)
+    emit(WestgardRule.R3_1S, SEVERITY_REJECT, _window_all(ge1n, 3), 3, -1)
+    # ≥3 mức QC, đủ dữ liệu mọi mức
+    full = (valid | ~level_real).all(axis=-1, keepdims=True) & (n_levels >= 3)
+    lv_p, lv_n = _pick_side_levels(ge1p & full, ge1n & full, 3)
+    emit(WestgardRule.R3_1S, SEVERITY_REJECT, lv_p, 1, 1, SCOPE_RUN)
+    emit(WestgardRule.R3_1S, SEVERITY_REJECT, lv_n, 1, -1, SCOPE_RUN)
+
+    # 4_1s
+    emit(WestgardRule.R4_1S, SEVERITY_REJECT, _window_all(ge1p, 4), 4, 1)
+    emit(WestgardRule.R4_1S, SEVERITY_REJECT, _window_all(ge1n, 4), 4, -1)
+    # 2 lần chạy x 2 mức QC
+    emit(WestgardRule.R4_1S, SEVERITY_REJECT, all_levels(ge1p, 2, lv2), 2, 1, SCOPE_RUN)
+    emit(WestgardRule.R4_1S, SEVERITY_REJECT, all_levels(ge1n, 2, lv2), 2, -1, SCOPE_RUN)
+
+    # 9x
+    emit(WestgardRule.R9X, SEVERITY_REJECT, _window_all(pos, 9), 9, 1)
+    emit(WestgardRule.R9X, SEVERITY_REJECT, _window_all(neg, 9), 9, -1)
+    # 3 lần chạy x 3 mức QC
+    emit(WestgardRule.R9X, SEVERITY_REJECT, all_levels(pos, 3, lv3), 3, 1, SCOPE_RUN)
+    emit(WestgardRule.R9X, SEVERITY_REJECT, all_levels(neg, 3, lv3), 3, -1, SCOPE_RUN)
+
+    # 10x (chỉ xét nghiệm 2 mức QC)
+    emit(WestgardRule.R10X, SEVERITY_REJECT, _window_all(pos, 10) & lv2, 10, 1)
+    emit(WestgardRule.R10X, SEVERITY_REJECT, _window_all(neg, 10) & lv2, 10, -1)
+    # 5 lần chạy x 2 mức QC
+    emit(WestgardRule.R10X, SEVERITY_REJECT, all_levels(pos, 5, lv2), 5, 1, SCOPE_RUN)
+    emit(WestgardRule.R10X, SEVERITY_REJECT, all_levels(neg, 5, lv2), 5, -1, SCOPE_RUN)
+
+    if not parts:
+        return np.empty(0, dtype=BATCH_VIOLATION_DTYPE)
+    return np.concatenate(parts)
+
+
+def _westgard_violations(Z, active_rules):
+    """Bảng vi phạm (mảng VIOLATION_DTYPE) cho ma trận Z của 1 xét nghiệm."""
+    n_runs, n_levels = Z.shape
+    batch = _westgard_violations_batch(
+        Z[None], [n_runs], [n_levels], _rule_mask(active_rules)[None]
+    )
+    out = np.empty(batch.size, dtype=VIOLATION_DTYPE)
+    for name in VIOLATION_DTYPE.names:
+        out[name] = batch[name]
+    return out
+
+
+def _violation_columns(violations):
+    """Trả về các cột của bảng vi phạm (structured array hoặc DataFrame) dạng list Python."""
+    return [np.asarray(violations[name]).tolist() for name in VIOLATION_DTYPE.names]
+
+
+def _violation_messages(violations, runs, Z):
+    """
+    Dựng message (text) cho từng dòng vi phạm – chỉ gọi khi cần hiển thị/xuất.
+    Trả về list (severity, run_idx, level_idx, msg).
+    """
+    cols = _violation_columns(violations)
+    rows = list(zip(*cols))
+
+    # Các mức QC cùng nhóm (run, rule, side) cho message dạng "giữa các mức"
+    groups = {}
+    for i, l, rule, _sev, _start, scope, side in rows:
+        if scope == SCOPE_RUN:
+            groups.setdefault((i, rule, side), []).append(l)
+
+    out = []
+    for i, l, rule, sev, start, scope, side in rows:
+        code = RULE_CODES[rule]
+        if scope == SCOPE_RUN:
+            levels = ", ".join(f"Ctrl {x+1}" for x in sorted(groups[(i, rule, side)]))
+            msg = _RUN_SCOPE_TEMPLATES[rule].format(run=runs[i], levels=levels)
+        elif rule in (WestgardRule.R1_2S, WestgardRule.R1_3S):
+            msg = f"{code} (Ctrl {l+1}, z={Z[i, l]:.2f})"
+        elif rule in (WestgardRule.R9X, WestgardRule.R10X):
+            msg = f"{code} (Ctrl {l+1}, {i - start + 1} kết quả liên tiếp cùng phía)"
+        else:
+            msg = f"{code} (Ctrl {l+1}, runs {runs[start]}–{runs[i]})"
+        out.append((sev, i, l, msg))
+    return out
+
+
+def _status_and_text(rejs, warns):
+    if rejs:
+        status = SEVERITY_LABELS[SEVERITY_REJECT]
+    elif warns:
+        status = SEVERITY_LABELS[SEVERITY_WARN]
+    else:
+        return SEVERITY_LABELS[0], ""
+    return status, "; ".join(sorted(rejs or ()) + sorted(warns or ()))
+
+
+def _render_westgard(violations, runs, Z):
+    """Dựng (summary_df, point_df) đúng định dạng của evaluate_westgard từ bảng vi phạm."""
+    n_levels = Z.shape[1]
+    by_run = {SEVERITY_WARN: {}, SEVERITY_REJECT: {}}
+    by_point = {SEVERITY_WARN: {}, SEVERITY_REJECT: {}}
+    for sev, i, l, msg in _violation_messages(violations, runs, Z):
+        by_run[sev].setdefault(i, set()).add(msg)
+        by_point[sev].setdefault((i, l), set()).add(msg)
+    warn_run, rej_run = by_run[SEVERITY_WARN], by_run[SEVERITY_REJECT]
+    warn_pt, rej_pt = by_point[SEVERITY_WARN], by_point[SEVERITY_REJECT]
+
+    # Tổng hợp theo run
+    rows = []
+    for i, run in enumerate(runs):
+        status, text = _status_and_text(rej_run.get(i), warn_run.get(i))
+        rows.append(
+            {
+                "Ngày/Lần": run,
+                "Trạng thái": status,
+                "Vi phạm loại bỏ": text,
+                "Người thực hiện": "",
+            }
+        )
+    summary_df = pd.DataFrame(rows)
+
+    # Tổng hợp theo điểm
+    point_rows = []
+    for i, run in enumerate(runs):
+        for l in range(n_levels):
+            p_status, text = _status_and_text(rej_pt.get((i, l)), warn_pt.get((i, l)))
+            point_rows.append(
+                {
+                    "Ngày/Lần": run,
+                    "Control": f"Ctrl {l+1}",
+                    "point_status": p_status,
+                    "rule_codes": text,
+                }
+            )
+    point_df = pd.DataFrame(point_rows)
+    return summary_df, point_df
+
+
+def render_westgard_frames(z_df, violations):
+    """(summary_df, point_df) dạng text từ z_df + bảng vi phạm (dùng khi hiển thị / xuất)."""
+    runs, Z = _z_matrix(z_df)
+    return _render_westgard(violations, runs, Z)
+
+
+def westgard_point_codes(violations):
+    """
+    {(run_idx, level_idx): (severity, "1_3s, 2_2s")} cho các điểm vi phạm – join bằng khoá số nguyên.
+    Thứ tự mã giống extract_rule_short: loại bỏ trước, cảnh báo sau, mỗi nhóm theo mã.
+    """
+    codes = {}
+    for i, l, rule, sev, *_ in zip(*_violation_columns(violations)):
+        codes.setdefault((i, l), set()).add((-sev, RULE_CODES[rule]))
+    return {
+        key: (-min(v)[0], ", ".join(dict.fromkeys(code for _, code in sorted(v))))
+        for key, v in codes.items()
+    }
+
+
+def westgard_long_df(z_df, violations):
+    """
+    Bảng dài (Run, Control, z_score, point_status, rule_codes, rule_short) cho biểu đồ LJ.
+    Trạng thái & mã quy tắc join theo (run_idx, level_idx); text chỉ dựng cho điểm vi phạm.
+    """
+    runs, Z = _z_matrix(z_df)
+    codes = westgard_point_codes(violations)
+    texts = {}
+    for sev, i, l, msg in _violation_messages(violations, runs, Z):
+        texts.setdefault((i, l), {SEVERITY_WARN: set(), SEVERITY_REJECT: set()})[sev].add(msg)
+
+    rows = []
+    for i, l in np.argwhere(~np.isnan(Z)).tolist():
+        sev, short = codes.get((i, l), (0, ""))
+        t = texts.get((i, l))
+        rows.append(
+            {
+                "Run": int(runs[i]),
+                "Control": f"Ctrl {l+1}",
+                "z_score": float(Z[i, l]),
+                "point_status": SEVERITY_LABELS[sev],
+                "rule_codes": _status_and_text(t[SEVERITY_REJECT], t[SEVERITY_WARN])[1] if t else "",
+                "rule_short": short,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+# -----------------------------------------------------
+# Cache LRU kết quả Westgard (dùng chung cả process)
+# - Khoá: hash nội dung Z + nhãn run + nhóm sigma + số mức QC.
+# - Streamlit chạy lại cả script mỗi lần tương tác; dữ liệu không đổi -> chỉ tốn 1 lần hash.
+# - App (iqc.derived) lấy WestgardStream ban đầu của mỗi state qua cached_westgard_stream.
+# -----------------------------------------------------
+
+WESTGARD_CACHE_SIZE = 128
+
+_westgard_cache = OrderedDict()
+_westgard_cache_lock = threading.Lock()
+_westgard_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _westgard_cache_key(kind, runs, Z, sigma_cat, num_levels):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(Z.shape).encode())
+    h.update(np.ascontiguousarray(Z).tobytes())
+    h.update("\x1f".join(map(repr, runs)).encode("utf-8"))
+    return kind, h.hexdigest(), sigma_cat, num_levels
+
+
+def _westgard_cached(key, compute):
+    with _westgard_cache_lock:
+        if key in _westgard_cache:
+            _westgard_cache.move_to_end(key)
+            _westgard_cache_stats["hits"] += 1
+            return _westgard_cache[key]
+        _westgard_cache_stats["misses"] += 1
+
+    value = compute()
+    with _westgard_cache_lock:
+        _westgard_cache[key] = value
+        _westgard_cache.move_to_end(key)
+        while len(_westgard_cache) > WESTGARD_CACHE_SIZE:
+            _westgard_cache.popitem(last=False)
+    return value
+
+
+def westgard_cache_stats() -> dict:
+    """Số lần hit/miss và kích thước hiện tại của cache Westgard."""
+    with _westgard_cache_lock:
+        return {
+            **_westgard_cache_stats,
+            "size": len(_westgard_cache),
+            "maxsize": WESTGARD_CACHE_SIZE,
+        }
+
+
+def clear_westgard_cache():
+    """Xoá cache Westgard và đặt lại bộ đếm."""
+    with _westgard_cache_lock:
+        _westgard_cache.clear()
+        _westgard_cache_stats.update(hits=0, misses=0)
+
+
+def evaluate_westgard_violations(z_df, num_levels, sigma):
+    """
+    Đánh giá Westgard, trả về (sigma_cat, active_rules, violations_df) – không dựng text.
+    violations_df: run_idx, level_idx, rule (WestgardRule), severity, window_start, scope, side.
+    """
+    runs, Z = _z_matrix(z_df)
+    sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
+    viol = _westgard_cached(
+        _westgard_cache_key("violations", runs, Z, sigma_cat, num_levels),
+        lambda: _westgard_violations(Z, active_rules),
+    )
+    return sigma_cat, active_rules, pd.DataFrame(viol)
+
+
+def evaluate_westgard(z_df, num_levels, sigma):
+    """
+    Đánh giá Westgard trên toàn bộ lịch sử z-score (có cache LRU theo nội dung).
+    Kết quả (sigma_cat, active_rules, summary_df, point_df) giống hệt bản vòng lặp gốc (tests/westgard_reference.py).
+    """
+    runs, Z = _z_matrix(z_df)
+    sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
+    summary_df, point_df = _westgard_cached(
+        _westgard_cache_key("frames", runs, Z, sigma_cat, num_levels),
+        lambda: _render_westgard(_westgard_violations(Z, active_rules), runs, Z),
+    )
+    # Trả bản sao để nơi gọi sửa DataFrame không làm hỏng cache
+    return sigma_cat, active_rules, summary_df.copy(), point_df.copy()
+
+
+def evaluate_westgard_batch(analytes):
+    """
+    Đánh giá Westgard nhiều xét nghiệm trong 1 lượt trên tensor (analyte x run x level) đệm NaN.
+    analytes: {analyte_key: (z_df, num_levels, sigma)} – mỗi xét nghiệm giữ bộ quy tắc sigma riêng.
+    Trả về (overview_df, violations_df): overview_df 1 dòng/xét nghiệm (theo thứ tự analytes),
+    violations_df như evaluate_westgard_violations + cột analyte_idx (vị trí dòng trong overview_df).
+    """
+    keys = list(analytes)
+    runs_list, mats, rule_masks, cats = [], [], [], []
+    for key in keys:
+        z_df, num_levels, sigma = analytes[key]
+        runs, Z = _z_matrix(z_df)
+        sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
+        runs_list.append(runs)
+        mats.append(Z)
+        rule_masks.append(_rule_mask(active_rules))
+        cats.append(sigma_cat)
+
+    n_runs = np.array([Z.shape[0] for Z in mats], dtype=int)
+    n_levels = np.array([Z.shape[1] for Z in mats], dtype=int)
+    n_batch = len(keys)
+    R = int(n_runs.max(initial=0))
+    L = int(n_levels.max(initial=0))
+    Z3 = np.full((n_batch, R, L), np.nan)
+    for b, Z in enumerate(mats):
+        Z3[b, : Z.shape[0], : Z.shape[1]] = Z
+
+    if n_batch:
+        viol = _westgard_violations_batch(Z3, n_runs, n_levels, np.vstack(rule_masks))
+    else:
+        viol = np.empty(0, dtype=BATCH_VIOLATION_DTYPE)
+
+    # Mức độ theo run & lần chạy cuối có dữ liệu của từng xét nghiệm
+    sev = np.zeros((n_batch, R), dtype=np.int8)
+    np.maximum.at(sev, (viol["analyte_idx"], viol["run_idx"]), viol["severity"])
+    has_data = ~np.isnan(Z3).all(axis=-1)
+    last = np.full(n_batch, -1)
+    if R:
+        last = np.where(has_data.any(axis=1), R - 1 - np.argmax(has_data[:, ::-1], axis=1), -1)
+
+    # Vi phạm của lần chạy cuối, nhóm theo xét nghiệm
+    on_last = viol[viol["run_idx"] == last[viol["analyte_idx"]]]
+    last_codes = {}
+    for b, r, s in zip(*(on_last[f].tolist() for f in ("analyte_idx", "rule", "severity"))):
+        last_codes.setdefault(b, set()).add((-s, RULE_CODES[r]))
+
+    rows = []
+    for b, key in enumerate(keys):
+        i_last = int(last[b])
+        if i_last >= 0:
+            codes = sorted(last_codes.get(b, ()))
+            status = SEVERITY_LABELS[int(sev[b, i_last])]
+            last_run = runs_list[b][i_last]
+        else:
+            codes, status, last_run = [], "Chưa có dữ liệu", ""
+        rows.append(
+            {
+                "Xét nghiệm": key,
+                "Nhóm sigma": cats[b],
+                "Số lần chạy": int(has_data[b].sum()),
+                "Lần chạy cuối": last_run,
+                "Trạng thái lần cuối": status,
+                "Quy tắc vi phạm": ", ".join(dict.fromkeys(code for _, code in codes)),
+                "Số lần Reject": int((sev[b] == SEVERITY_REJECT).sum()),
+                "Số lần cảnh báo": int((sev[b] == SEVERITY_WARN).sum()),
+            }
+        )
+    return pd.DataFrame(rows), pd.DataFrame(viol)
+
+
+class WestgardStream:
+    """
+    Đánh giá Westgard tăng dần cho 1 xét nghiệm.
+    - push(run_id, z_vector): chỉ xét ring buffer WESTGARD_LOOKBACK run cuối, trả về vi phạm của run mới.
+    - edit(index, z_vector): sửa 1 run cũ -> đánh giá lại từ run đó trở đi.
+    - sync(z_df): đồng bộ với bảng z-score mới (1 run mới -> push, còn lại đánh giá lại 1 lần).
+    - take_changes(): chỉ số run đầu tiên có thể đã đổi (giá trị / trạng thái) từ lần gọi trước,
+      cho nơi cộng dồn theo run (CSTK chạy) chỉ cập nhật phần đuôi đó.
+    """
+
+    def __init__(self, num_levels, sigma):
+        self.num_levels = num_levels
+        self.sigma = sigma
+        self.sigma_cat, self.active_rules = get_sigma_category_and_rules(sigma, num_levels)
+        self._reset()
+
+    def _reset(self):
+        self.n_levels = None
+        self.runs = []
+        self._rows = []
+        self._tail = deque(maxlen=WESTGARD_LOOKBACK)
+        self._parts = []
+        self._changed_from = 0
+
+    def _as_row(self, z_vector):
+        z = np.asarray(z_vector, dtype=float).reshape(-1)
+        if self.n_levels is None:
+            self.n_levels = z.size
+        elif z.size != self.n_levels:
+            raise ValueError(f"z_vector phải có {self.n_levels} mức QC, nhận {z.size}")
+        return z
+
+    def push(self, run_id, z_vector):
+        """Thêm 1 run mới; trả về các vi phạm (mảng VIOLATION_DTYPE) của run này."""
+        z = self._as_row(z_vector)
+        self.runs.append(run_id)
+        self._rows.append(z)
+        self._tail.append(z)
+        self._changed_from = min(self._changed_from, len(self.runs) - 1)
+
+        offset = len(self.runs) - len(self._tail)
+        viol = _westgard_violations(np.vstack(self._tail), self.active_rules)
+        new = viol[viol["run_idx"] == len(self._tail) - 1]
+        new["run_idx"] += offset
+        new["window_start"] += offset
+        self._parts.append(new)
+        return new
+
+    def edit(self, index, z_vector):
+        """Sửa giá trị của run đã có và đánh giá lại phần đuôi bị ảnh hưởng."""
+        self._rows[index] = self._as_row(z_vector)
+        self._reevaluate_from(index)
+
+    def _reevaluate_from(self, start):
+        # Run < start không phụ thuộc vào run >= start; chỉ cần lùi WESTGARD_LOOKBACK-1 run làm ngữ cảnh
+        self._changed_from = min(self._changed_from, start)
+        kept = self.violations_array()
+        self._parts = [kept[kept["run_idx"] < start]]
+        lo = max(0, start - WESTGARD_LOOKBACK + 1)
+        if lo < len(self._rows):
+            viol = _westgard_violations(np.vstack(self._rows[lo:]), self.active_rules)
+            viol = viol[viol["run_idx"] + lo >= start]
+            viol["run_idx"] += lo
+            viol["window_start"] += lo
+            self._parts.append(viol)
+        self._tail = deque(self._rows[-WESTGARD_LOOKBACK:], maxlen=WESTGARD_LOOKBACK)
+
+    def sync(self, z_df):
+        """Đồng bộ với z_df: run mới -> push, run cũ bị sửa/xoá -> đánh giá lại từ run đầu tiên khác."""
+        runs, Z = _z_matrix(z_df)
+        if self.n_levels is not None and Z.shape[1] != self.n_levels:
+            self._reset()
+        if self.n_levels is None:
+            self.n_levels = Z.shape[1]
+
+        n_old = len(self._rows)
+        m = min(n_old, len(runs))
+        start = m
+        if m:
+            old_Z = np.vstack(self._rows[:m])
+            same = (old_Z == Z[:m]) | (np.isnan(old_Z) & np.isnan(Z[:m]))
+            same = same.all(axis=1) & np.array(
+                [a == b for a, b in zip(self.runs[:m], runs[:m])], dtype=bool
+            )
+            changed = np.flatnonzero(~same)
+            if changed.size:
+                start = int(changed[0])
+
+        if start == n_old and len(runs) - n_old <= 1:
+            for run, z in zip(runs[n_old:], Z[n_old:]):
+                self.push(run, z)
+        else:
+            # Sửa / xoá run cũ, hoặc thêm nhiều run 1 lúc (lần tải đầu): đánh giá chung 1 lần
+            # từ run đầu tiên khác thay vì push từng run
+            self.runs = list(runs)
+            self._rows = list(Z)
+            self._reevaluate_from(start)
+        return self
+
+    def copy(self):
+        """Bản độc lập (list / ring buffer riêng; hàng z và mảng vi phạm không bị sửa tại chỗ nên dùng chung)."""
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.runs = list(self.runs)
+        other._rows = list(self._rows)
+        other._tail = deque(self._tail, maxlen=WESTGARD_LOOKBACK)
+        other._parts = list(self._parts)
+        return other
+
+    def take_changes(self) -> int:
+        """Run >= chỉ số này có thể đã được thêm / sửa / xoá / đổi trạng thái kể từ lần gọi trước."""
+        start = self._changed_from
+        self._changed_from = len(self.runs)
+        return start
+
+    def violations_array(self):
+        """Toàn bộ vi phạm hiện tại (mảng VIOLATION_DTYPE)."""
+        if len(self._parts) != 1:
+            self._parts = [np.concatenate(self._parts) if self._parts else _empty_violations()]
+        return self._parts[0]
+
+    def violations(self):
+        """Bảng vi phạm dạng DataFrame (như evaluate_westgard_violations)."""
+        return pd.DataFrame(self.violations_array())
+
+    def result(self):
+        """(sigma_cat, active_rules, summary_df, point_df) như evaluate_westgard."""
+        n_levels = self.n_levels or 0
+        Z = np.vstack(self._rows) if self._rows else np.empty((0, n_levels))
+        summary_df, point_df = _render_westgard(self.violations_array(), self.runs, Z)
+        return self.sigma_cat, self.active_rules, summary_df, point_df
+
+
+def cached_westgard_stream(z_df, num_levels, sigma) -> WestgardStream:
+    """
+    WestgardStream đã đồng bộ với z_df, lấy qua cache LRU theo nội dung (như evaluate_westgard):
+    xét nghiệm vừa tải lại / mở ở phiên khác với dữ liệu không đổi chỉ tốn 1 lần hash.
+    Trả bản sao riêng – stream được sync / sửa tại chỗ.
+    """
+    runs, Z = _z_matrix(z_df)
+    stream = _westgard_cached(
+        _westgard_cache_key("stream", runs, Z, float(sigma), num_levels),
+        lambda: WestgardStream(num_levels, sigma).sync(z_df),
+    )
+    return stream.copy()
@@ -0,0 +1,85 @@
+"""
+Thống kê & z-score (không phụ thuộc Streamlit).
+"""
+import numpy as np
+import pandas as pd
+
+from utils.statistics import mean_sd_cv
+
+
+def compute_stats(values):
+    """(mean, sd, cv) của 1 dãy giá trị; cả bảng / nhiều mức 1 lần -> column_stats."""
+    return mean_sd_cv(values)
+
+
+def compute_zscore(value, mean, sd):
+    try:
+        v = float(value)
+        if sd is None or sd == 0 or np.isnan(sd):
+            return np.nan
+        return (v - mean) / sd
+    except Exception:
+        return np.nan
+
+
+def _level_vector(values, columns) -> np.ndarray:
+    """Mean/SD theo mức: dict/Series theo tên cột, hoặc dãy theo thứ tự cột -> mảng float."""
+    if isinstance(values, (dict, pd.Series)):
+        values = [values.get(c, np.nan) for c in columns]
+    try:
+        return np.asarray(values, dtype=float).reshape(-1)
+    except (TypeError, ValueError):
+        vec = pd.to_numeric(pd.Series(list(values), dtype=object), errors="coerce")
+        return vec.to_numpy(dtype=float)
+
+
+def _values_matrix(values) -> np.ndarray:
+    if isinstance(values, pd.DataFrame):
+        # Chỉ chuyển kiểu các cột chưa phải số (data_editor thường trả về cột số sẵn)
+        if not all(pd.api.types.is_numeric_dtype(t) for t in values.dtypes):
+            values = values.apply(
+                lambda c: c if pd.api.types.is_numeric_dtype(c) else pd.to_numeric(c, errors="coerce")
+            )
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    arr = np.asarray(values)
+    if arr.dtype.kind in "fiub":
+        return arr.astype(float)
+    return pd.DataFrame(arr).apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+
+
+def compute_zscores(values_df, means, sds):
+    """
+    z-score cả bảng 1 lần (như compute_zscore cho từng ô): values_df gồm các cột Ctrl (run x mức),
+    means / sds: dict|Series theo tên cột hoặc dãy theo thứ tự cột. Ô không phải số, SD = 0 / NaN -> NaN.
+    Nhiều xét nghiệm: values_df = {xét nghiệm: bảng}, means / sds = {xét nghiệm: ...}
+    -> {xét nghiệm: mảng z}, tính chung trong 1 phép toán mảng.
+    """
+    if isinstance(values_df, dict):
+        keys = list(values_df)
+        blocks, mean_rows, sd_rows = [], [], []
+        for k in keys:
+            X = _values_matrix(values_df[k])
+            cols = list(values_df[k].columns) if isinstance(values_df[k], pd.DataFrame) else range(X.shape[1])
+            blocks.append(X)
+            mean_rows.append(np.broadcast_to(_level_vector(means[k], cols), X.shape).ravel())
+            sd_rows.append(np.broadcast_to(_level_vector(sds[k], cols), X.shape).ravel())
+        if not keys:
+            return {}
+        flat = _zscore_array(
+            np.concatenate([X.ravel() for X in blocks]), np.concatenate(mean_rows), np.concatenate(sd_rows)
+        )
+        out, start = {}, 0
+        for k, X in zip(keys, blocks):
+            out[k] = flat[start : start + X.size].reshape(X.shape)
+            start += X.size
+        return out
+    X = _values_matrix(values_df)
+    cols = list(values_df.columns) if isinstance(values_df, pd.DataFrame) else range(X.shape[1])
+    return _zscore_array(X, _level_vector(means, cols), _level_vector(sds, cols))
+
+
+def _zscore_array(X, mean, sd):
+    bad_sd = np.isnan(sd) | (sd == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Z = (X - mean) / np.where(bad_sd, 1.0, sd)
+    return np.where(bad_sd, np.nan, Z)
@@ -5,7 +5,7 @@ import numpy as np
 import qc_core as qc
 
 from export.export_cstk_word import export_cstk
-from export.word_reports import ReportMeta
+from export.report_meta import ReportMeta
 
 
 qc.apply_page_config()
@@ -57,11 +57,11 @@ cvh_inputs = {}
 sd_from_cvh = {}
 
 col_stats = st.columns(num_levels)
+baseline_stats = qc.column_stats(baseline_df[cols])
 
 for i, ctrl in enumerate(cols):
     with col_stats[i]:
-        values = baseline_df[ctrl].tolist()
-        mean, sd, cv = qc.compute_stats(values)
+        mean, sd, cv = baseline_stats.get(ctrl)
 
         st.markdown(f"**🧪 {ctrl}**")
         st.write(
@@ -118,6 +118,12 @@ st.info(
 
 qc.update_current_analyte_state(qc_stats=stats_df)
 
+running = qc.running_qc_targets(qc.get_current_analyte_state())
+if running is not None:
+    with st.expander(f"📈 CSTK chạy từ kết quả hằng ngày (run đạt; cộng dồn & {qc.RUNNING_WINDOW} run gần nhất)"):
+        st.dataframe(running, use_container_width=True, hide_index=True)
+        st.caption("Tham khảo khi cập nhật Mean/SD mục tiêu; không tự thay bảng thiết lập ở trên.")
+
 
 st.markdown("---")
 st.markdown("### 🖨️ Xuất Phiếu thiết lập CSTK (Word – A4)")
@@ -133,14 +139,17 @@ try:
     meta.phien_ban = (f"Phiên bản: {cfg.get('phien_ban','')}" if cfg.get("phien_ban","") else "Phiên bản: {{PHIEN_BAN}}")
     meta.ngay_hieu_luc = (f"Ngày hiệu lực: {cfg.get('ngay_hieu_luc','')}" if cfg.get("ngay_hieu_luc","") else "Ngày hiệu lực: {{NGAY_HIEU_LUC}}")
 
-    docx_buf = export_cstk(meta=meta, stats_df=stats_df, raw_df=None, num_levels=cfg.get('num_levels',3))
-
+    # File Word chỉ dựng khi bấm tải (python-docx không nạp ở mỗi lượt chạy)
+    num_levels = cfg.get('num_levels',3)
     st.download_button(
-        f"📄 Tải Phiếu thiết lập CSTK ({cfg.get('num_levels',3)} mức) – .docx",
-        data=docx_buf.getvalue(),
+        f"📄 Tải Phiếu thiết lập CSTK ({num_levels} mức) – .docx",
+        data=lambda: export_cstk(meta=meta, stats_df=stats_df, raw_df=None, num_levels=num_levels),
         file_name=f"Phieu_thiet_lap_CSTK_{cfg.get('test_name','') or 'Xet_nghiem'}.docx",
         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         use_container_width=True,
     )
 except Exception as e:
     st.error(f"Không thể xuất CSTK: {e}")
+
+# Ghi gộp các thay đổi state của lượt chạy này (tối đa 1 upsert / xét nghiệm)
+qc.flush_state_saves()
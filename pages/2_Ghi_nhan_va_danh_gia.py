@@ -4,8 +4,7 @@ import numpy as np
 from io import BytesIO
 
 import qc_core as qc
-from export.export_so_gn_dg_word import export_so_gn_dg
-from export.word_reports import ReportMeta
+from export.bulk_word import export_zip, so_gn_dg_job, so_gn_dg_jobs
 
 
 qc.apply_page_config()
@@ -34,12 +33,15 @@ if qc_stats is None or qc_stats.empty:
 else:
     st.markdown("### 🔧 Chọn SD dùng để tính z-score")
 
+    sd_options = ["SD thực nghiệm", "SD theo CVh"]
     sd_mode = st.radio(
         "SD dùng để tính z-score",
-        ["SD thực nghiệm", "SD theo CVh"],
-        index=1,
+        sd_options,
+        index=sd_options.index(cur_state.get("sd_mode") or "SD theo CVh"),
         horizontal=True,
     )
+    if cur_state.get("sd_mode") != sd_mode:
+        qc.update_current_analyte_state(sd_mode=sd_mode)
 
     mean_dict = {}
     sd_dict = {}
@@ -106,29 +108,17 @@ else:
         },
     )
     qc.update_current_analyte_state(daily_df=daily_df)
+    cur_state = qc.get_current_analyte_state()
 
-    # Tính z-score
-    zscore_cols = {}
-    for lvl in range(1, num_levels + 1):
-        ctrl = f"Ctrl {lvl}"
-        mean = mean_dict.get(ctrl, np.nan)
-        sd = sd_dict.get(ctrl, np.nan)
-        z_col = f"z_Ctrl {lvl}"
-        zscore_cols[z_col] = [
-            qc.compute_zscore(v, mean, sd) if v not in (None, "") else np.nan
-            for v in daily_df.get(ctrl, pd.Series([np.nan]*len(daily_df))).tolist()
-        ]
-
-    z_df = pd.DataFrame({"Ngày/Lần": daily_df["Ngày/Lần"], **zscore_cols})
+    # z-score / Westgard / bảng xuất: tính từ dữ liệu thô, nhớ tới khi dữ liệu đổi
+    z_df = qc.get_derived(cur_state, "z_df")
 
     st.markdown("### 📈 Bảng z-score")
     st.dataframe(z_df, use_container_width=True)
-    qc.update_current_analyte_state(z_df=z_df)
 
-    if not z_df.drop(columns=["Ngày/Lần"]).isna().all().all():
-        sigma_cat2, active_rules2, summary_df, point_df = qc.evaluate_westgard(
-            z_df, num_levels=num_levels, sigma=cfg["sigma_value"]
-        )
+    summary_df = qc.get_derived(cur_state, "summary_df")
+    if summary_df is not None:
+        sigma_cat2, active_rules2 = qc.get_sigma_category_and_rules(cfg["sigma_value"], num_levels)
 
         st.markdown("### ✅ Đánh giá theo quy tắc Westgard (theo sigma)")
         st.write(
@@ -153,9 +143,9 @@ else:
             },
             key="people_editor",
         )
-        # Ghi lại vào summary_df
-        summary_df = summary_df.drop(columns=["Người thực hiện"]).merge(edit_people, on="Ngày/Lần", how="left")
-        qc.update_current_analyte_state(summary_df=summary_df, point_df=point_df)
+        # Người thực hiện là dữ liệu thô (lưu lại); summary_df tự tính lại theo
+        qc.update_current_analyte_state(performers=qc.performers_from_df(edit_people))
+        summary_df = qc.get_derived(cur_state, "summary_df")
 
         st.info(
             "• **Đạt**: không vi phạm quy tắc loại bỏ.\n"
@@ -165,49 +155,29 @@ else:
             "• **'Người thực hiện'** để ghi tay sau khi xuất Excel."
         )
 
-        # Chuẩn bị dữ liệu xuất sổ theo dõi
-        export_df = daily_df.copy()
-        for col in z_df.columns:
-            if col != "Ngày/Lần":
-                export_df[col] = z_df[col]
-        export_df = export_df.merge(summary_df, on="Ngày/Lần", how="left")
-
-        ctrl_cols = [
-            f"Ctrl {i}"
-            for i in range(1, num_levels + 1)
-            if f"Ctrl {i}" in export_df.columns
-        ]
-        z_cols_out = [
-            f"z_Ctrl {i}"
-            for i in range(1, num_levels + 1)
-            if f"z_Ctrl {i}" in export_df.columns
-        ]
-        tail_cols = [
-            c
-            for c in ["Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"]
-            if c in export_df.columns
-        ]
-        ordered_cols = ["Ngày/Lần"] + ctrl_cols + z_cols_out + tail_cols
-        export_df = export_df[ordered_cols]
+        # Dữ liệu xuất sổ theo dõi
+        export_df = qc.get_derived(cur_state, "export_df")
 
         st.markdown("### 📤 Xuất Excel 'Sổ theo dõi KQ NK'")
 
         file_name = (
             f"So_theo_doi_KQ_NK_{cfg['test_name'] if cfg['test_name'] else 'Xet_nghiem'}.xlsx"
         )
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            export_df.to_excel(writer, sheet_name="So theo doi KQ NK", index=False)
-        buffer.seek(0)
+
+        def _excel_buffer(df=export_df):
+            # openpyxl chỉ nạp khi bấm tải, không phải ở mỗi lượt chạy
+            buffer = BytesIO()
+            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+                df.to_excel(writer, sheet_name="So theo doi KQ NK", index=False)
+            buffer.seek(0)
+            return buffer
 
         st.download_button(
             label="⬇️ Tải file Excel 'Sổ theo dõi KQ NK'",
-            data=buffer,
+            data=_excel_buffer,
             file_name=file_name,
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
-
-        qc.update_current_analyte_state(export_df=export_df)
     else:
         st.warning(
             "Chưa có giá trị z-score nào (tất cả đang trống). Hãy nhập kết quả nội kiểm."
@@ -218,39 +188,14 @@ else:
 st.markdown("### 🖨️ Xuất Word A4 (Sổ ghi nhận & đánh giá)")
 st.caption("Thông tin biểu mẫu được lấy từ sidebar (không nhập lặp lại).")
 ten_xn = cfg.get("test_name","")
-thiet_bi_pp = f'{cfg.get("device","")} / {cfg.get("method","")}'.strip(" /")
-lo_qc_hd = f'Lô: {cfg.get("qc_lot","")}  |  HSD: {cfg.get("qc_expiry","")}'.strip()
-thang_nam = cfg.get("report_period","")
-meta = ReportMeta(
-    don_vi=cfg.get("don_vi","") or "{DON_VI}",
-    phien_ban=(f'Phiên bản: {cfg.get("phien_ban","")}' if cfg.get("phien_ban","") else "Phiên bản: {PHIEN_BAN}"),
-    ngay_hieu_luc=(f'Ngày hiệu lực: {cfg.get("ngay_hieu_luc","")}' if cfg.get("ngay_hieu_luc","") else "Ngày hiệu lực: {NGAY_HIEU_LUC}"),
-    ten_xet_nghiem=ten_xn,
-    thiet_bi_phuong_phap=thiet_bi_pp,
-    lo_qc_han_dung=lo_qc_hd,
-    thang_nam=thang_nam,
-)
 
 
 if st.button("📄 Tạo file Word A4 (Sổ ghi nhận & đánh giá)"):
     try:
-        z_df_state = qc.get_current_analyte_state().get("z_df")
-        point_df_state = qc.get_current_analyte_state().get("point_df")
-
-        # Dùng summary_df làm bảng xuất (ổn định nhất)
-        base_df = summary_df.copy()
-
-        # (tuỳ chọn) đảm bảo cột "Người thực hiện" tồn tại
-        if "Người thực hiện" not in base_df.columns:
-            base_df["Người thực hiện"] = ""
-
-        docx_buf = export_so_gn_dg(
-            meta=meta,
-            export_df=base_df,
-            z_df=z_df_state,
-            point_df=point_df_state,
-            num_levels=int(cfg.get("num_levels", 3)),
-        )
+        job = so_gn_dg_job(qc.get_current_analyte_state(), ten_xn)
+        if job is None:
+            raise ValueError("chưa có z-score")
+        docx_buf = job.build(**job.kwargs)
 
         st.download_button(
             label=f"⬇️ Tải file Word A4 'Sổ ghi nhận & đánh giá ({cfg.get('num_levels',3)} mức)'",
@@ -261,3 +206,37 @@ if st.button("📄 Tạo file Word A4 (Sổ ghi nhận & đánh giá)"):
 
     except Exception as e:
         st.error(f"Không thể xuất Word: {e}")
+
+# Xuất Word cho mọi xét nghiệm (chốt sổ cuối tháng): dựng song song nhiều process, gộp vào 1 ZIP
+with st.expander("📦 Xuất Word tất cả xét nghiệm (ZIP)"):
+    st.caption("Mỗi xét nghiệm đã có z-score 1 file 'Sổ ghi nhận & đánh giá' theo thông tin biểu mẫu riêng của xét nghiệm đó.")
+    if st.button("Tạo file ZIP", key="bulk_word_zip"):
+        # Cả danh mục của lab (xét nghiệm chưa mở trong phiên được đọc từ nơi lưu)
+        skipped = []
+        jobs, no_data = so_gn_dg_jobs(qc.lab_analyte_states(skipped))
+        if skipped:
+            st.warning(f"Không tải được dữ liệu, không có trong ZIP: {', '.join(skipped)}")
+        no_data = [k for k in no_data if k not in skipped]
+        if no_data:
+            st.info(f"Chưa có z-score, không có trong ZIP: {', '.join(no_data)}")
+        if not jobs:
+            st.info("Chưa có xét nghiệm nào có z-score để xuất.")
+        else:
+            bar = st.progress(0.0, text=f"0/{len(jobs)} file")
+            zip_buf = BytesIO()
+            failures = export_zip(
+                jobs,
+                zip_buf,
+                progress=lambda done, total, name: bar.progress(done / total, text=f"{done}/{total} – {name}"),
+            )
+            for name, err in failures.items():
+                st.warning(f"Không xuất được {name}: {err}")
+            st.download_button(
+                label=f"⬇️ Tải ZIP ({len(jobs) - len(failures)} file Word)",
+                data=zip_buf.getvalue(),
+                file_name=f"So_ghi_nhan_danh_gia_{cfg.get('report_period','') or 'IQC'}.zip".replace("/", "-"),
+                mime="application/zip",
+            )
+
+# Ghi gộp các thay đổi state của lượt chạy này (tối đa 1 upsert / xét nghiệm)
+qc.flush_state_saves()
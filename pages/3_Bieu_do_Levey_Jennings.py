@@ -1,5 +1,4 @@
 import streamlit as st
-import pandas as pd
 import os
 
 import qc_core as qc
@@ -23,8 +22,8 @@ qc.render_top_info_cards(cfg, sigma_cat, active_rules)
 st.subheader("3️⃣ 📊 Biểu đồ Levey–Jennings (z-score)")
 
 cur_state = qc.get_current_analyte_state()
-z_df = cur_state.get("z_df")
-point_df = cur_state.get("point_df")
+z_df = qc.get_derived(cur_state, "z_df")
+violations = qc.get_derived(cur_state, "violations")
 num_levels = cfg["num_levels"]
 
 if z_df is None or z_df.empty:
@@ -33,46 +32,10 @@ if z_df is None or z_df.empty:
         "Vào trang **2 – Ghi nhận & đánh giá** để tính trước."
     )
 else:
-    if point_df is None or point_df.empty:
-        _, _, _, point_df = qc.evaluate_westgard(
-            z_df, num_levels=num_levels, sigma=cfg["sigma_value"]
-        )
-        qc.update_current_analyte_state(point_df=point_df)
-
-    point_idx = point_df.set_index(["Ngày/Lần", "Control"])
-
-    runs = z_df["Ngày/Lần"].tolist()
-    z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
-    z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
-
-    df_long_rows = []
-    for idx, run in enumerate(runs):
-        for lvl, z_col in enumerate(z_cols, start=1):
-            z_val = z_df.loc[idx, z_col]
-            if pd.isna(z_val):
-                continue
-            ctrl_name = f"Ctrl {lvl}"
-            key = (run, ctrl_name)
-            if key in point_idx.index:
-                row = point_idx.loc[key]
-                p_status = row["point_status"]
-                r_codes = row["rule_codes"]
-            else:
-                p_status = "Đạt"
-                r_codes = ""
-            short = qc.extract_rule_short(r_codes)
-            df_long_rows.append(
-                {
-                    "Run": int(run),
-                    "Control": ctrl_name,
-                    "z_score": float(z_val),
-                    "point_status": p_status,
-                    "rule_codes": r_codes,
-                    "rule_short": short,
-                }
-            )
+    if violations is None:
+        violations = qc.evaluate_westgard_violations(z_df, num_levels=num_levels, sigma=cfg["sigma_value"])[2]
 
-    df_long = pd.DataFrame(df_long_rows)
+    df_long = qc.westgard_long_df(z_df, violations)
 
     if df_long.empty:
         st.warning("Không có điểm z-score hợp lệ để vẽ biểu đồ.")
@@ -118,3 +81,6 @@ else:
             "• |z| > 3: dấu vuông nằm trên đường ±3SD, tooltip vẫn hiển thị z-score thật.\n"
             "• Control vi phạm: khoanh đỏ + mã quy tắc (1_3s, 2_2s, 10x...)."
         )
+
+# Ghi gộp các thay đổi state của lượt chạy này (tối đa 1 upsert / xét nghiệm)
+qc.flush_state_saves()
@@ -72,3 +72,22 @@ Nếu chị muốn mở rộng thêm:
 thì có thể tiếp tục bổ sung vào thư mục `pages/` với cùng phong cách giao diện.
 """
 )
+
+st.markdown("### 🛠️ Tình trạng hệ thống")
+
+wg_cache = qc.westgard_cache_stats()
+wg_total = wg_cache["hits"] + wg_cache["misses"]
+st.caption(
+    f"Cache đánh giá Westgard: {wg_cache['hits']} hit / {wg_cache['misses']} miss"
+    + (f" ({wg_cache['hits'] / wg_total:.0%} hit)" if wg_total else "")
+    + f" • {wg_cache['size']}/{wg_cache['maxsize']} mục."
+)
+
+state_cache = qc.state_cache_stats()
+state_total = state_cache["hits"] + state_cache["misses"]
+st.caption(
+    f"Cache dữ liệu xét nghiệm (dùng chung các phiên): {state_cache['hits']} hit / "
+    f"{state_cache['misses']} miss"
+    + (f" ({state_cache['hits'] / state_total:.0%} hit)" if state_total else "")
+    + f" • {state_cache['size']}/{state_cache['maxsize']} mục, TTL {state_cache['ttl']:.0f}s."
+)
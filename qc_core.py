@@ -1,24 +1,53 @@
-import math
+import atexit
+import base64
+import copy
+import hashlib
+import importlib.util
 import os
 import json
-from io import BytesIO
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
 
-import altair as alt
 import numpy as np
 import pandas as pd
 
 import streamlit as st
 
-# Optional dependencies (chỉ cần khi bật Supabase)
-try:
-    from supabase import create_client  # type: ignore
-except Exception:  # pragma: no cover
-    create_client = None
-
-try:
-    from passlib.hash import bcrypt  # type: ignore
-except Exception:  # pragma: no cover
-    bcrypt = None
+from storage import SQLiteStorage, SupabaseStorage, VersionConflict
+
+# Engine tính toán không phụ thuộc Streamlit (package iqc); nhập lại ở đây cho pages (qc.get_derived, ...)
+from iqc.derived import (
+    DERIVED_STATE_KEYS,
+    RUNNING_WINDOW,
+    _prime_z_dfs,
+    _strip_derived,
+    get_derived,
+    performers_from_df,
+    running_qc_targets,
+)
+from iqc.westgard import (
+    clear_westgard_cache,
+    evaluate_westgard,
+    evaluate_westgard_batch,
+    evaluate_westgard_violations,
+    extract_rule_short,
+    get_sigma_category_and_rules,
+    render_westgard_frames,
+    westgard_cache_stats,
+    westgard_long_df,
+    westgard_point_codes,
+)
+from iqc.zscore import compute_stats, compute_zscore, compute_zscores
+from utils.statistics import ColumnStats, column_stats, mean_sd_cv
+
+# Thư viện nặng / tuỳ chọn (supabase, altair, docx, matplotlib, openpyxl) chỉ import khi
+# tính năng đó được dùng lần đầu -> khởi động app / mỗi trang nhanh hơn (python -m utils.importtime).
+def _has_module(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
 
 
 def supabase_is_configured() -> bool:
@@ -28,7 +57,7 @@ def supabase_is_configured() -> bool:
         url = sb.get("url")
         anon = sb.get("anon_key")
         svc = sb.get("service_key")
-        return bool(url and (anon or svc) and create_client is not None)
+        return bool(url and (anon or svc) and _has_module("supabase"))
     except Exception:
         return False
 
@@ -46,7 +75,9 @@ def _get_supabase_client(use_service: bool = False):
     svc = sb.get("service_key")
     if not url:
         raise RuntimeError("Missing Supabase secret: supabase.url")
-    if create_client is None:
+    try:
+        from supabase import create_client  # type: ignore
+    except Exception:
         raise RuntimeError("Missing dependency: supabase (pip install supabase)")
 
     key = (svc if use_service else anon) or (anon if use_service else svc)
@@ -56,13 +87,47 @@ def _get_supabase_client(use_service: bool = False):
     return create_client(url, key)
 
 
+def storage_backend_name() -> str:
+    """'supabase' (mặc định) hoặc 'sqlite' – đọc từ IQC_STORAGE hoặc secrets [storage] backend."""
+    name = os.environ.get("IQC_STORAGE")
+    if not name:
+        try:
+            name = st.secrets.get("storage", {}).get("backend")
+        except Exception:
+            name = None
+    return "sqlite" if str(name or "").strip().lower() == "sqlite" else "supabase"
+
+
+def _sqlite_path() -> str:
+    path = os.environ.get("IQC_SQLITE_PATH")
+    if not path:
+        try:
+            path = st.secrets.get("storage", {}).get("sqlite_path")
+        except Exception:
+            path = None
+    return path or os.path.join("data", "iqc.sqlite3")
+
+
+def storage_is_configured() -> bool:
+    """Có nơi lưu dữ liệu: SQLite luôn sẵn sàng, Supabase cần secrets."""
+    return storage_backend_name() == "sqlite" or supabase_is_configured()
+
+
+@st.cache_resource
+def get_storage():
+    """Backend lưu trữ dùng chung cả process (xem storage.py)."""
+    if storage_backend_name() == "sqlite":
+        return SQLiteStorage(_sqlite_path())
+    return SupabaseStorage(_get_supabase_client(use_service=True))
+
+
 def _df_to_records(df: pd.DataFrame) -> list:
     if df is None or not isinstance(df, pd.DataFrame) or df.empty:
         return []
     _df = df.copy()
     # Chuyển Timestamp -> ISO string
     for c in _df.columns:
-        if np.issubdtype(_df[c].dtype, np.datetime64):
+        if pd.api.types.is_datetime64_any_dtype(_df[c]):
             _df[c] = _df[c].astype("datetime64[ns]").dt.strftime("%Y-%m-%d")
     return _df.to_dict(orient="records")
 
@@ -73,58 +138,856 @@ def _records_to_df(records) -> pd.DataFrame:
     return pd.DataFrame(records)
 
 
-def db_load_state(lab_id: str, analyte_key: str) -> dict | None:
-    """Load toàn bộ state của 1 xét nghiệm (analyte_key) theo lab_id."""
-    if not supabase_is_configured():
+# Định dạng cột (columnar) cho DataFrame lưu trong state:
+# {"__df__": version, "n": số dòng, "cols": [[tên, kiểu, dữ liệu], ...]}
+# - cột số: mảng little-endian f4/f8/i8/b1 đóng gói base64 (f4 khi không mất chính xác)
+# - cột khác: list JSON (ngày -> "YYYY-MM-DD", NaN -> null)
+# Payload lớn được nén zlib: {"__df__": version, "z": base64(zlib(json))}.
+DF_CODEC_VERSION = 1
+DF_COMPRESS_MIN_BYTES = 512
+
+
+def _encode_column(s: pd.Series):
+    if pd.api.types.is_bool_dtype(s.dtype) and not s.isna().any():
+        return "b1", base64.b64encode(s.to_numpy(dtype="<b1").tobytes()).decode("ascii")
+    if pd.api.types.is_integer_dtype(s.dtype) and not s.isna().any():
+        return "i8", base64.b64encode(s.to_numpy(dtype="<i8").tobytes()).decode("ascii")
+    if pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+        arr = s.to_numpy(dtype="<f8", na_value=np.nan)
+        arr32 = arr.astype("<f4")
+        if np.array_equal(arr32.astype("<f8"), arr, equal_nan=True):
+            return "f4", base64.b64encode(arr32.tobytes()).decode("ascii")
+        return "f8", base64.b64encode(arr.tobytes()).decode("ascii")
+    if pd.api.types.is_datetime64_any_dtype(s.dtype):
+        s = s.astype("datetime64[ns]").dt.strftime("%Y-%m-%d")
+    values = s.astype(object).where(s.notna(), None).tolist()
+    return "json", [v.item() if isinstance(v, np.generic) else v for v in values]
+
+
+def _df_to_columnar(df: pd.DataFrame):
+    """DataFrame -> dict cột gọn (tên cột 1 lần, số dạng nhị phân); rỗng -> []."""
+    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
+        return []
+    cols = []
+    for j, name in enumerate(df.columns):
+        kind, data = _encode_column(df.iloc[:, j])
+        cols.append([name, kind, data])
+    raw = json.dumps(cols, ensure_ascii=False, separators=(",", ":"), default=str)
+    if len(raw) >= DF_COMPRESS_MIN_BYTES:
+        packed = zlib.compress(raw.encode("utf-8"), 6)
+        return {"__df__": DF_CODEC_VERSION, "n": len(df), "z": base64.b64encode(packed).decode("ascii")}
+    return {"__df__": DF_CODEC_VERSION, "n": len(df), "cols": cols}
+
+
+def _columnar_to_df(obj: dict) -> pd.DataFrame:
+    if "z" in obj:
+        cols = json.loads(zlib.decompress(base64.b64decode(obj["z"])).decode("utf-8"))
+    else:
+        cols = obj.get("cols") or []
+    arrays = {}
+    for j, (_, kind, data) in enumerate(cols):
+        if kind == "json":
+            arrays[j] = data
+        else:
+            arr = np.frombuffer(base64.b64decode(data), dtype="<" + kind)
+            arrays[j] = arr.astype("<f8") if kind == "f4" else arr.copy()
+    df = pd.DataFrame(arrays, index=pd.RangeIndex(int(obj.get("n", 0))))
+    df.columns = [c[0] for c in cols]
+    return df
+
+
+def _df_from_payload(value) -> pd.DataFrame:
+    """Đọc DataFrame đã lưu: định dạng cột (mới) hoặc list records (cũ)."""
+    if isinstance(value, dict) and "__df__" in value:
+        return _columnar_to_df(value)
+    return _records_to_df(value)
+
+
+# Các thành phần DataFrame trong state của 1 xét nghiệm (gồm cả bảng dẫn xuất của bản lưu cũ)
+STATE_DF_KEYS = [
+    "baseline_df",
+    "qc_stats",
+    "daily_df",
+    "z_df",
+    "summary_df",
+    "point_df",
+    "export_df",
+    "violations",
+    "chart_df",
+]
+
+def _is_persisted_key(k) -> bool:
+    """Trường được lưu: không phải khoá nội bộ '_...' hay bảng dẫn xuất."""
+    return not str(k).startswith("_") and k not in DERIVED_STATE_KEYS
+
+
+# -----------------------------------------------------
+# Cache đọc dùng chung cả process: các phiên cùng lab dùng chung 1 bản state đã giải mã.
+# Khoá (lab_id, analyte_key, version): backend có cột version -> ("v", version trên DB,
+# chỉ cần đọc version là biết bản cache còn đúng); không có -> ("g", số lần process này đã ghi).
+# Ghi xong -> bỏ mục cũ; TTL giới hạn độ trễ với thay đổi từ process khác.
+# -----------------------------------------------------
+STATE_CACHE_SIZE = 256
+STATE_CACHE_TTL = 300.0
+
+_state_cache = OrderedDict()
+_state_cache_lock = threading.Lock()
+_state_cache_versions = {}
+_state_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+
+def _state_cache_key(lab_id, analyte_key, storage=None):
+    if storage is not None:
+        try:
+            if storage.versioned:
+                return lab_id, analyte_key, ("v", storage.get_version(lab_id, analyte_key))
+        except Exception:
+            pass
+    with _state_cache_lock:
+        return lab_id, analyte_key, ("g", _state_cache_versions.get((lab_id, analyte_key), 0))
+
+
+def _state_cache_get(key):
+    with _state_cache_lock:
+        entry = _state_cache.get(key)
+        if entry is None:
+            _state_cache_stats["misses"] += 1
+            return None
+        if time.monotonic() - entry[0] > STATE_CACHE_TTL:
+            del _state_cache[key]
+            _state_cache_stats["expired"] += 1
+            _state_cache_stats["misses"] += 1
+            return None
+        _state_cache.move_to_end(key)
+        _state_cache_stats["hits"] += 1
+        return entry[1]
+
+
+def _state_cache_put(key, state):
+    with _state_cache_lock:
+        if key[2][0] == "v":
+            # Lưu theo đúng version đã đọc được cùng state
+            key = (key[0], key[1], ("v", state.get("_version", key[2][1])))
+        elif _state_cache_versions.get(key[:2], 0) != key[2][1]:
+            # Có ghi xen giữa lúc đọc -> không lưu bản cũ
+            return
+        _state_cache[key] = (time.monotonic(), state)
+        _state_cache.move_to_end(key)
+        while len(_state_cache) > STATE_CACHE_SIZE:
+            _state_cache.popitem(last=False)
+
+
+# copy(deep=False) chỉ an toàn khi pandas copy-on-write (mặc định từ pandas 3, requirements.txt)
+_PANDAS_COW = int(pd.__version__.split(".", 1)[0]) >= 3
+
+
+def _state_copy(state: dict) -> dict:
+    """Bản riêng cho 1 phiên: DataFrame copy nông (copy-on-write; pandas < 3 -> copy sâu), phần còn lại copy sâu."""
+    return {
+        k: v.copy(deep=not _PANDAS_COW) if isinstance(v, pd.DataFrame) else copy.deepcopy(v)
+        for k, v in state.items()
+    }
+
+
+def invalidate_state_cache(lab_id: str, analyte_key: str):
+    """Bỏ bản cache của 1 xét nghiệm (gọi sau khi ghi xong)."""
+    with _state_cache_lock:
+        k = (lab_id, analyte_key)
+        _state_cache_versions[k] = _state_cache_versions.get(k, 0) + 1
+        for key in [key for key in _state_cache if key[:2] == k]:
+            del _state_cache[key]
+            _state_cache_stats["invalidated"] += 1
+
+
+def state_cache_stats() -> dict:
+    """Số lần hit/miss/hết hạn/bị huỷ và kích thước hiện tại của cache state."""
+    with _state_cache_lock:
+        return {
+            **_state_cache_stats,
+            "size": len(_state_cache),
+            "maxsize": STATE_CACHE_SIZE,
+            "ttl": STATE_CACHE_TTL,
+        }
+
+
+def clear_state_cache():
+    """Xoá cache state và đặt lại bộ đếm."""
+    with _state_cache_lock:
+        _state_cache.clear()
+        _state_cache_stats.update(hits=0, misses=0, expired=0, invalidated=0)
+
+
+def db_load_state(
+    lab_id: str, analyte_key: str, run_from: int | None = None, run_to: int | None = None
+) -> dict | None:
+    """
+    Load toàn bộ state của 1 xét nghiệm (analyte_key) theo lab_id (qua cache dùng chung).
+    Xét nghiệm lưu theo chế độ runs: chỉ tải giá trị thô (trong [run_from, run_to]) rồi tính lại.
+    """
+    if not storage_is_configured():
         return None
-    try:
-        client = _get_supabase_client(use_service=True)
-        resp = (
-            client.table("iqc_state")
-            .select("state")
-            .eq("lab_id", lab_id)
-            .eq("analyte_key", analyte_key)
-            .limit(1)
-            .execute()
-        )
-        data = getattr(resp, "data", None) or []
-        if not data:
+    if run_from is not None or run_to is not None:
+        return _db_read_state(lab_id, analyte_key, run_from, run_to)
+    key = _state_cache_key(lab_id, analyte_key, get_storage())
+    state = _state_cache_get(key)
+    if state is None:
+        state = _db_read_state(lab_id, analyte_key)
+        if state is None:
             return None
-        state = data[0].get("state")
+        _state_cache_put(key, state)
+    return _state_copy(state)
+
+
+def _db_read_state(lab_id: str, analyte_key: str, run_from=None, run_to=None) -> dict | None:
+    try:
+        storage = get_storage()
+        state, version = storage.load_state(lab_id, analyte_key)
         if not isinstance(state, dict):
             return None
+        if state.get("storage") == "runs":
+            raw = {}
+            for kind, df_key in RUNS_KINDS.items():
+                raw[df_key] = db_load_runs(lab_id, analyte_key, kind, run_from, run_to, storage=storage)
+            state = _derive_runs_state(state, raw)
+            state["_version"] = version
+            return state
+        state["_version"] = version
         # Restore DataFrames
-        for k in ["qc_stats", "daily_df", "summary_df", "chart_df"]:
-            if k in state and isinstance(state[k], list):
-                state[k] = _records_to_df(state[k])
-        return state
+        for k in STATE_DF_KEYS:
+            if k in state and isinstance(state[k], (list, dict)):
+                state[k] = _df_from_payload(state[k])
+        if "patch_seq" in state:
+            # Snapshot + các patch ghi sau nó
+            seq = int(state.pop("patch_seq") or 0)
+            try:
+                patches = storage.load_patches(lab_id, analyte_key, seq)
+            except Exception:
+                patches = []
+            for seq_i, patch in patches:
+                _apply_state_patch(state, patch)
+                seq = seq_i
+            state["_patch_seq"] = seq
+            state["_patch_n"] = len(patches)
+        return _strip_derived(state)
     except Exception:
         return None
 
 
-def db_save_state(lab_id: str, analyte_key: str, state: dict) -> bool:
-    """Upsert state về Supabase. Chỉ lưu các thành phần cần thiết."""
-    if not supabase_is_configured():
-        return False
+def db_load_index(lab_id: str) -> dict | None:
+    """Danh mục xét nghiệm của lab: {analyte_key: config}.
+
+    Chỉ lấy config (state->config); DataFrame nặng để tải sau.
+    """
+    if not storage_is_configured():
+        return None
+    try:
+        return get_storage().list_analytes(lab_id)
+    except Exception:
+        return None
+
+
+def _state_payload(state: dict) -> dict:
+    """State -> dict JSON được (mọi DataFrame -> định dạng cột; chỉ dữ liệu thô)."""
+    payload = {k: v for k, v in state.items() if _is_persisted_key(k)}
+    # Serialize DataFrames
+    for k, v in payload.items():
+        if isinstance(v, pd.DataFrame):
+            payload[k] = _df_to_columnar(v)
+    return payload
+
+
+def _payload_hash(payload: dict) -> str:
+    """Hash nội dung payload (để bỏ qua lần ghi không thay đổi gì)."""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# -----------------------------------------------------
+# Lưu dạng patch (chế độ "state"): chỉ gửi các dòng DataFrame thêm / sửa / xoá
+# so với bản đã lưu; cứ STATE_PATCH_COMPACT_EVERY patch thì ghi lại 1 snapshot đầy đủ.
+# Khoá dòng: "r<Ngày/Lần>" (kèm "/<Control>" nếu bảng có cột Control) khi không trùng,
+# ngược lại "i<vị trí dòng>". Bảng đổi quá nửa số dòng -> gửi cả bảng (dạng cột, gọn hơn).
+# -----------------------------------------------------
+STATE_PATCH_COMPACT_EVERY = 50
+
+
+def state_patches_enabled() -> bool:
+    """Bật lưu patch: IQC_STATE_PATCHES / secrets [storage] patches; mặc định bật với SQLite."""
+    flag = os.environ.get("IQC_STATE_PATCHES")
+    if flag is None:
+        try:
+            flag = st.secrets.get("storage", {}).get("patches")
+        except Exception:
+            flag = None
+    if flag is None:
+        return storage_backend_name() == "sqlite"
+    return str(flag).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _frame_rows(df: pd.DataFrame):
+    """DataFrame -> (cột, {khoá dòng: list giá trị JSON được}) theo thứ tự dòng."""
+    cols = list(df.columns)
+    values = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+    values = [[v.item() if isinstance(v, np.generic) else v for v in row] for row in values]
+    keys = [f"i{j}" for j in range(len(df))]
+    if "Ngày/Lần" in df.columns:
+        runs = pd.to_numeric(df["Ngày/Lần"], errors="coerce").to_numpy(dtype=float)
+        ok = np.isfinite(runs)
+        ok[ok] = runs[ok] == np.round(runs[ok])
+        row_keys = pd.Series([f"r{int(r)}" if good else "" for r, good in zip(runs, ok)], dtype=object)
+        if "Control" in df.columns:
+            row_keys = row_keys + "/" + df["Control"].astype(str).to_numpy()
+        dup = row_keys.duplicated(keep=False).to_numpy()
+        for j in np.flatnonzero(ok & ~dup):
+            keys[j] = row_keys[j]
+    return cols, dict(zip(keys, values))
+
+
+def _rows_to_frame(cols, rows: dict) -> pd.DataFrame:
+    if not rows:
+        return pd.DataFrame(columns=cols)
+    return pd.DataFrame(list(rows.values()), columns=cols)
+
+
+def _patch_base(state: dict, n: int) -> dict:
+    """Mốc so sánh cho patch kế tiếp: các dòng DataFrame + hash các trường khác."""
+    frames, scalars = {}, {}
+    for k, v in state.items():
+        if not _is_persisted_key(k):
+            continue
+        if isinstance(v, pd.DataFrame):
+            frames[k] = _frame_rows(v)
+        else:
+            scalars[k] = _payload_hash({"v": v})
+    return {"n": n, "frames": frames, "scalars": scalars}
+
+
+def _state_patch(base: dict, state: dict) -> dict:
+    """Khác biệt state so với mốc: {"set": trường thay cả, "rows": {bảng: upsert/delete}, "drop": [...]}."""
+    patch_set, patch_rows = {}, {}
+    for k, v in state.items():
+        if not _is_persisted_key(k):
+            continue
+        if isinstance(v, pd.DataFrame):
+            cols, rows = _frame_rows(v)
+            prev = base["frames"].get(k)
+            if prev is None or prev[0] != cols:
+                patch_set[k] = _df_to_columnar(v)
+                continue
+            upsert = {rk: rv for rk, rv in rows.items() if prev[1].get(rk) != rv}
+            delete = [rk for rk in prev[1] if rk not in rows]
+            if 2 * (len(upsert) + len(delete)) > max(len(rows), 1):
+                patch_set[k] = _df_to_columnar(v)
+            elif upsert or delete:
+                patch_rows[k] = {"upsert": upsert, "delete": delete}
+        elif k in base["frames"] or base["scalars"].get(k) != _payload_hash({"v": v}):
+            patch_set[k] = v
+    drop = [
+        k
+        for k in list(base["frames"]) + list(base["scalars"])
+        if k not in state
+    ]
+    patch = {}
+    if patch_set:
+        patch["set"] = patch_set
+    if patch_rows:
+        patch["rows"] = patch_rows
+    if drop:
+        patch["drop"] = drop
+    return patch
+
+
+def _apply_state_patch(state: dict, patch: dict) -> dict:
+    for k in patch.get("drop", []):
+        state.pop(k, None)
+    for k, v in (patch.get("set") or {}).items():
+        is_df = isinstance(v, dict) and "__df__" in v
+        state[k] = _df_from_payload(v) if is_df or (k in STATE_DF_KEYS and isinstance(v, list)) else v
+    for k, diff in (patch.get("rows") or {}).items():
+        df = state.get(k)
+        if not isinstance(df, pd.DataFrame):
+            continue
+        cols, rows = _frame_rows(df)
+        rows.update(diff.get("upsert") or {})
+        for rk in diff.get("delete") or []:
+            rows.pop(rk, None)
+        state[k] = _rows_to_frame(cols, rows)
+    return state
+
+
+def _db_upsert_payload(lab_id: str, analyte_key: str, payload: dict, storage=None):
+    """Upsert payload đã serialize; lỗi được raise để nơi gọi quyết định thử lại."""
+    (storage or get_storage()).save_state(lab_id, analyte_key, payload)
+
+
+def _db_write_sync(lab_id: str, analyte_key: str, payload: dict) -> bool:
+    """Ghi đồng bộ 1 payload đã chuẩn bị (dự phòng khi hàng đợi ghi nền đầy)."""
     try:
-        client = _get_supabase_client(use_service=True)
-        payload = dict(state)
-        # Serialize DataFrames
-        for k in ["qc_stats", "daily_df", "summary_df", "chart_df"]:
-            if k in payload and isinstance(payload[k], pd.DataFrame):
-                payload[k] = _df_to_records(payload[k])
-        client.table("iqc_state").upsert(
-            {"lab_id": lab_id, "analyte_key": analyte_key, "state": payload},
-            on_conflict="lab_id,analyte_key",
-        ).execute()
+        _db_write_payload(lab_id, analyte_key, payload)
         return True
     except Exception:
         return False
 
 
+# -----------------------------------------------------
+# Chế độ lưu "runs": 1 dòng / (lab, xét nghiệm, lần chạy, mức) trong iqc_runs
+# + 1 dòng nhỏ trong iqc_state (config, qc_stats, người thực hiện).
+# Bảng dẫn xuất (z_df, summary_df, ...) không lưu mà tính lại khi tải.
+# -----------------------------------------------------
+RUNS_KINDS = {"daily": "daily_df", "baseline": "baseline_df"}
+
+
+def persistence_mode() -> str:
+    """'state' (mặc định: 1 JSON / xét nghiệm) hoặc 'runs' (bảng iqc_runs)."""
+    mode = os.environ.get("IQC_PERSISTENCE")
+    if not mode:
+        try:
+            mode = st.secrets.get("supabase", {}).get("persistence")
+        except Exception:
+            mode = None
+    return "runs" if str(mode or "").strip().lower() == "runs" else "state"
+
+
+def _level_of(col) -> int | None:
+    """'Ctrl 2' -> 2; cột khác -> None."""
+    if isinstance(col, str) and col.startswith("Ctrl "):
+        try:
+            return int(col[5:])
+        except ValueError:
+            return None
+    return None
+
+
+def _runs_cells(state: dict) -> dict:
+    """Giá trị thô của state -> {(kind, run, level): value} (bỏ ô trống)."""
+    cells = {}
+    for kind, df_key in RUNS_KINDS.items():
+        df = state.get(df_key)
+        if not isinstance(df, pd.DataFrame) or df.empty:
+            continue
+        if kind == "daily" and "Ngày/Lần" in df.columns:
+            runs = pd.to_numeric(df["Ngày/Lần"], errors="coerce").to_numpy(dtype=float, copy=True)
+            # Dòng mới thêm trong editor chưa có số lần chạy -> đánh tiếp sau số lớn nhất
+            nxt = int(np.nanmax(runs)) if np.isfinite(runs).any() else 0
+            for j in np.flatnonzero(~np.isfinite(runs)):
+                nxt += 1
+                runs[j] = nxt
+        else:
+            runs = np.arange(1, len(df) + 1, dtype=float)
+        runs = runs.astype(int)
+        for col in df.columns:
+            level = _level_of(col)
+            if level is None:
+                continue
+            vals = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float)
+            for j in np.flatnonzero(np.isfinite(vals)):
+                cells[(kind, int(runs[j]), level)] = float(vals[j])
+    return cells
+
+
+def _diff_cells(prev: dict, cur: dict) -> dict:
+    """Ô mới/đổi giá trị + ô bị xoá (value None)."""
+    changed = {k: v for k, v in cur.items() if prev.get(k) != v}
+    changed.update({k: None for k in prev if k not in cur})
+    return changed
+
+
+def _runs_state_row(state: dict) -> dict:
+    """Dòng iqc_state nhỏ của chế độ runs: config, qc_stats, SD dùng, người thực hiện."""
+    return {
+        "storage": "runs",
+        "config": state.get("config"),
+        "qc_stats": _df_to_columnar(state.get("qc_stats")),
+        "sd_mode": state.get("sd_mode"),
+        "performers": dict(state.get("performers") or {}),
+    }
+
+
+def _merge_runs_payloads(old: dict, new: dict) -> dict:
+    """Gộp 2 payload runs đang chờ: ô sau ghi đè ô trước, dòng state lấy bản mới nhất."""
+    if old.get("mode") != "runs" or new.get("mode") != "runs":
+        return new
+    return {
+        **new,
+        "state": new["state"] if new.get("state") is not None else old.get("state"),
+        "cells": {**old.get("cells", {}), **new.get("cells", {})},
+    }
+
+
+def db_append_runs(lab_id: str, analyte_key: str, rows, storage=None):
+    """
+    Ghi các giá trị thô vào iqc_runs: rows = [(kind, run, level, value), ...].
+    Mỗi ô là 1 dòng theo khoá (lab_id, analyte_key, kind, run, level): thêm 1 ngày QC
+    chỉ là vài insert; sửa/xoá giá trị = ghi đè ô đó (value null). Lỗi được raise.
+    """
+    (storage or get_storage()).append_runs(lab_id, analyte_key, rows)
+
+
+def db_load_runs(
+    lab_id: str,
+    analyte_key: str,
+    kind: str = "daily",
+    run_from: int | None = None,
+    run_to: int | None = None,
+    storage=None,
+) -> pd.DataFrame | None:
+    """Tải giá trị thô trong khoảng lần chạy [run_from, run_to] -> bảng rộng (Ctrl 1..n)."""
+    try:
+        rows = (storage or get_storage()).load_runs(lab_id, analyte_key, kind, run_from, run_to)
+    except Exception:
+        return None
+    return _runs_to_wide(rows, kind)
+
+
+def _runs_to_wide(rows, kind: str) -> pd.DataFrame | None:
+    long_df = pd.DataFrame(rows, columns=["run", "level", "value"])
+    long_df = long_df.dropna(subset=["value"])
+    if long_df.empty:
+        return None
+    wide = long_df.pivot_table(index="run", columns="level", values="value", aggfunc="last")
+    wide = wide.sort_index()
+    wide.columns = [f"Ctrl {int(c)}" for c in wide.columns]
+    if kind == "daily":
+        wide.insert(0, "Ngày/Lần", wide.index.astype(int))
+    return wide.reset_index(drop=True)
+
+
+def _derive_runs_state(row: dict, raw: dict) -> dict:
+    """Dựng lại state từ dòng config + dữ liệu thô (z-score, Westgard tính khi cần qua get_derived)."""
+    cfg = row.get("config") or {}
+    state = _new_analyte_state(cfg.get("test_name", ""), cfg)
+    state.update(raw)
+    state["sd_mode"] = row.get("sd_mode")
+    qc_stats = row.get("qc_stats")
+    state["qc_stats"] = _df_from_payload(qc_stats) if qc_stats else None
+    state["performers"] = dict(row.get("performers") or {})
+    return state
+
+
+def _db_write_runs(lab_id: str, analyte_key: str, payload: dict, storage=None):
+    """Ghi payload chế độ runs: các ô thay đổi + (nếu đổi) dòng config."""
+    storage = storage or get_storage()
+    cells = payload.get("cells") or {}
+    if cells:
+        db_append_runs(
+            lab_id,
+            analyte_key,
+            [(kind, run, level, value) for (kind, run, level), value in cells.items()],
+            storage=storage,
+        )
+    if payload.get("state") is not None:
+        _db_upsert_payload(lab_id, analyte_key, payload["state"], storage=storage)
+
+
+# -----------------------------------------------------
+# Ghi có kiểm tra phiên bản (backend versioned): mọi lần ghi tăng iqc_state.version bằng
+# compare-and-swap, nên 2 người sửa cùng 1 xét nghiệm không âm thầm ghi đè nhau:
+# - patch: seq = version mới -> luôn gộp được (chỉ các dòng đã đổi), xung đột thì thử lại trên version mới;
+# - runs: ô dữ liệu gộp theo từng ô, dòng config ghi trên version hiện tại;
+# - snapshot: CAS đúng version mong đợi; xung đột -> gửi phần thay đổi dạng patch nếu có,
+#   không thì báo VersionConflict để người dùng chọn tải lại / ghi đè.
+# -----------------------------------------------------
+VERSION_CAS_RETRIES = 8
+VERSION_CHECK_INTERVAL = 15.0
+
+_own_versions = {}
+_own_versions_lock = threading.Lock()
+
+
+def _session_owner() -> str:
+    """Mã phiên (để phân biệt lần ghi của phiên này với người khác)."""
+    return st.session_state.setdefault("iqc_session_id", uuid.uuid4().hex)
+
+
+def _record_own_version(lab_id, analyte_key, payload, version):
+    """Phiên 'owner' đã có đủ dữ liệu tới version này (ghi không xen lẫn người khác)."""
+    with _own_versions_lock:
+        k = (lab_id, analyte_key, payload.get("owner"))
+        _own_versions[k] = max(_own_versions.get(k, 0), version)
+
+
+def _expected_version(lab_id, analyte_key, payload):
+    base = payload.get("base_version")
+    if base is None:
+        return None
+    with _own_versions_lock:
+        own = _own_versions.get((lab_id, analyte_key, payload.get("owner")), 0)
+    return max(int(base), own)
+
+
+def _cas_append_patch(storage, lab_id, analyte_key, payload):
+    expected = _expected_version(lab_id, analyte_key, payload)
+    for attempt in range(VERSION_CAS_RETRIES):
+        cur = storage.get_version(lab_id, analyte_key)
+        if cur == 0:
+            raise VersionConflict("chưa có snapshot để áp patch")
+        try:
+            storage.insert_patch(lab_id, analyte_key, cur + 1, payload["patch"])
+        except VersionConflict:
+            time.sleep(0.05 * (attempt + 1))
+            continue
+        new = storage.cas_state(lab_id, analyte_key, cur)
+        if new is not None:
+            if cur == expected:
+                _record_own_version(lab_id, analyte_key, payload, new)
+            return new
+    raise VersionConflict(f"không ghi được patch sau {VERSION_CAS_RETRIES} lần thử")
+
+
+def _cas_overwrite(storage, lab_id, analyte_key, payload, row):
+    """Tăng version (kèm thay dòng state nếu có) trên version hiện tại."""
+    expected = _expected_version(lab_id, analyte_key, payload)
+    for _ in range(VERSION_CAS_RETRIES):
+        cur = storage.get_version(lab_id, analyte_key)
+        if cur == 0 and row is None:
+            return 0
+        new = storage.cas_state(lab_id, analyte_key, cur, row)
+        if new is not None:
+            if cur == expected:
+                _record_own_version(lab_id, analyte_key, payload, new)
+            return new
+    raise VersionConflict(f"không ghi được sau {VERSION_CAS_RETRIES} lần thử")
+
+
+def _db_write_versioned(storage, lab_id, analyte_key, payload):
+    mode = payload.get("mode")
+    if mode == "batch":
+        for item in payload["items"]:
+            _db_write_versioned(storage, lab_id, analyte_key, item)
+    elif mode == "patch":
+        _cas_append_patch(storage, lab_id, analyte_key, payload)
+    elif mode == "runs":
+        cells = payload.get("cells") or {}
+        if cells:
+            db_append_runs(
+                lab_id,
+                analyte_key,
+                [(kind, run, level, value) for (kind, run, level), value in cells.items()],
+                storage=storage,
+            )
+        _cas_overwrite(storage, lab_id, analyte_key, payload, payload.get("state"))
+    else:
+        expected = _expected_version(lab_id, analyte_key, payload)
+        state = dict(payload["state"])
+        for _ in range(VERSION_CAS_RETRIES):
+            # base_version None: người dùng chọn ghi đè -> ghi trên version hiện tại
+            cur = storage.get_version(lab_id, analyte_key) if expected is None else expected
+            if "patch_seq" in state:
+                # Snapshot = state sau version mới, các patch cũ hơn không còn dùng
+                state["patch_seq"] = cur + 1
+            new = storage.cas_state(lab_id, analyte_key, cur, state)
+            if new is not None or expected is not None:
+                break
+        if new is None:
+            if payload.get("patch"):
+                _cas_append_patch(storage, lab_id, analyte_key, {**payload, "base_version": -1})
+                return
+            raise VersionConflict(f"'{analyte_key}' đã được người khác cập nhật")
+        _record_own_version(lab_id, analyte_key, payload, new)
+        if "patch_seq" in state:
+            storage.prune_patches(lab_id, analyte_key, new)
+
+
+def _db_write_payload(lab_id: str, analyte_key: str, payload: dict, storage=None):
+    """Ghi payload theo đúng chế độ lưu của nó."""
+    storage = storage or get_storage()
+    mode = payload.get("mode")
+    if storage.versioned:
+        _db_write_versioned(storage, lab_id, analyte_key, payload)
+    elif mode == "runs":
+        _db_write_runs(lab_id, analyte_key, payload, storage=storage)
+    elif mode == "patch":
+        storage.append_patch(lab_id, analyte_key, payload["seq"], payload["patch"])
+    elif mode == "batch":
+        for item in payload["items"]:
+            _db_write_payload(lab_id, analyte_key, item, storage=storage)
+    else:
+        state = payload["state"] if mode == "snapshot" else payload
+        _db_upsert_payload(lab_id, analyte_key, state, storage=storage)
+        if "patch_seq" in state:
+            # Snapshot đã gồm mọi patch trước nó
+            storage.prune_patches(lab_id, analyte_key, state["patch_seq"])
+    invalidate_state_cache(lab_id, analyte_key)
+
+
+def _merge_payloads(old: dict, new: dict) -> dict:
+    """
+    Gộp 2 payload đang chờ ghi của cùng 1 xét nghiệm:
+    runs + runs -> gộp ô; patch -> nối tiếp theo thứ tự; snapshot mới -> thay thế.
+    """
+    if old.get("mode") == "runs" and new.get("mode") == "runs":
+        return _merge_runs_payloads(old, new)
+    if new.get("mode") == "patch":
+        items = old["items"] if old.get("mode") == "batch" else [old]
+        return {"mode": "batch", "items": items + [new]}
+    return new
+
+
+class WriteBehindWriter:
+    """
+    Ghi nền (write-behind) state lên DB: 1 thread / process, hàng đợi có giới hạn.
+    - Mỗi (lab_id, analyte_key) chỉ giữ payload mới nhất đang chờ.
+    - Ghi lỗi -> thử lại với backoff luỹ thừa; quá max_attempts -> ghi nhận vào failures.
+    - merge_fn(old, new): gộp payload thay vì thay thế (payload dạng delta).
+    - fatal: các loại lỗi không thử lại (vd. xung đột phiên bản, cần người dùng quyết định).
+    - on_done(error): gọi ở thread ghi khi payload đã ghi xong (error None) hoặc lỗi hẳn.
+    """
+
+    def __init__(
+        self,
+        write_fn,
+        maxsize=256,
+        max_attempts=5,
+        base_delay=0.5,
+        max_delay=30.0,
+        merge_fn=None,
+        fatal=(),
+    ):
+        self._write_fn = write_fn
+        self._merge_fn = merge_fn
+        self._fatal = tuple(fatal)
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pending = OrderedDict()
+        self._callbacks = {}
+        self._inflight = None
+        self._cond = threading.Condition()
+        self.failures = {}
+        self.counters = {"written": 0, "coalesced": 0, "retries": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="iqc-write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, lab_id, analyte_key, payload, on_done=None) -> bool:
+        """Đưa payload vào hàng đợi; False khi hàng đợi đầy (nơi gọi tự ghi đồng bộ)."""
+        key = (lab_id, analyte_key)
+        with self._cond:
+            if key in self._pending:
+                self.counters["coalesced"] += 1
+                if self._merge_fn is not None:
+                    payload = self._merge_fn(self._pending[key], payload)
+            elif len(self._pending) >= self.maxsize:
+                return False
+            self._pending[key] = payload
+            if on_done is not None:
+                self._callbacks.setdefault(key, []).append(on_done)
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                key, payload = self._pending.popitem(last=False)
+                callbacks = self._callbacks.pop(key, [])
+                self._inflight = key
+            try:
+                self._write_with_retry(key, payload, callbacks)
+            finally:
+                with self._cond:
+                    self._inflight = None
+                    self._cond.notify_all()
+
+    def _write_with_retry(self, key, payload, callbacks):
+        delay = self.base_delay
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._write_fn(key[0], key[1], payload)
+            except Exception as e:
+                if attempt == self.max_attempts or isinstance(e, self._fatal):
+                    with self._cond:
+                        self.failures[key] = {
+                            "error": f"{type(e).__name__}: {e}",
+                            "conflict": isinstance(e, VersionConflict),
+                            "attempts": attempt,
+                            "time": time.time(),
+                        }
+                        self.counters["failed"] += 1
+                    error = e
+                    break
+                with self._cond:
+                    self.counters["retries"] += 1
+                    # Chờ backoff; có payload mới hơn cho cùng key thì thử lại ngay với payload đó
+                    self._cond.wait_for(lambda: key in self._pending, timeout=delay)
+                    if key in self._pending:
+                        newer = self._pending.pop(key)
+                        callbacks += self._callbacks.pop(key, [])
+                        payload = self._merge_fn(payload, newer) if self._merge_fn else newer
+                delay = min(delay * 2, self.max_delay)
+            else:
+                with self._cond:
+                    self.failures.pop(key, None)
+                    self.counters["written"] += 1
+                break
+        for cb in callbacks:
+            try:
+                cb(error)
+            except Exception:
+                pass
+
+    def flush(self, timeout=None) -> bool:
+        """Chờ ghi hết hàng đợi; False nếu hết timeout mà vẫn còn việc."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and self._inflight is None, timeout
+            )
+
+    def is_pending(self, lab_id, analyte_key) -> bool:
+        key = (lab_id, analyte_key)
+        with self._cond:
+            return key in self._pending or self._inflight == key
+
+    def clear_failure(self, lab_id, analyte_key):
+        with self._cond:
+            self.failures.pop((lab_id, analyte_key), None)
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "pending": len(self._pending) + (self._inflight is not None),
+                "failures": dict(self.failures),
+                **self.counters,
+            }
+
+
+@st.cache_resource
+def _get_write_behind():
+    """WriteBehindWriter dùng chung cả process (backend lưu trữ lấy sẵn ở script thread)."""
+    storage = get_storage()
+    writer = WriteBehindWriter(
+        lambda lab_id, analyte_key, payload: _db_write_payload(
+            lab_id, analyte_key, payload, storage=storage
+        ),
+        merge_fn=_merge_payloads,
+        fatal=(VersionConflict,),
+    )
+    atexit.register(writer.flush, 5.0)
+    return writer
+
+
 def auth_logout():
-    """Xóa trạng thái đăng nhập trong session."""
+    """Xóa trạng thái đăng nhập trong session (kèm dữ liệu/danh mục của lab cũ)."""
+    try:
+        flush_state_saves()
+    except Exception:
+        pass
     for k in [
+        "iqc_multi",
+        "iqc_index_lab",
+        "iqc_dirty",
+        "iqc_saved_hash",
+        "iqc_runs_saved",
+        "iqc_patch_seq",
+        "iqc_patch_base",
+        "iqc_versions",
+        "iqc_version_checked",
+        "iqc_force_save",
+        "iqc_reloaded",
+        "iqc_lru",
+        "iqc_nbytes",
+        "iqc_evicted",
         "auth_ok",
         "auth_user",
         "auth_role",
@@ -253,23 +1116,66 @@ def _rerun():
     elif hasattr(st, "experimental_rerun"):
         st.experimental_rerun()
 
+_IMG_MIME = {".gif": "image/gif", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".svg": "image/svg+xml"}
+
+# Ảnh đã mã hoá / URL tĩnh, dùng chung cả process; khoá (đường dẫn, mtime, kích thước) -> sửa file là tự đọc lại
+_asset_cache = {}
+_asset_cache_lock = threading.Lock()
+
+
+def _asset_key(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
 def _img_to_base64(path: str) -> str:
-    """Đọc file ảnh và trả về data URI base64 để nhúng vào HTML."""
+    """Đọc file ảnh và trả về data URI base64 để nhúng vào HTML (cache theo path + mtime)."""
+    key = _asset_key(path)
+    if key is None:
+        return ""
+    with _asset_cache_lock:
+        uri = _asset_cache.get(("uri",) + key)
+    if uri is not None:
+        return uri
     try:
-        import base64
-        if not os.path.exists(path):
-            return ""
-        ext = os.path.splitext(path)[1].lower()
-        mime = "image/png"
-        if ext == ".gif":
-            mime = "image/gif"
-        elif ext in [".jpg", ".jpeg"]:
-            mime = "image/jpeg"
+        mime = _IMG_MIME.get(os.path.splitext(path)[1].lower(), "image/png")
         with open(path, "rb") as f:
             b64 = base64.b64encode(f.read()).decode("utf-8")
-        return f"data:{mime};base64,{b64}"
+        uri = f"data:{mime};base64,{b64}"
     except Exception:
         return ""
+    with _asset_cache_lock:
+        _asset_cache[("uri",) + key] = uri
+    return uri
+
+
+def asset_src(path: str) -> str:
+    """
+    Nguồn ảnh cho thẻ <img>: URL tĩnh (static serving bật – trình duyệt tự cache, không gửi lại
+    ảnh mỗi lượt chạy) hoặc data URI. "" nếu không có file.
+    """
+    if not static_serving_enabled():
+        return _img_to_base64(path)
+    key = _asset_key(path)
+    if key is None:
+        return ""
+    with _asset_cache_lock:
+        url = _asset_cache.get(("url",) + key)
+    if url is None:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            stem, ext = os.path.splitext(os.path.basename(path))
+            digest = hashlib.blake2b(data, digest_size=6).hexdigest()
+            url = _static_url(f"{stem}_{digest}{ext}", data)
+        except OSError:
+            return _img_to_base64(path)
+        with _asset_cache_lock:
+            _asset_cache[("url",) + key] = url
+    return url
 
 
 # =====================================================
@@ -324,13 +1230,13 @@ def get_theme() -> dict:
         theme = dict(THEME_DEFAULT)
 
     st.session_state["qc_theme"] = theme
+    st.session_state["qc_theme_hash"] = _payload_hash(theme)
     return theme
 
 
-def inject_global_css():
-    t = get_theme()
-    css = f"""
-    <style>
+def _compile_global_css(t: dict) -> str:
+    """CSS toàn app theo theme (chỉ gọi khi theme đổi – xem compiled_global_css)."""
+    return f"""
       :root {{
         --qc-bg: {t['bg']};
         --qc-panel: {t['panel']};
@@ -638,9 +1544,115 @@ def inject_global_css():
         overflow: hidden;
         border: 1px solid rgba(185,150,60,0.18);
       }}
-    </style>
     """
-    st.markdown(css, unsafe_allow_html=True)
+
+
+# CSS đã dựng theo hash theme, dùng chung cả process (theme hiếm khi đổi)
+_css_cache = {}
+_css_cache_lock = threading.Lock()
+
+
+def compiled_global_css(theme: dict | None = None):
+    """(hash theme, CSS) – chỉ dựng chuỗi CSS 1 lần cho mỗi theme."""
+    if theme is None:
+        t = get_theme()
+        key = st.session_state.get("qc_theme_hash") or _payload_hash(t)
+    else:
+        t, key = theme, _payload_hash(theme)
+    with _css_cache_lock:
+        css = _css_cache.get(key)
+    if css is None:
+        css = _compile_global_css(t)
+        with _css_cache_lock:
+            _css_cache[key] = css
+    return key, css
+
+
+# -----------------------------------------------------
+# Phục vụ file tĩnh (CSS / ảnh) qua Streamlit static serving thay vì nhúng vào mỗi lượt chạy.
+# Bật theo server.enableStaticServing (.streamlit/config.toml), hoặc ép bằng IQC_STATIC_SERVING=0/1.
+# File được ghi vào STATIC_DIR, trình duyệt tải qua URL app/static/<tên> và tự cache.
+# Streamlit phục vụ static/ cạnh script chính (app.py, cùng thư mục qc_core.py), không theo thư mục chạy lệnh.
+# -----------------------------------------------------
+STATIC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "static")
+
+
+def static_serving_enabled() -> bool:
+    flag = os.environ.get("IQC_STATIC_SERVING")
+    if flag is not None:
+        return str(flag).strip().lower() in ("1", "true", "yes", "on")
+    try:
+        return bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        return False
+
+
+def _static_url(name: str, data: bytes) -> str:
+    """Ghi data thành STATIC_DIR/name (nếu chưa có) và trả về URL phục vụ file đó."""
+    path = os.path.join(STATIC_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return f"app/static/{name}"
+
+
+def inject_global_css():
+    key, css = compiled_global_css()
+    if static_serving_enabled():
+        try:
+            # Tên file theo hash theme -> trình duyệt cache, theme đổi thì tự đổi URL
+            url = _static_url(f"iqc_{key[:12]}.css", css.encode("utf-8"))
+            st.markdown(f'<link rel="stylesheet" href="{url}">', unsafe_allow_html=True)
+            return
+        except OSError:
+            pass
+    st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
+
+
+def _new_analyte_state(name: str, config: dict | None = None) -> dict:
+    """State rỗng mặc định cho 1 xét nghiệm."""
+    cfg = {
+        "test_name": name,
+        "unit": "",
+        "device": "",
+        "method": "",
+        "qc_name": "",
+        "qc_lot": "",
+        "qc_expiry": "",
+        "num_levels": 2,
+        "sigma_value": 6.0,
+    }
+    if config:
+        cfg.update(config)
+    return {
+        "config": cfg,
+        "baseline_df": None,
+        "qc_stats": None,
+        "daily_df": None,
+        "performers": {},
+    }
+
+
+def _prefetch_analyte_index(store: dict, lab_id: str) -> None:
+    """Nạp danh mục xét nghiệm của lab 1 lần (sau đăng nhập).
+
+    Mỗi xét nghiệm chưa có trong session -> bản ghi nhẹ (chỉ config, cờ "_lazy");
+    dữ liệu đầy đủ được tải khi xét nghiệm đó được chọn lần đầu.
+    """
+    if st.session_state.get("iqc_index_lab") == lab_id:
+        return
+    index = db_load_index(lab_id)
+    if index is None:
+        return  # DB lỗi -> thử lại ở lần rerun sau
+    for key, cfg in index.items():
+        if key not in store:
+            stub = _new_analyte_state(key, cfg)
+            stub["_lazy"] = True
+            store[key] = stub
+    st.session_state["iqc_index_lab"] = lab_id
 
 
 def _init_multi_analyte_store():
@@ -652,44 +1664,202 @@ def _init_multi_analyte_store():
 
     store = st.session_state["iqc_multi"]
     active = st.session_state["active_analyte"]
+    _touch_analyte(active)
 
-    if active not in store:
-        # Default in-memory state
-        store[active] = {
-            "config": {
-                "test_name": active,
-                "unit": "",
-                "device": "",
-                "method": "",
-                "qc_name": "",
-                "qc_lot": "",
-                "qc_expiry": "",
-                "num_levels": 2,
-                "sigma_value": 6.0,
-            },
-            "baseline_df": None,
-            "qc_stats": None,
-            "daily_df": None,
-            "z_df": None,
-            "summary_df": None,
-            "point_df": None,
-            "export_df": None,
-        }
+    user = get_current_user()
+    use_db = bool(user.get("lab_id")) and storage_is_configured()
+    if use_db:
+        _prefetch_analyte_index(store, user["lab_id"])
+
+    if active not in store or store[active].get("_lazy"):
+        # Default in-memory state (giữ config đã có trong danh mục)
+        stub = store.get(active) or {}
+        store[active] = _new_analyte_state(active, stub.get("config"))
 
         # (NEW) Nếu đã đăng nhập + có Supabase secrets -> load state đã lưu
         try:
-            user = get_current_user()
-            if user.get("lab_id") and supabase_is_configured():
+            if use_db:
                 loaded = db_load_state(user["lab_id"], active)
                 if loaded:
                     store[active] = loaded
+                    # Nội dung vừa tải = nội dung đã lưu -> không cần ghi lại
+                    _mark_state_saved(active, loaded)
         except Exception:
             # Không làm app crash nếu DB lỗi
             pass
+    elif use_db:
+        _refresh_if_changed(store, active, user["lab_id"])
     st.session_state["iqc_multi"] = store
     return store, active
 
 
+def _refresh_if_changed(store: dict, analyte_key: str, lab_id: str):
+    """
+    Xét nghiệm đang mở đã được phiên khác ghi (version trên DB mới hơn bản đang có)
+    -> tải lại. Kiểm tra tối đa 1 lần / VERSION_CHECK_INTERVAL giây, bỏ qua khi đang có
+    thay đổi chưa ghi xong (xung đột sẽ được xử lý lúc ghi).
+    """
+    storage = get_storage()
+    checked = st.session_state.setdefault("iqc_version_checked", {})
+    now = time.monotonic()
+    if now - checked.get(analyte_key, 0.0) < VERSION_CHECK_INTERVAL:
+        return
+    checked[analyte_key] = now
+    if analyte_key in (st.session_state.get("iqc_dirty") or {}):
+        return
+    try:
+        if not storage.versioned or _get_write_behind().is_pending(lab_id, analyte_key):
+            return
+        remote = storage.get_version(lab_id, analyte_key)
+        with _own_versions_lock:
+            own = _own_versions.get((lab_id, analyte_key, _session_owner()), 0)
+        known = max(st.session_state.setdefault("iqc_versions", {}).get(analyte_key, 0), own)
+        if remote <= known:
+            return
+        loaded = db_load_state(lab_id, analyte_key)
+    except Exception:
+        return
+    if loaded:
+        store[analyte_key] = loaded
+        _mark_state_saved(analyte_key, loaded)
+        st.session_state["iqc_reloaded"] = analyte_key
+
+
+# -----------------------------------------------------
+# Giới hạn bộ nhớ mỗi phiên: vượt ngân sách -> xét nghiệm lâu không mở nhất bị thu gọn
+# thành stub (chỉ config + version, cờ "_lazy"); mở lại thì nạp từ cache process / DB.
+# Chỉ thu gọn xét nghiệm đã lưu xong (không dirty, không đang chờ ghi / ghi lỗi).
+# -----------------------------------------------------
+SESSION_MEMORY_MB = 64.0
+
+
+def session_memory_budget() -> int:
+    """Ngân sách bộ nhớ (byte) cho dữ liệu xét nghiệm của 1 phiên; <= 0 -> không giới hạn.
+    IQC_SESSION_MEMORY_MB / secrets [session] memory_mb."""
+    mb = os.environ.get("IQC_SESSION_MEMORY_MB")
+    if mb is None:
+        try:
+            mb = st.secrets.get("session", {}).get("memory_mb")
+        except Exception:
+            mb = None
+    try:
+        mb = SESSION_MEMORY_MB if mb is None else float(mb)
+    except (TypeError, ValueError):
+        mb = SESSION_MEMORY_MB
+    return int(mb * 1024 * 1024)
+
+
+def _value_nbytes(value, seen=None) -> int:
+    # seen: id đã đo (WestgardStream có ở cả _wg_stream lẫn _running) -> không đếm 2 lần
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True, deep=True)))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_value_nbytes(v, seen) for v in value.values())
+    if isinstance(value, (list, tuple, deque)):
+        return sys.getsizeof(value) + sum(_value_nbytes(v, seen) for v in value)
+    if hasattr(value, "__dict__"):
+        return sys.getsizeof(value) + _value_nbytes(vars(value), seen)
+    return sys.getsizeof(value)
+
+
+# Phần dẫn xuất được sửa tại chỗ (cùng id) -> đo riêng, nhớ theo _rev + khoá memo + số run của stream
+_DERIVED_NBYTES_KEYS = ("_derived", "_wg_stream", "_running")
+
+
+def _state_nbytes(analyte_key: str, state: dict) -> int:
+    """
+    Ước lượng bộ nhớ của 1 state. Dữ liệu thô nhớ theo id các giá trị (DataFrame luôn được thay mới
+    khi sửa); bảng dẫn xuất / WestgardStream / CSTK chạy đo lại khi dữ liệu hoặc các bảng đã tính đổi.
+    """
+    memo = st.session_state.setdefault("iqc_nbytes", {})
+    derived = state.get("_derived") or {}
+    stream = state.get("_wg_stream")
+    raw_stamp = tuple((k, id(v)) for k, v in state.items() if k not in _DERIVED_NBYTES_KEYS)
+    derived_stamp = (
+        state.get("_rev", 0),
+        derived.get("key"),
+        tuple(derived),
+        id(stream),
+        len(stream.runs) if stream is not None else 0,
+        id(state.get("_running")),
+    )
+    raw_hit, derived_hit = memo.get(analyte_key) or (None, None)
+    if raw_hit is None or raw_hit[0] != raw_stamp:
+        raw_hit = (raw_stamp, _value_nbytes({k: v for k, v in state.items() if k not in _DERIVED_NBYTES_KEYS}))
+    if derived_hit is None or derived_hit[0] != derived_stamp:
+        derived_hit = (derived_stamp, _value_nbytes([state.get(k) for k in _DERIVED_NBYTES_KEYS]))
+    memo[analyte_key] = (raw_hit, derived_hit)
+    return raw_hit[1] + derived_hit[1]
+
+
+def _touch_analyte(analyte_key: str):
+    lru = st.session_state.setdefault("iqc_lru", OrderedDict())
+    lru[analyte_key] = time.time()
+    lru.move_to_end(analyte_key)
+
+
+def session_memory_usage() -> dict:
+    """Bộ nhớ dữ liệu xét nghiệm đang giữ trong phiên (cho sidebar)."""
+    store = st.session_state.get("iqc_multi") or {}
+    loaded = {k: _state_nbytes(k, s) for k, s in store.items() if not s.get("_lazy")}
+    return {
+        "bytes": sum(loaded.values()),
+        "budget": session_memory_budget(),
+        "loaded": len(loaded),
+        "total": len(store),
+        "evicted": st.session_state.get("iqc_evicted", 0),
+    }
+
+
+def _evict_analyte(store: dict, analyte_key: str):
+    state = store[analyte_key]
+    stub = _new_analyte_state(analyte_key, state.get("config"))
+    stub["_lazy"] = True
+    stub["_evicted"] = True
+    stub["_version"] = state.get("_version", 0)
+    store[analyte_key] = stub
+    for k in ("iqc_saved_hash", "iqc_runs_saved", "iqc_patch_base", "iqc_nbytes"):
+        st.session_state.get(k, {}).pop(analyte_key, None)
+    st.session_state["iqc_evicted"] = st.session_state.get("iqc_evicted", 0) + 1
+
+
+def enforce_session_memory_budget() -> int:
+    """Thu gọn các xét nghiệm ít dùng nhất tới khi dưới ngân sách; trả về số xét nghiệm đã thu gọn."""
+    budget = session_memory_budget()
+    lab_id = get_current_user().get("lab_id")
+    if budget <= 0 or not lab_id or not storage_is_configured():
+        return 0  # không có nơi để nạp lại
+    store = st.session_state.get("iqc_multi") or {}
+    sizes = {k: _state_nbytes(k, s) for k, s in store.items() if not s.get("_lazy")}
+    total = sum(sizes.values())
+    if total <= budget:
+        return 0
+    try:
+        writer = _get_write_behind()
+        failures = writer.status()["failures"]
+    except Exception:
+        return 0
+    active = st.session_state.get("active_analyte")
+    dirty = st.session_state.get("iqc_dirty") or {}
+    lru = st.session_state.get("iqc_lru") or {}
+    n = 0
+    for key in sorted(sizes, key=lambda k: lru.get(k, 0.0)):
+        if total <= budget:
+            break
+        if key == active or key in dirty or (lab_id, key) in failures or writer.is_pending(lab_id, key):
+            continue
+        _evict_analyte(store, key)
+        total -= sizes[key]
+        n += 1
+    return n
+
+
 def get_current_analyte_state():
     """Trả về dict state của xét nghiệm đang chọn."""
     store, active = _init_multi_analyte_store()
@@ -700,17 +1870,260 @@ def update_current_analyte_state(**kwargs):
     """Cập nhật state cho xét nghiệm đang chọn."""
     store, active = _init_multi_analyte_store()
     cur = store.get(active, {})
-    cur.update(kwargs)
+    # Giá trị không đổi (vd. data_editor trả lại bảng y hệt) -> giữ object cũ, không tính lại / lưu lại
+    changed = {k: v for k, v in kwargs.items() if not _same_value(cur.get(k), v)}
+    if not changed:
+        return
+    cur.update(changed)
+    cur["_rev"] = cur.get("_rev", 0) + 1
     store[active] = cur
     st.session_state["iqc_multi"] = store
 
-    # (NEW) autosave DB (nếu đã login)
+    # (NEW) autosave: chỉ đánh dấu dirty, flush_state_saves() ghi gộp 1 lần cuối lượt chạy
+    mark_state_dirty(active, changed.keys())
+
+
+def _same_value(old, new) -> bool:
+    if old is new:
+        return True
+    if isinstance(old, pd.DataFrame) or isinstance(new, pd.DataFrame):
+        return (
+            isinstance(old, pd.DataFrame)
+            and isinstance(new, pd.DataFrame)
+            and list(old.columns) == list(new.columns)
+            and old.dtypes.equals(new.dtypes)
+            and old.index.equals(new.index)
+            and old.equals(new)
+        )
     try:
-        user = get_current_user()
-        if user.get("lab_id") and supabase_is_configured():
-            db_save_state(user["lab_id"], active, cur)
+        return bool(old == new)
     except Exception:
-        pass
+        return False
+
+
+def mark_state_dirty(analyte_key: str, fields):
+    """Đánh dấu các thành phần state của 1 xét nghiệm cần lưu."""
+    dirty = st.session_state.setdefault("iqc_dirty", {})
+    dirty.setdefault(analyte_key, set()).update(fields)
+
+
+def _mark_state_saved(analyte_key: str, state: dict):
+    """Ghi nhận state hiện tại là bản đã lưu (hash / snapshot ô dữ liệu / mốc patch theo chế độ lưu)."""
+    saved = st.session_state.setdefault("iqc_saved_hash", {})
+    st.session_state.setdefault("iqc_versions", {})[analyte_key] = int(state.get("_version") or 0)
+    if persistence_mode() == "runs":
+        saved[analyte_key] = _payload_hash(_runs_state_row(state))
+        st.session_state.setdefault("iqc_runs_saved", {})[analyte_key] = _runs_cells(state)
+        return
+    saved[analyte_key] = _payload_hash(_state_payload(state))
+    seq = int(state.get("_patch_seq") or 0)
+    st.session_state.setdefault("iqc_patch_seq", {})[analyte_key] = seq
+    if state_patches_enabled():
+        bases = st.session_state.setdefault("iqc_patch_base", {})
+        bases[analyte_key] = _patch_base(state, int(state.get("_patch_n") or 0))
+
+
+def _saved_marks() -> tuple:
+    """Các dict mốc 'đã lưu' của phiên (giữ tham chiếu được ở thread ghi nền)."""
+    return tuple(st.session_state.setdefault(k, {}) for k in ("iqc_saved_hash", "iqc_runs_saved", "iqc_patch_base"))
+
+
+def _forget_state_saved(analyte_key: str, marks: tuple | None = None):
+    """Quên bản đã lưu -> lần flush sau gửi lại toàn bộ."""
+    for d in marks if marks is not None else _saved_marks():
+        d.pop(analyte_key, None)
+
+
+def _save_payload(analyte_key: str, state: dict, saved: dict):
+    """
+    (payload, on_saved) cần ghi theo chế độ lưu; payload None nếu không có gì đổi.
+    on_saved() ghi nhận bản vừa gửi làm mốc so sánh cho lần sau.
+    """
+    if persistence_mode() == "runs":
+        row = _runs_state_row(state)
+        digest = _payload_hash(row)
+        cells = _runs_cells(state)
+        prev = st.session_state.setdefault("iqc_runs_saved", {}).get(analyte_key, {})
+        changed = _diff_cells(prev, cells)
+        row_changed = saved.get(analyte_key) != digest
+        if not changed and not row_changed:
+            return None, None
+
+        runs_saved = st.session_state["iqc_runs_saved"]
+
+        def on_saved():
+            saved[analyte_key] = digest
+            runs_saved[analyte_key] = cells
+
+        return {"mode": "runs", "state": row if row_changed else None, "cells": changed}, on_saved
+
+    seqs = st.session_state.setdefault("iqc_patch_seq", {})
+    bases = st.session_state.setdefault("iqc_patch_base", {})
+    base = bases.get(analyte_key) if state_patches_enabled() else None
+    seq = seqs.get(analyte_key, 0) + 1
+    patch = None
+    if base is not None:
+        # Chỉ gửi các dòng thêm/sửa/xoá so với bản đã lưu
+        patch = _state_patch(base, state)
+        if not patch:
+            return None, None
+        if base["n"] < STATE_PATCH_COMPACT_EVERY:
+            new_base = _patch_base(state, base["n"] + 1)
+
+            def on_saved():
+                seqs[analyte_key] = seq
+                bases[analyte_key] = new_base
+                saved.pop(analyte_key, None)
+
+            return {"mode": "patch", "seq": seq, "patch": patch}, on_saved
+
+    # Snapshot đầy đủ (lần đầu / sau lỗi ghi / điểm nén định kỳ);
+    # kèm patch (nếu có) để ghi thay khi snapshot bị xung đột phiên bản
+    payload = _state_payload(state)
+    digest = _payload_hash(payload)
+    if saved.get(analyte_key) == digest:
+        return None, None
+    if not state_patches_enabled():
+
+        def on_saved():
+            saved[analyte_key] = digest
+
+        return {"mode": "snapshot", "state": payload, "patch": None}, on_saved
+
+    payload["patch_seq"] = seq
+    new_base = _patch_base(state, 0)
+
+    def on_saved():
+        saved[analyte_key] = digest
+        seqs[analyte_key] = seq
+        bases[analyte_key] = new_base
+
+    return {"mode": "snapshot", "state": payload, "patch": patch}, on_saved
+
+
+def flush_state_saves() -> int:
+    """
+    Ghi các xét nghiệm có thay đổi trong lượt chạy: tối đa 1 upsert / xét nghiệm,
+    bỏ qua nếu hash nội dung trùng lần lưu trước. Trả về số lần ghi thực sự.
+    Gọi ở cuối mỗi trang (và đầu render_sidebar để vét phần còn sót khi trang dừng giữa chừng).
+    """
+    # Giữ nguyên dict iqc_dirty (thread ghi nền đánh dấu lại vào đó khi ghi lỗi)
+    dirty_marks = st.session_state.setdefault("iqc_dirty", {})
+    if not dirty_marks:
+        return 0
+    dirty = dict(dirty_marks)
+    dirty_marks.clear()
+
+    user = get_current_user()
+    if not user.get("lab_id") or not storage_is_configured():
+        return 0
+
+    store = st.session_state.get("iqc_multi", {})
+    saved = st.session_state.setdefault("iqc_saved_hash", {})
+    marks = _saved_marks()
+    n_saved = 0
+    for analyte_key, fields in dirty.items():
+        state = store.get(analyte_key)
+        if state is None:
+            continue
+        try:
+            payload, on_saved = _save_payload(analyte_key, state, saved)
+        except Exception:
+            continue
+        if payload is None:
+            continue
+        # Phiên bản mà thay đổi này dựa trên (None = người dùng chọn ghi đè)
+        force = st.session_state.setdefault("iqc_force_save", set())
+        payload["owner"] = _session_owner()
+        if analyte_key in force:
+            force.discard(analyte_key)
+            payload["base_version"] = None
+        else:
+            payload["base_version"] = st.session_state.setdefault("iqc_versions", {}).get(analyte_key, 0)
+        # Ghi nền để lượt chạy không phải chờ mạng; hàng đợi đầy -> ghi đồng bộ.
+        # Mốc "đã lưu" tiến ngay khi gửi (lần flush sau chỉ gửi phần đổi tiếp theo, nối sau payload
+        # đang chờ); ghi nền lỗi hẳn -> on_done lùi mốc ngay ở thread ghi: quên bản đã lưu
+        # (lần sau gửi snapshot đầy đủ) và đánh dấu dirty lại. Xung đột phiên bản: chờ người dùng chọn.
+        marked = threading.Event()
+
+        def on_done(error, analyte_key=analyte_key, fields=fields, marked=marked):
+            if error is not None and not isinstance(error, VersionConflict):
+                marked.wait(5.0)  # lùi sau khi on_saved() đã tiến mốc
+                _forget_state_saved(analyte_key, marks)
+                dirty_marks.setdefault(analyte_key, set()).update(fields)
+
+        try:
+            queued = _get_write_behind().submit(user["lab_id"], analyte_key, payload, on_done=on_done)
+        except Exception:
+            queued = False
+        try:
+            if queued or _db_write_sync(user["lab_id"], analyte_key, payload):
+                on_saved()
+                n_saved += 1
+            else:
+                # Lỗi ghi -> giữ dirty để thử lại ở lượt chạy sau
+                mark_state_dirty(analyte_key, fields)
+        finally:
+            marked.set()
+    return n_saved
+
+
+def render_save_status():
+    """Sidebar: số bản ghi đang chờ ghi nền, nút ghi ngay và các lỗi ghi kéo dài."""
+    if not is_logged_in() or not storage_is_configured():
+        return
+    try:
+        writer = _get_write_behind()
+    except Exception as e:
+        st.warning(f"Không khởi tạo được bộ ghi dữ liệu: {e}")
+        return
+
+    lab_id = get_current_user().get("lab_id")
+    status = writer.status()
+    failures = {a: info for (lab, a), info in status["failures"].items() if lab == lab_id}
+
+    # Ghi lỗi hẳn: mốc đã lưu được lùi ngay khi lỗi (on_done trong flush_state_saves);
+    # xung đột phiên bản thì chờ người dùng chọn tải lại / ghi đè
+    st.markdown("### 💾 Lưu dữ liệu")
+    if storage_backend_name() == "sqlite":
+        st.caption("🗄️ Lưu cục bộ (SQLite) – không cần Internet")
+    if status["pending"]:
+        st.caption(f"⏳ Đang chờ ghi: {status['pending']} xét nghiệm")
+    else:
+        st.caption("✅ Đã lưu toàn bộ thay đổi")
+    mem = session_memory_usage()
+    budget = f" / {mem['budget'] / 2**20:.0f} MB" if mem["budget"] > 0 else ""
+    st.caption(
+        f"🧠 Bộ nhớ phiên: {mem['bytes'] / 2**20:.1f} MB{budget} · "
+        f"đang giữ {mem['loaded']}/{mem['total']} xét nghiệm"
+    )
+    if st.button("💾 Ghi ngay", use_container_width=True):
+        flush_state_saves()
+        if not writer.flush(timeout=10):
+            st.warning("Vẫn còn dữ liệu chưa ghi xong, sẽ tiếp tục ghi nền.")
+    reloaded = st.session_state.pop("iqc_reloaded", None)
+    if reloaded:
+        st.info(f"🔄 '{reloaded}' vừa được cập nhật từ phiên khác, đã tải bản mới nhất.")
+    for analyte_key, info in failures.items():
+        if not info.get("conflict"):
+            st.error(
+                f"Không lưu được '{analyte_key}' sau {info['attempts']} lần thử: {info['error']}"
+            )
+            continue
+        st.error(f"⚠️ '{analyte_key}' đã được người khác sửa trong lúc bạn đang sửa – chưa lưu thay đổi của bạn.")
+        c1, c2 = st.columns(2)
+        if c1.button("🔄 Tải bản mới", key=f"iqc_conflict_reload_{analyte_key}", use_container_width=True):
+            writer.clear_failure(lab_id, analyte_key)
+            st.session_state.get("iqc_multi", {}).pop(analyte_key, None)
+            st.session_state.get("iqc_dirty", {}).pop(analyte_key, None)
+            _forget_state_saved(analyte_key)
+            _rerun()
+        if c2.button("⚠️ Ghi đè", key=f"iqc_conflict_force_{analyte_key}", use_container_width=True):
+            writer.clear_failure(lab_id, analyte_key)
+            st.session_state.setdefault("iqc_force_save", set()).add(analyte_key)
+            _forget_state_saved(analyte_key)
+            mark_state_dirty(analyte_key, [])
+            _rerun()
 
 
 # =====================================================
@@ -723,12 +2136,16 @@ def render_sidebar():
     Sidebar dùng chung cho tất cả pages.
     Hỗ trợ multi-analyte: chọn / tạo xét nghiệm.
     """
+    # Lượt chạy trước dừng giữa chừng (st.stop/rerun) -> ghi nốt thay đổi còn treo
+    flush_state_saves()
     store, active = _init_multi_analyte_store()
 
     with st.sidebar:
         # Logo nhỏ + menu điều hướng (ẩn menu mặc định bằng CSS)
         logo_path = "assets/qc_logo.png"
-        if os.path.exists(logo_path):
+        if static_serving_enabled() and asset_src(logo_path):
+            st.markdown(f"<img src='{asset_src(logo_path)}' width='120' alt='logo'/>", unsafe_allow_html=True)
+        elif os.path.exists(logo_path):
             st.image(logo_path, width=120)
 
         st.markdown('<div class="qc-nav">', unsafe_allow_html=True)
@@ -754,32 +2171,14 @@ def render_sidebar():
         st.session_state["active_analyte"] = selected
         store, active = _init_multi_analyte_store()
         cur = store[active]
+        enforce_session_memory_budget()
 
         new_name = st.text_input("Tên xét nghiệm mới")
         if st.button("➕ Thêm xét nghiệm mới", use_container_width=True):
             if new_name.strip():
                 name = new_name.strip()
                 if name not in store:
-                    store[name] = {
-                        "config": {
-                            "test_name": name,
-                            "unit": "",
-                            "device": "",
-                            "method": "",
-                            "qc_name": "",
-                            "qc_lot": "",
-                            "qc_expiry": "",
-                            "num_levels": 2,
-                            "sigma_value": 6.0,
-                        },
-                        "baseline_df": None,
-                        "qc_stats": None,
-                        "daily_df": None,
-                        "z_df": None,
-                        "summary_df": None,
-                        "point_df": None,
-                        "export_df": None,
-                    }
+                    store[name] = _new_analyte_state(name)
                 st.session_state["active_analyte"] = name
                 store, active = _init_multi_analyte_store()
                 cur = store[active]
@@ -823,6 +2222,9 @@ def render_sidebar():
             help="Nếu =0 hoặc <4, app dùng bộ quy tắc nhóm <4-sigma.",
         )
 
+        st.markdown("---")
+        render_save_status()
+
         st.markdown("---")
         st.caption(
             "💡 Copyright © 2025 LINH CSQL."
@@ -843,6 +2245,8 @@ def render_sidebar():
         "num_levels": num_levels,
         "sigma_value": sigma_value,
     }
+    if cur.get("config") != cfg_new:
+        mark_state_dirty(active, ["config"])
     cur["config"] = cfg_new
     store[active] = cur
     st.session_state["iqc_multi"] = store
@@ -852,7 +2256,7 @@ def render_sidebar():
 
 
 def render_global_header():
-    gif_data = _img_to_base64("assets/header_anim.gif")
+    gif_data = asset_src("assets/header_anim.gif")
     gif_html = (
         f"<img class='qc-header-gif' src='{gif_data}' alt='IQC animation'/>"
         if gif_data else ""
@@ -935,50 +2339,16 @@ def render_top_info_cards(cfg, sigma_cat, active_rules):
 
 
 # =====================================================
-# HÀM TÍNH TOÁN
+# BIỂU ĐỒ & WESTGARD THEO PHIÊN
+# Phần tính toán (z-score, Westgard, bảng dẫn xuất) nằm trong package iqc,
+# không phụ thuộc Streamlit; ở đây chỉ còn lớp hiển thị / session.
 # =====================================================
 
 
-def compute_stats(values):
-    arr = np.array([v for v in values if v not in (None, "")])
-    arr = arr.astype(float) if arr.size > 0 else arr
-
-    if arr.size == 0:
-        return np.nan, np.nan, np.nan
-
-    mean = float(arr.mean())
-    sd = float(arr.std(ddof=1)) if arr.size > 1 else np.nan
-    cv = float(sd / mean * 100) if (mean != 0 and not np.isnan(sd)) else np.nan
-    return mean, sd, cv
-
-
-def compute_zscore(value, mean, sd):
-    try:
-        v = float(value)
-        if sd is None or sd == 0 or np.isnan(sd):
-            return np.nan
-        return (v - mean) / sd
-    except Exception:
-        return np.nan
-
-
-def extract_rule_short(text):
-    if not isinstance(text, str) or not text.strip():
-        return ""
-    codes = []
-    for part in text.split(";"):
-        part = part.strip()
-        if not part:
-            continue
-        token = part.split()[0]
-        if token not in codes:
-            codes.append(token)
-    return ", ".join(codes)
-
-
 def create_levey_jennings_chart(df_long, title):
     if df_long.empty:
         return None
+    import altair as alt
 
     df = df_long.copy()
     df["z_clip"] = df["z_score"].clip(-3, 3)
@@ -1064,326 +2434,36 @@ def create_levey_jennings_chart(df_long, title):
     return chart
 
 
-def get_sigma_category_and_rules(sigma, num_levels):
-    if sigma is None or (isinstance(sigma, float) and math.isnan(sigma)) or sigma == 0:
-        cat = "<4"
-    else:
-        if sigma >= 6:
-            cat = "6"
-        elif sigma >= 5:
-            cat = "5"
-        elif sigma >= 4:
-            cat = "4"
-        else:
-            cat = "<4"
-
-    rules = {"1_3s"}  # luôn có 1_3s
-
-    if num_levels == 2:
-        if cat == "6":
-            pass
-        elif cat == "5":
-            rules.update(["R_4s", "2_2s"])
-        elif cat == "4":
-            rules.update(["R_4s", "2_2s", "4_1s"])
-        else:
-            rules.update(["R_4s", "2_2s", "4_1s", "10x"])
-    else:
-        if cat == "6":
-            pass
-        elif cat == "5":
-            rules.update(["R_4s", "2of3_2s"])
-        elif cat == "4":
-            rules.update(["R_4s", "2of3_2s", "3_1s"])
-        else:
-            rules.update(["R_4s", "2of3_2s", "3_1s", "9x"])
-
-    return cat, rules
-
-
-def evaluate_westgard(z_df, num_levels, sigma):
-    runs = z_df["Ngày/Lần"].tolist()
-    z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
-    z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
-    Z = z_df[z_cols].to_numpy(dtype=float)
-    n_runs, n_levels = Z.shape
-
-    sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
-
-    warn_by_run = [set() for _ in range(n_runs)]
-    rej_by_run = [set() for _ in range(n_runs)]
-    warn_point = [[set() for _ in range(n_levels)] for _ in range(n_runs)]
-    rej_point = [[set() for _ in range(n_levels)] for _ in range(n_runs)]
-
-    def add_warn(i, msg, levels=None):
-        warn_by_run[i].add(msg)
-        if levels is not None:
-            for l in levels:
-                warn_point[i][l].add(msg)
-
-    def add_rej(i, msg, levels=None):
-        rej_by_run[i].add(msg)
-        if levels is not None:
-            for l in levels:
-                rej_point[i][l].add(msg)
-
-    # 1_2s
-    for i in range(n_runs):
-        for l in range(n_levels):
-            z = Z[i, l]
-            if np.isnan(z):
-                continue
-            if 2 <= abs(z) < 3:
-                msg = f"1_2s (Ctrl {l+1}, z={z:.2f})"
-                add_warn(i, msg, levels=[l])
-
-    # 1_3s
-    if "1_3s" in active_rules:
-        for i in range(n_runs):
-            for l in range(n_levels):
-                z = Z[i, l]
-                if np.isnan(z):
-                    continue
-                if abs(z) >= 3:
-                    msg = f"1_3s (Ctrl {l+1}, z={z:.2f})"
-                    add_rej(i, msg, levels=[l])
-
-    # 2_2s
-    if "2_2s" in active_rules:
-        # cùng lần chạy, 2 mức khác nhau
-        for i in range(n_runs):
-            idxs = []
-            signs = []
-            for l in range(n_levels):
-                z = Z[i, l]
-                if np.isnan(z):
-                    continue
-                if 2 <= abs(z) < 3:
-                    idxs.append(l)
-                    signs.append(np.sign(z) or 1)
-            for s in (+1, -1):
-                levels = [l for l, sgn in zip(idxs, signs) if sgn == s]
-                if len(levels) >= 2:
-                    msg = (
-                        "2_2s (cùng lần chạy, "
-                        + ", ".join(f"Ctrl {l+1}" for l in levels)
-                        + " cùng phía 2–3SD)"
-                    )
-                    add_rej(i, msg, levels=levels)
-
-        # cùng mức, 2 lần liên tiếp
-        for l in range(n_levels):
-            for i in range(1, n_runs):
-                z1, z2 = Z[i - 1, l], Z[i, l]
-                if any(np.isnan([z1, z2])):
-                    continue
-                if (
-                    2 <= abs(z1) < 3
-                    and 2 <= abs(z2) < 3
-                    and np.sign(z1) == np.sign(z2)
-                ):
-                    msg = f"2_2s (Ctrl {l+1}, runs {runs[i-1]}–{runs[i]})"
-                    add_rej(i, msg, levels=[l])
-
-    # 2/3_2s
-    if "2of3_2s" in active_rules:
-        # cùng mức, 3 lần liên tiếp
-        for l in range(n_levels):
-            for i in range(2, n_runs):
-                window_idx = [i - 2, i - 1, i]
-                vals = [Z[j, l] for j in window_idx]
-                if all(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    cnt = sum(
-                        (not np.isnan(v)) and abs(v) >= 2 and np.sign(v) == s
-                        for v in vals
-                    )
-                    if cnt >= 2:
-                        msg = f"2/3_2s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})"
-                        add_rej(i, msg, levels=[l])
-                        break
-
-        # cùng lần chạy, nhiều mức
-        for i in range(n_runs):
-            vals = [Z[i, l] for l in range(n_levels)]
-            for s in (+1, -1):
-                levels = [
-                    l
-                    for l, v in enumerate(vals)
-                    if (not np.isnan(v)) and abs(v) >= 2 and np.sign(v) == s
-                ]
-                if len(levels) >= 2:
-                    msg = f"2/3_2s (run {runs[i]}, ≥2 mức QC cùng phía ≥2SD)"
-                    add_rej(i, msg, levels=levels)
-                    break
-
-    # R_4s
-    if "R_4s" in active_rules:
-        for i in range(n_runs):
-            vals = [Z[i, l] for l in range(n_levels) if not np.isnan(Z[i, l])]
-            if len(vals) < 2:
-                continue
-            maxz = max(vals)
-            minz = min(vals)
-            if (maxz - minz) >= 4 and maxz >= 2 and minz <= -2:
-                levels = []
-                for l in range(n_levels):
-                    if np.isnan(Z[i, l]):
-                        continue
-                    if Z[i, l] == maxz or Z[i, l] == minz:
-                        levels.append(l)
-                msg = f"R_4s (run {runs[i]}, chênh lệch ≥4SD giữa các mức QC)"
-                add_rej(i, msg, levels=levels)
-
-    # 3_1s
-    if "3_1s" in active_rules:
-        for l in range(n_levels):
-            for i in range(2, n_runs):
-                window_idx = [i - 2, i - 1, i]
-                vals = [Z[j, l] for j in window_idx]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
-                        msg = f"3_1s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})"
-                        add_rej(i, msg, levels=[l])
-                        break
-
-        if n_levels >= 3:
-            for i in range(n_runs):
-                vals = [Z[i, l] for l in range(n_levels)]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    levels = [
-                        l for l, v in enumerate(vals) if abs(v) >= 1 and np.sign(v) == s
-                    ]
-                    if len(levels) >= 3:
-                        msg = f"3_1s (run {runs[i]}, ≥3 mức QC cùng phía ≥1SD)"
-                        add_rej(i, msg, levels=levels)
-                        break
-
-    # 4_1s
-    if "4_1s" in active_rules:
-        for l in range(n_levels):
-            for i in range(3, n_runs):
-                window_idx = [i - 3, i - 2, i - 1, i]
-                vals = [Z[j, l] for j in window_idx]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
-                        msg = f"4_1s (Ctrl {l+1}, runs {runs[i-3]}–{runs[i]})"
-                        add_rej(i, msg, levels=[l])
-                        break
-
-        if n_levels == 2:
-            for i in range(1, n_runs):
-                idxs = [i - 1, i]
-                vals = [Z[j, l] for j in idxs for l in range(n_levels)]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
-                        msg = "4_1s (2 lần chạy x 2 mức QC, tất cả cùng phía ≥1SD)"
-                        add_rej(i, msg, levels=[0, 1])
-                        break
-
-    # 9x
-    if "9x" in active_rules:
-        for l in range(n_levels):
-            for i in range(8, n_runs):
-                window_idx = list(range(i - 8, i + 1))
-                vals = [Z[j, l] for j in window_idx]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(np.sign(v) == s for v in vals):
-                        msg = f"9x (Ctrl {l+1}, 9 kết quả liên tiếp cùng phía)"
-                        add_rej(i, msg, levels=[l])
-                        break
-
-        if n_levels == 3:
-            for i in range(2, n_runs):
-                window_idx = [i - 2, i - 1, i]
-                vals = [Z[j, l] for j in window_idx for l in range(n_levels)]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(np.sign(v) == s for v in vals):
-                        msg = "9x (3 lần chạy x 3 mức QC, tất cả cùng phía)"
-                        add_rej(i, msg, levels=[0, 1, 2])
-                        break
-
-    # 10x
-    if "10x" in active_rules and n_levels == 2:
-        for l in range(n_levels):
-            for i in range(9, n_runs):
-                window_idx = list(range(i - 9, i + 1))
-                vals = [Z[j, l] for j in window_idx]
-                if any(np.isnan(v) for v in vals):
-                    continue
-                for s in (+1, -1):
-                    if all(np.sign(v) == s for v in vals):
-                        msg = f"10x (Ctrl {l+1}, 10 kết quả liên tiếp cùng phía)"
-                        add_rej(i, msg, levels=[l])
-                        break
-
-        for i in range(4, n_runs):
-            window_idx = list(range(i - 4, i + 1))
-            vals = [Z[j, l] for j in window_idx for l in range(n_levels)]
-            if any(np.isnan(v) for v in vals):
-                continue
-            for s in (+1, -1):
-                if all(np.sign(v) == s for v in vals):
-                    msg = "10x (5 lần chạy x 2 mức QC, tất cả cùng phía)"
-                    add_rej(i, msg, levels=[0, 1])
-                    break
-
-    # Tổng hợp theo run
-    rows = []
-    for i, run in enumerate(runs):
-        warns = sorted(warn_by_run[i])
-        rejs = sorted(rej_by_run[i])
-        if rejs:
-            status = "Không đạt (Reject QC)"
-        elif warns:
-            status = "Cảnh báo (1_2s)"
-        else:
-            status = "Đạt"
-        all_msgs = rejs + warns
-        rows.append(
-            {
-                "Ngày/Lần": run,
-                "Trạng thái": status,
-                "Vi phạm loại bỏ": "; ".join(all_msgs),
-                "Người thực hiện": "",
-            }
-        )
-    summary_df = pd.DataFrame(rows)
-
-    # Tổng hợp theo điểm
-    point_rows = []
-    for i, run in enumerate(runs):
-        for l in range(n_levels):
-            warns = sorted(warn_point[i][l])
-            rejs = sorted(rej_point[i][l])
-            if rejs:
-                p_status = "Không đạt (Reject QC)"
-            elif warns:
-                p_status = "Cảnh báo (1_2s)"
-            else:
-                p_status = "Đạt"
-            all_msgs = rejs + warns
-            point_rows.append(
-                {
-                    "Ngày/Lần": run,
-                    "Control": f"Ctrl {l+1}",
-                    "point_status": p_status,
-                    "rule_codes": "; ".join(all_msgs),
-                }
-            )
-    point_df = pd.DataFrame(point_rows)
-
-    return sigma_cat, active_rules, summary_df, point_df
+def lab_analyte_states(skipped: list | None = None) -> dict:
+    """
+    {analyte_key: state} mọi xét nghiệm của lab (cả danh mục, không chỉ các xét nghiệm đã mở).
+    Bản chưa tải / đã thu gọn ("_lazy") đọc qua cache process, không giữ lại trong phiên.
+    skipped: list nhận các xét nghiệm không tải được (vẫn trả về bản rỗng).
+    """
+    store, _ = _init_multi_analyte_store()
+    lab_id = get_current_user().get("lab_id")
+    states = {}
+    for key, state in store.items():
+        if state.get("_lazy") and lab_id:
+            try:
+                loaded = db_load_state(lab_id, key)
+            except Exception:
+                loaded = None
+            if loaded is None and skipped is not None:
+                skipped.append(key)
+            state = loaded or state
+        states[key] = state
+    _prime_z_dfs(states)
+    return states
+
+
+def lab_westgard_overview():
+    """Tổng quan Westgard mọi xét nghiệm (đã có z-score) của lab – dùng cho dashboard toàn PXN."""
+    states = lab_analyte_states()
+    analytes = {}
+    for key, state in states.items():
+        z_df = get_derived(state, "z_df")
+        cfg = state.get("config") or {}
+        if isinstance(z_df, pd.DataFrame) and not z_df.empty:
+            analytes[key] = (z_df, cfg.get("num_levels", 2), cfg.get("sigma_value", 6.0))
+    return evaluate_westgard_batch(analytes)
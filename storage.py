@@ -0,0 +1,491 @@
+"""
+storage.py — Lớp lưu trữ dữ liệu IQC (có thể thay thế backend).
+
+- StorageBackend: giao diện chung (load_state, save_state, list_analytes, append_runs, load_runs,
+  append_patch / load_patches / prune_patches cho lưu dạng patch,
+  get_version / cas_state / insert_patch cho ghi có kiểm tra phiên bản).
+- SupabaseStorage: bảng iqc_state / iqc_runs trên Supabase.
+- SQLiteStorage: file SQLite cục bộ (WAL) – cho PXN mạng chập chờn, chạy offline, benchmark.
+
+Backend chỉ làm việc với payload đã serialize (dict JSON được) và các dòng giá trị thô;
+chuyển đổi DataFrame / tính lại bảng dẫn xuất nằm ở qc_core.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+RunRow = Tuple[str, int, int, Optional[float]]  # (kind, run, level, value)
+
+
+class VersionConflict(Exception):
+    """Dữ liệu đã bị người khác ghi (version trên DB khác version mong đợi)."""
+
+
+class StorageBackend:
+    """
+    Giao diện lưu trữ; lỗi ghi được raise để nơi gọi (write-behind) thử lại.
+    versioned=True: iqc_state có cột version tăng dần sau mỗi lần ghi (compare-and-swap).
+    """
+
+    name = "base"
+    versioned = False
+
+    def load_state(self, lab_id: str, analyte_key: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        """(state, version); chưa có dữ liệu -> (None, 0)."""
+        raise NotImplementedError
+
+    def save_state(self, lab_id: str, analyte_key: str, payload: Dict[str, Any]) -> None:
+        """Ghi đè không điều kiện (version vẫn tăng nếu backend có version)."""
+        raise NotImplementedError
+
+    def get_version(self, lab_id: str, analyte_key: str) -> int:
+        """Chỉ đọc version (0 nếu chưa có) – kiểm tra rẻ 'dữ liệu có đổi không'."""
+        raise NotImplementedError
+
+    def cas_state(
+        self, lab_id: str, analyte_key: str, expected: int, payload: Optional[Dict[str, Any]] = None
+    ) -> Optional[int]:
+        """
+        Compare-and-swap: nếu version hiện tại == expected thì tăng version
+        (và thay state nếu payload khác None). Trả về version mới, None nếu xung đột.
+        """
+        raise NotImplementedError
+
+    def list_analytes(self, lab_id: str) -> Dict[str, Optional[Dict[str, Any]]]:
+        """{analyte_key: config} của 1 lab (không tải dữ liệu nặng)."""
+        raise NotImplementedError
+
+    def append_runs(self, lab_id: str, analyte_key: str, rows: Iterable[RunRow]) -> None:
+        """Ghi các ô giá trị thô; ô đã có (cùng kind, run, level) bị ghi đè."""
+        raise NotImplementedError
+
+    def load_runs(
+        self,
+        lab_id: str,
+        analyte_key: str,
+        kind: str = "daily",
+        run_from: Optional[int] = None,
+        run_to: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Các dòng {run, level, value} trong [run_from, run_to], sắp theo run, level."""
+        raise NotImplementedError
+
+    def append_patch(self, lab_id: str, analyte_key: str, seq: int, patch: Dict[str, Any]) -> None:
+        """Ghi 1 patch (thay đổi so với bản trước) với số thứ tự seq."""
+        raise NotImplementedError
+
+    def insert_patch(self, lab_id: str, analyte_key: str, seq: int, patch: Dict[str, Any]) -> None:
+        """Như append_patch nhưng chỉ thêm mới; seq đã có -> VersionConflict."""
+        raise NotImplementedError
+
+    def load_patches(self, lab_id: str, analyte_key: str, after_seq: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """Các (seq, patch) có seq > after_seq, sắp theo seq."""
+        raise NotImplementedError
+
+    def prune_patches(self, lab_id: str, analyte_key: str, upto_seq: int) -> None:
+        """Xoá các patch đã gộp vào snapshot (seq <= upto_seq)."""
+        raise NotImplementedError
+
+
+class SupabaseStorage(StorageBackend):
+    name = "supabase"
+    page_size = 1000
+    write_chunk = 500
+    save_retries = 5
+
+    def __init__(self, client):
+        self.client = client
+        self._versioned = None
+
+    @property
+    def versioned(self):
+        # Bảng cũ chưa có cột version -> ghi như trước (không kiểm tra xung đột)
+        if self._versioned is None:
+            try:
+                self.client.table("iqc_state").select("version").limit(1).execute()
+                self._versioned = True
+            except Exception as e:
+                # Chỉ nhớ "không có cột" khi DB báo đúng lỗi đó; lỗi mạng / quyền -> raise, lần sau thử lại
+                if not _is_missing_column(e):
+                    raise
+                self._versioned = False
+        return self._versioned
+
+    def load_state(self, lab_id, analyte_key):
+        cols = "state,version" if self.versioned else "state"
+        resp = (
+            self.client.table("iqc_state")
+            .select(cols)
+            .eq("lab_id", lab_id)
+            .eq("analyte_key", analyte_key)
+            .limit(1)
+            .execute()
+        )
+        data = getattr(resp, "data", None) or []
+        if not data:
+            return None, 0
+        state = data[0].get("state")
+        version = int(data[0].get("version") or 0)
+        return (state if isinstance(state, dict) else None), version
+
+    def save_state(self, lab_id, analyte_key, payload):
+        if not self.versioned:
+            row = {"lab_id": lab_id, "analyte_key": analyte_key, "state": payload}
+            self.client.table("iqc_state").upsert(row, on_conflict="lab_id,analyte_key").execute()
+            return
+        # Ghi đè nhưng version phải tăng nguyên tử: CAS trên version vừa đọc, thua (phiên khác
+        # vừa ghi) thì đọc lại và thử tiếp – không để 2 lần ghi cùng ra 1 version
+        for _ in range(self.save_retries):
+            if self.cas_state(lab_id, analyte_key, self.get_version(lab_id, analyte_key), payload) is not None:
+                return
+        raise VersionConflict(f"{analyte_key}: ghi không thành công sau {self.save_retries} lần (ghi đồng thời)")
+
+    def get_version(self, lab_id, analyte_key):
+        resp = (
+            self.client.table("iqc_state")
+            .select("version")
+            .eq("lab_id", lab_id)
+            .eq("analyte_key", analyte_key)
+            .limit(1)
+            .execute()
+        )
+        data = getattr(resp, "data", None) or []
+        return int(data[0].get("version") or 0) if data else 0
+
+    def cas_state(self, lab_id, analyte_key, expected, payload=None):
+        expected = int(expected)
+        if expected == 0:
+            if payload is None:
+                return None
+            try:
+                self.client.table("iqc_state").insert(
+                    {"lab_id": lab_id, "analyte_key": analyte_key, "state": payload, "version": 1}
+                ).execute()
+            except Exception as e:
+                if _is_unique_violation(e):
+                    return None
+                raise
+            return 1
+        values: Dict[str, Any] = {"version": expected + 1}
+        if payload is not None:
+            values["state"] = payload
+        resp = (
+            self.client.table("iqc_state")
+            .update(values)
+            .eq("lab_id", lab_id)
+            .eq("analyte_key", analyte_key)
+            .eq("version", expected)
+            .execute()
+        )
+        return expected + 1 if (getattr(resp, "data", None) or []) else None
+
+    def list_analytes(self, lab_id):
+        # Chỉ lấy state->config, đọc theo trang
+        index: Dict[str, Optional[Dict[str, Any]]] = {}
+        start = 0
+        while True:
+            resp = (
+                self.client.table("iqc_state")
+                .select("analyte_key,config:state->config")
+                .eq("lab_id", lab_id)
+                .order("analyte_key")
+                .range(start, start + self.page_size - 1)
+                .execute()
+            )
+            data = getattr(resp, "data", None) or []
+            for row in data:
+                key = row.get("analyte_key")
+                if key:
+                    cfg = row.get("config")
+                    index[key] = cfg if isinstance(cfg, dict) else None
+            if len(data) < self.page_size:
+                return index
+            start += self.page_size
+
+    def append_runs(self, lab_id, analyte_key, rows):
+        batch = [
+            {
+                "lab_id": lab_id,
+                "analyte_key": analyte_key,
+                "kind": kind,
+                "run": int(run),
+                "level": int(level),
+                "value": value,
+            }
+            for kind, run, level, value in rows
+        ]
+        for i in range(0, len(batch), self.write_chunk):
+            self.client.table("iqc_runs").upsert(
+                batch[i : i + self.write_chunk],
+                on_conflict="lab_id,analyte_key,kind,run,level",
+            ).execute()
+
+    def load_runs(self, lab_id, analyte_key, kind="daily", run_from=None, run_to=None):
+        rows: List[Dict[str, Any]] = []
+        start = 0
+        while True:
+            q = (
+                self.client.table("iqc_runs")
+                .select("run,level,value")
+                .eq("lab_id", lab_id)
+                .eq("analyte_key", analyte_key)
+                .eq("kind", kind)
+            )
+            if run_from is not None:
+                q = q.gte("run", int(run_from))
+            if run_to is not None:
+                q = q.lte("run", int(run_to))
+            resp = q.order("run").order("level").range(start, start + self.page_size - 1).execute()
+            data = getattr(resp, "data", None) or []
+            rows.extend(data)
+            if len(data) < self.page_size:
+                return rows
+            start += self.page_size
+
+    def append_patch(self, lab_id, analyte_key, seq, patch):
+        self.client.table("iqc_state_patches").upsert(
+            {"lab_id": lab_id, "analyte_key": analyte_key, "seq": int(seq), "patch": patch},
+            on_conflict="lab_id,analyte_key,seq",
+        ).execute()
+
+    def insert_patch(self, lab_id, analyte_key, seq, patch):
+        try:
+            self.client.table("iqc_state_patches").insert(
+                {"lab_id": lab_id, "analyte_key": analyte_key, "seq": int(seq), "patch": patch}
+            ).execute()
+        except Exception as e:
+            if _is_unique_violation(e):
+                raise VersionConflict(f"patch {seq} đã tồn tại") from e
+            raise
+
+    def load_patches(self, lab_id, analyte_key, after_seq):
+        resp = (
+            self.client.table("iqc_state_patches")
+            .select("seq,patch")
+            .eq("lab_id", lab_id)
+            .eq("analyte_key", analyte_key)
+            .gt("seq", int(after_seq))
+            .order("seq")
+            .execute()
+        )
+        data = getattr(resp, "data", None) or []
+        return [(int(r["seq"]), r["patch"]) for r in data]
+
+    def prune_patches(self, lab_id, analyte_key, upto_seq):
+        (
+            self.client.table("iqc_state_patches")
+            .delete()
+            .eq("lab_id", lab_id)
+            .eq("analyte_key", analyte_key)
+            .lte("seq", int(upto_seq))
+            .execute()
+        )
+
+
+def _is_unique_violation(e: Exception) -> bool:
+    """Lỗi trùng khoá chính từ PostgREST (mã Postgres 23505)."""
+    return getattr(e, "code", None) == "23505" or "23505" in str(e) or "duplicate key" in str(e)
+
+
+def _is_missing_column(e: Exception) -> bool:
+    """Lỗi cột không tồn tại từ PostgREST (mã Postgres 42703)."""
+    return getattr(e, "code", None) == "42703" or "42703" in str(e)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS iqc_state (
+    lab_id      TEXT    NOT NULL,
+    analyte_key TEXT    NOT NULL,
+    state       TEXT    NOT NULL,
+    updated_at  REAL    NOT NULL,
+    version     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (lab_id, analyte_key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS iqc_runs (
+    lab_id      TEXT    NOT NULL,
+    analyte_key TEXT    NOT NULL,
+    kind        TEXT    NOT NULL,
+    run         INTEGER NOT NULL,
+    level       INTEGER NOT NULL,
+    value       REAL,
+    PRIMARY KEY (lab_id, analyte_key, kind, run, level)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS iqc_state_patches (
+    lab_id      TEXT    NOT NULL,
+    analyte_key TEXT    NOT NULL,
+    seq         INTEGER NOT NULL,
+    patch       TEXT    NOT NULL,
+    PRIMARY KEY (lab_id, analyte_key, seq)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    SQLite cục bộ: WAL (đọc không chặn ghi), bảng clustered theo khoá chính
+    (lab_id, analyte_key, ...) nên đọc 1 xét nghiệm / khoảng lần chạy là 1 lần quét theo chỉ mục.
+    1 connection dùng chung, khoá bằng Lock (thread ghi nền + các script thread).
+    """
+
+    name = "sqlite"
+    versioned = True
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SQLITE_SCHEMA)
+        # File tạo trước khi có cột version
+        cols = {r[1] for r in self._conn.execute("PRAGMA table_info(iqc_state)")}
+        if "version" not in cols:
+            self._conn.execute("ALTER TABLE iqc_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load_state(self, lab_id, analyte_key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, version FROM iqc_state WHERE lab_id = ? AND analyte_key = ?",
+                (lab_id, analyte_key),
+            ).fetchone()
+        if not row:
+            return None, 0
+        state = json.loads(row[0])
+        return (state if isinstance(state, dict) else None), int(row[1])
+
+    def save_state(self, lab_id, analyte_key, payload):
+        raw = json.dumps(payload, ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO iqc_state (lab_id, analyte_key, state, updated_at, version) "
+                "VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT (lab_id, analyte_key) DO UPDATE SET "
+                "state = excluded.state, updated_at = excluded.updated_at, version = version + 1",
+                (lab_id, analyte_key, raw, time.time()),
+            )
+
+    def get_version(self, lab_id, analyte_key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM iqc_state WHERE lab_id = ? AND analyte_key = ?",
+                (lab_id, analyte_key),
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def cas_state(self, lab_id, analyte_key, expected, payload=None):
+        expected = int(expected)
+        raw = json.dumps(payload, ensure_ascii=False, default=str) if payload is not None else None
+        with self._lock:
+            if expected == 0:
+                if raw is None:
+                    return None
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO iqc_state (lab_id, analyte_key, state, updated_at, version) "
+                    "VALUES (?, ?, ?, ?, 1)",
+                    (lab_id, analyte_key, raw, time.time()),
+                )
+            else:
+                cur = self._conn.execute(
+                    "UPDATE iqc_state SET version = version + 1, state = COALESCE(?, state), updated_at = ? "
+                    "WHERE lab_id = ? AND analyte_key = ? AND version = ?",
+                    (raw, time.time(), lab_id, analyte_key, expected),
+                )
+        return expected + 1 if cur.rowcount == 1 else None
+
+    def list_analytes(self, lab_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT analyte_key, json_extract(state, '$.config') FROM iqc_state "
+                "WHERE lab_id = ? ORDER BY analyte_key",
+                (lab_id,),
+            ).fetchall()
+        index: Dict[str, Optional[Dict[str, Any]]] = {}
+        for key, cfg in rows:
+            cfg = json.loads(cfg) if cfg else None
+            index[key] = cfg if isinstance(cfg, dict) else None
+        return index
+
+    def append_runs(self, lab_id, analyte_key, rows):
+        params = [
+            (lab_id, analyte_key, kind, int(run), int(level), value)
+            for kind, run, level, value in rows
+        ]
+        if not params:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO iqc_runs (lab_id, analyte_key, kind, run, level, value) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (lab_id, analyte_key, kind, run, level) DO UPDATE SET value = excluded.value",
+                    params,
+                )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def load_runs(self, lab_id, analyte_key, kind="daily", run_from=None, run_to=None):
+        sql = "SELECT run, level, value FROM iqc_runs WHERE lab_id = ? AND analyte_key = ? AND kind = ?"
+        args: list = [lab_id, analyte_key, kind]
+        if run_from is not None:
+            sql += " AND run >= ?"
+            args.append(int(run_from))
+        if run_to is not None:
+            sql += " AND run <= ?"
+            args.append(int(run_to))
+        sql += " ORDER BY run, level"
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [{"run": r, "level": lv, "value": v} for r, lv, v in rows]
+
+    def append_patch(self, lab_id, analyte_key, seq, patch):
+        raw = json.dumps(patch, ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO iqc_state_patches (lab_id, analyte_key, seq, patch) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (lab_id, analyte_key, seq) DO UPDATE SET patch = excluded.patch",
+                (lab_id, analyte_key, int(seq), raw),
+            )
+
+    def insert_patch(self, lab_id, analyte_key, seq, patch):
+        raw = json.dumps(patch, ensure_ascii=False, default=str)
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO iqc_state_patches (lab_id, analyte_key, seq, patch) VALUES (?, ?, ?, ?)",
+                    (lab_id, analyte_key, int(seq), raw),
+                )
+        except sqlite3.IntegrityError as e:
+            raise VersionConflict(f"patch {seq} đã tồn tại") from e
+
+    def load_patches(self, lab_id, analyte_key, after_seq):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, patch FROM iqc_state_patches "
+                "WHERE lab_id = ? AND analyte_key = ? AND seq > ? ORDER BY seq",
+                (lab_id, analyte_key, int(after_seq)),
+            ).fetchall()
+        return [(seq, json.loads(raw)) for seq, raw in rows]
+
+    def prune_patches(self, lab_id, analyte_key, upto_seq):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM iqc_state_patches WHERE lab_id = ? AND analyte_key = ? AND seq <= ?",
+                (lab_id, analyte_key, int(upto_seq)),
+            )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Chạy pytest từ gốc repo: import được iqc, utils, export, storage
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
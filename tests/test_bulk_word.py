@@ -0,0 +1,37 @@
+"""
+export.bulk_word.export_zip: tên trùng được đánh số, lỗi khoá theo tên trong ZIP.
+"""
+import io
+import zipfile
+
+import pytest
+
+from export.bulk_word import ReportJob, export_zip
+
+
+def build_ok(text):
+    return io.BytesIO(text.encode())
+
+
+def build_fail(text):
+    raise RuntimeError(text)
+
+
+JOBS = [
+    ReportJob("a.docx", build_ok, {"text": "1"}),
+    ReportJob("a.docx", build_fail, {"text": "hỏng 2"}),
+    ReportJob("a.docx", build_fail, {"text": "hỏng 3"}),
+    ReportJob("b.docx", build_ok, {"text": "4"}),
+]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_duplicate_names_keep_every_failure(workers):
+    buf = io.BytesIO()
+    seen = []
+    failures = export_zip(JOBS, buf, workers=workers, progress=lambda done, total, name: seen.append(name))
+    assert failures == {"a_2.docx": "RuntimeError: hỏng 2", "a_3.docx": "RuntimeError: hỏng 3"}
+    with zipfile.ZipFile(buf) as zf:
+        assert sorted(zf.namelist()) == ["a.docx", "b.docx"]
+        assert zf.read("a.docx") == b"1"
+    assert sorted(seen) == ["a.docx", "a_2.docx", "a_3.docx", "b.docx"]
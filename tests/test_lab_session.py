@@ -0,0 +1,149 @@
+"""
+qc_core với phiên Streamlit giả (session_state = dict) trên SQLiteStorage tạm:
+danh mục cả lab, ghi nền.
+"""
+import pandas as pd
+import pytest
+
+import qc_core
+from storage import SQLiteStorage, VersionConflict
+
+LAB = "lab1"
+
+
+def analyte_state(name, n=12, offset=0.0):
+    state = qc_core._new_analyte_state(name, {"num_levels": 2, "sigma_value": 6.0})
+    state["daily_df"] = pd.DataFrame(
+        {
+            "Ngày/Lần": list(range(1, n + 1)),
+            "Ctrl 1": [100.0 + offset + (i % 3) for i in range(n)],
+            "Ctrl 2": [200.0 + offset - (i % 2) for i in range(n)],
+        }
+    )
+    state["qc_stats"] = pd.DataFrame(
+        {"Control": ["Ctrl 1", "Ctrl 2"], "Mean_X": [101.0, 200.0], "SD_empirical": [1.0, 1.0]}
+    )
+    state["sd_mode"] = "SD thực nghiệm"
+    return state
+
+
+@pytest.fixture
+def lab(monkeypatch, tmp_path):
+    """Đã đăng nhập vào LAB, nơi lưu là file SQLite tạm."""
+    storage = SQLiteStorage(str(tmp_path / "iqc.sqlite3"))
+    monkeypatch.setenv("IQC_STORAGE", "sqlite")
+    monkeypatch.setattr(qc_core, "get_storage", lambda: storage)
+    monkeypatch.setattr(
+        qc_core.st, "session_state", {"auth_ok": True, "username": "u", "lab_id": LAB, "active_analyte": "A"}
+    )
+    qc_core.clear_state_cache()
+    yield storage
+    qc_core.clear_state_cache()
+
+
+def store_analyte(storage, name, **kw):
+    storage.save_state(LAB, name, qc_core._state_payload(analyte_state(name, **kw)))
+
+
+def test_overview_lists_every_stored_analyte(lab):
+    for i, name in enumerate(["A", "B", "C"]):
+        store_analyte(lab, name, offset=i)
+    store, active = qc_core._init_multi_analyte_store()
+    assert active == "A" and not store["A"].get("_lazy")
+    assert store["B"].get("_lazy") and store["C"].get("_lazy")
+
+    overview, _ = qc_core.lab_westgard_overview()
+    assert sorted(overview["Xét nghiệm"]) == ["A", "B", "C"]
+    assert (overview["Số lần chạy"] == 12).all()
+    # B, C chỉ đọc qua cache process, không được ghim vào phiên
+    assert store["B"].get("_lazy") and store["C"].get("_lazy")
+
+
+def test_lab_states_reports_unloadable_analytes(lab, monkeypatch):
+    for name in ["A", "B"]:
+        store_analyte(lab, name)
+    qc_core._init_multi_analyte_store()
+    real = qc_core.db_load_state
+    monkeypatch.setattr(qc_core, "db_load_state", lambda lab_id, key: None if key == "B" else real(lab_id, key))
+    skipped = []
+    states = qc_core.lab_analyte_states(skipped)
+    assert set(states) == {"A", "B"}
+    assert skipped == ["B"]
+
+
+def test_bulk_word_covers_whole_catalogue(lab):
+    import io
+    import zipfile
+
+    from export.bulk_word import export_zip, so_gn_dg_jobs
+
+    store_analyte(lab, "A")
+    store_analyte(lab, "B", offset=1.0)
+    empty = qc_core._new_analyte_state("C")
+    lab.save_state(LAB, "C", qc_core._state_payload(empty))
+    qc_core._init_multi_analyte_store()
+
+    skipped = []
+    jobs, no_data = so_gn_dg_jobs(qc_core.lab_analyte_states(skipped))
+    assert skipped == [] and no_data == ["C"]
+    buf = io.BytesIO()
+    assert export_zip(jobs, buf, workers=1) == {}
+    with zipfile.ZipFile(buf) as zf:
+        names = sorted(zf.namelist())
+    assert len(names) == 2 and names[0].endswith("_A.docx") and names[1].endswith("_B.docx")
+
+
+def test_failed_background_write_keeps_analyte_dirty(lab, monkeypatch):
+    store_analyte(lab, "A")
+    store, _ = qc_core._init_multi_analyte_store()
+    session = qc_core.st.session_state
+    sent, fail = [], [True]
+
+    def write(lab_id, analyte_key, payload):
+        sent.append(payload["mode"])
+        if fail[0]:
+            raise ConnectionError("mất mạng")
+        qc_core._db_write_payload(lab_id, analyte_key, payload, storage=lab)
+
+    writer = qc_core.WriteBehindWriter(
+        write, max_attempts=2, base_delay=0.0, merge_fn=qc_core._merge_payloads, fatal=(VersionConflict,)
+    )
+    monkeypatch.setattr(qc_core, "_get_write_behind", lambda: writer)
+
+    state = store["A"]
+    daily = state["daily_df"].copy()
+    daily.loc[0, "Ctrl 1"] = 150.0
+    state["daily_df"] = daily
+    qc_core.mark_state_dirty("A", ["daily_df"])
+    assert qc_core.flush_state_saves() == 1
+    assert writer.flush(5)
+    # Ghi nền lỗi hẳn -> vẫn dirty, mốc đã lưu bị quên ngay (không chờ lượt chạy sau)
+    assert sent == ["patch", "patch"]
+    assert "A" in session["iqc_dirty"]
+    assert "A" not in session["iqc_saved_hash"] and "A" not in session["iqc_patch_base"]
+
+    fail[0] = False
+    assert qc_core.flush_state_saves() == 1
+    assert writer.flush(5)
+    assert sent[2:] == ["snapshot"]
+    assert not session["iqc_dirty"] and writer.status()["failures"] == {}
+    qc_core.clear_state_cache()
+    assert qc_core.db_load_state(LAB, "A")["daily_df"].loc[0, "Ctrl 1"] == 150.0
+
+
+def test_conflicting_background_write_waits_for_user(lab, monkeypatch):
+    store_analyte(lab, "A")
+    store, _ = qc_core._init_multi_analyte_store()
+    session = qc_core.st.session_state
+
+    def write(lab_id, analyte_key, payload):
+        raise VersionConflict("phiên khác vừa ghi")
+
+    writer = qc_core.WriteBehindWriter(write, max_attempts=3, base_delay=0.0, fatal=(VersionConflict,))
+    monkeypatch.setattr(qc_core, "_get_write_behind", lambda: writer)
+    store["A"]["sd_mode"] = "SD từ CVh"
+    qc_core.mark_state_dirty("A", ["sd_mode"])
+    qc_core.flush_state_saves()
+    assert writer.flush(5)
+    assert writer.status()["failures"][(LAB, "A")]["conflict"]
+    assert not session["iqc_dirty"]
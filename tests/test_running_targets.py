@@ -0,0 +1,181 @@
+"""
+CSTK chạy (iqc.derived.running_qc_targets) cập nhật dần theo phần đuôi đổi của WestgardStream
+phải bằng tính lại từ đầu (np.nanmean / np.nanstd) sau khi thêm, sửa, xoá run và khi run đổi trạng thái.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from iqc.derived import get_derived, running_qc_targets
+from iqc.westgard import clear_westgard_cache, westgard_cache_stats
+
+WINDOW = 5
+MEANS = [100.0, 200.0, 300.0]
+SDS = [2.0, 4.0, 6.0]
+
+
+def make_state(n, levels=2, seed=0):
+    rng = np.random.default_rng(seed)
+    daily = pd.DataFrame({"Ngày/Lần": list(range(1, n + 1))})
+    for j in range(levels):
+        col = rng.normal(MEANS[j], SDS[j] * 1.2, n)
+        col[rng.random(n) < 0.1] = np.nan
+        daily[f"Ctrl {j + 1}"] = col
+    return {
+        "config": {"num_levels": levels, "sigma_value": 4.0},
+        "daily_df": daily,
+        "qc_stats": pd.DataFrame(
+            {"Control": [f"Ctrl {j + 1}" for j in range(levels)], "Mean_X": MEANS[:levels], "SD_empirical": SDS[:levels]}
+        ),
+        "sd_mode": "SD thực nghiệm",
+        "_rev": 0,
+    }
+
+
+def set_daily(state, daily):
+    state["daily_df"] = daily.reset_index(drop=True)
+    state["_rev"] += 1
+
+
+def _figures(values):
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    mean = float(values.mean()) if n else np.nan
+    sd = float(np.std(values, ddof=1)) if n > 1 else np.nan
+    return n, mean, sd
+
+
+def expected_targets(state, window):
+    status = get_derived(state, "summary_df")["Trạng thái"].astype(str)
+    levels = state["config"]["num_levels"]
+    ctrls = [f"Ctrl {j + 1}" for j in range(levels)]
+    daily = state["daily_df"]
+    keep = ~status.str.startswith("Không đạt").to_numpy() & daily[ctrls].notna().any(axis=1).to_numpy()
+    rows = []
+    for c in ctrls:
+        col = daily.loc[keep, c].dropna()
+        rows.append((_figures(col), _figures(col.iloc[-window:])))
+    return rows
+
+
+def assert_matches(state, window=WINDOW):
+    got = running_qc_targets(state, window)
+    for j, ((n, mean, sd), (rn, rmean, rsd)) in enumerate(expected_targets(state, window)):
+        row = got.iloc[j]
+        assert row["N"] == n
+        assert row["Mean_X"] == pytest.approx(mean, nan_ok=True)
+        assert row["SD"] == pytest.approx(sd, nan_ok=True)
+        assert row[f"N_{window}"] == rn
+        assert row[f"Mean_{window}"] == pytest.approx(rmean, nan_ok=True)
+        assert row[f"SD_{window}"] == pytest.approx(rsd, nan_ok=True)
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache():
+    clear_westgard_cache()
+    yield
+    clear_westgard_cache()
+
+
+def test_no_runs():
+    state = make_state(0)
+    assert running_qc_targets(state) is None
+
+
+@pytest.mark.parametrize("levels", [1, 2, 3])
+def test_append(levels):
+    full = make_state(40, levels, seed=levels)["daily_df"]
+    state = make_state(0, levels)
+    for n in range(1, 41):
+        set_daily(state, full.iloc[:n])
+        assert_matches(state)
+    assert_matches(state, window=3)  # cửa sổ khác trên cùng bộ cộng dồn
+
+
+def test_append_many_runs():
+    full = make_state(60, seed=7)["daily_df"]
+    state = make_state(0)
+    for n in [10, 11, 30, 60]:
+        set_daily(state, full.iloc[:n])
+        assert_matches(state)
+
+
+def test_edit_inside_and_outside_window():
+    state = make_state(40, seed=1)
+    assert_matches(state)
+    for idx, value in [(3, 101.0), (38, 99.5), (39, np.nan), (20, 100.5)]:
+        daily = state["daily_df"].copy()
+        daily.loc[idx, "Ctrl 1"] = value
+        set_daily(state, daily)
+        assert_matches(state)
+
+
+def test_delete():
+    state = make_state(40, seed=2)
+    assert_matches(state)
+    for idx in [39, 0, 17]:
+        set_daily(state, state["daily_df"].drop(index=idx))
+        assert_matches(state)
+    set_daily(state, state["daily_df"].iloc[:0])
+    assert running_qc_targets(state) is None
+
+
+def test_status_flip():
+    state = make_state(30, seed=3)
+    assert_matches(state)
+    # Run 25 thành 1_3s (Reject) -> bị loại khỏi CSTK chạy, rồi sửa lại -> được tính lại
+    daily = state["daily_df"].copy()
+    daily.loc[25, "Ctrl 1"] = MEANS[0] + 5 * SDS[0]
+    set_daily(state, daily)
+    assert get_derived(state, "summary_df")["Trạng thái"].iloc[25].startswith("Không đạt")
+    assert_matches(state)
+    daily = daily.copy()
+    daily.loc[25, "Ctrl 1"] = MEANS[0]
+    set_daily(state, daily)
+    assert not get_derived(state, "summary_df")["Trạng thái"].iloc[25].startswith("Không đạt")
+    assert_matches(state)
+
+
+def test_sigma_change_rebuilds():
+    state = make_state(30, seed=4)
+    assert_matches(state)
+    state["config"]["sigma_value"] = 3.0
+    assert_matches(state)
+
+
+def test_append_does_not_rescan(monkeypatch):
+    """Thêm 1 run chỉ đọc run mới, không quét lại các run cũ."""
+    import iqc.derived as derived
+
+    full = make_state(30, seed=5)["daily_df"]
+    state = make_state(0)
+    set_daily(state, full.iloc[:29])
+    running_qc_targets(state)
+
+    starts = []
+    original = derived._run_entries
+    monkeypatch.setattr(derived, "_run_entries", lambda s, df, start: starts.append(start) or original(s, df, start))
+    set_daily(state, full)
+    assert_matches(state)
+    assert starts == [29]
+
+
+def test_reloaded_state_reuses_cached_stream():
+    """Cùng dữ liệu ở state khác (tải lại / phiên khác): Westgard lấy từ cache, CSTK chạy vẫn đúng."""
+    first = make_state(30, seed=6)
+    assert_matches(first)
+    hits = westgard_cache_stats()["hits"]
+    second = make_state(30, seed=6)
+    assert_matches(second)
+    assert westgard_cache_stats()["hits"] == hits + 1
+    assert second["_wg_stream"] is not first["_wg_stream"]
+
+    # Sửa state thứ 2 không ảnh hưởng state đầu
+    daily = second["daily_df"].copy()
+    daily.loc[5, "Ctrl 1"] = MEANS[0] + 5 * SDS[0]
+    set_daily(second, daily)
+    assert_matches(second)
+    first["_rev"] += 1
+    assert not get_derived(first, "summary_df")["Trạng thái"].iloc[5].startswith("Không đạt")
+    assert_matches(first)
@@ -0,0 +1,62 @@
+"""
+Cache state dùng chung các phiên (qc_core): bản của 1 phiên sửa không lọt sang phiên khác.
+"""
+import pandas as pd
+
+import qc_core
+
+
+def test_state_copy_isolates_frames():
+    state = {
+        "config": {"num_levels": 2},
+        "daily_df": pd.DataFrame({"Ngày/Lần": [1, 2], "Ctrl 1": [1.0, 2.0]}),
+    }
+    mine = qc_core._state_copy(state)
+    mine["daily_df"].loc[0, "Ctrl 1"] = 99.0
+    mine["daily_df"]["Ctrl 2"] = [3.0, 4.0]
+    mine["config"]["num_levels"] = 3
+    assert state["daily_df"]["Ctrl 1"].tolist() == [1.0, 2.0]
+    assert list(state["daily_df"].columns) == ["Ngày/Lần", "Ctrl 1"]
+    assert state["config"]["num_levels"] == 2
+
+
+def _state(n):
+    daily = pd.DataFrame({"Ngày/Lần": list(range(1, n + 1)), "Ctrl 1": [100.0 + i % 3 for i in range(n)]})
+    return {
+        "config": {"num_levels": 1, "sigma_value": 6.0},
+        "daily_df": daily,
+        "qc_stats": pd.DataFrame({"Control": ["Ctrl 1"], "Mean_X": [101.0], "SD_empirical": [1.0]}),
+        "sd_mode": "SD thực nghiệm",
+        "_rev": 0,
+    }
+
+
+def test_state_nbytes_remeasures_derived_entries(monkeypatch):
+    monkeypatch.setattr(qc_core.st, "session_state", {})
+    fresh = iter(range(100))
+
+    def measured_fresh(state):
+        # Khoá mới -> chưa có trong memo, đo lại toàn bộ
+        return qc_core._state_nbytes(f"fresh{next(fresh)}", state)
+
+    state = _state(200)
+    raw = qc_core._state_nbytes("GLU", state)
+    assert qc_core._state_nbytes("GLU", state) == raw
+
+    # Bảng dẫn xuất / stream được thêm vào state["_derived"] / ["_wg_stream"] tại chỗ
+    qc_core.get_derived(state, "z_df")
+    with_z = qc_core._state_nbytes("GLU", state)
+    assert with_z > raw
+    qc_core.get_derived(state, "export_df")
+    with_export = qc_core._state_nbytes("GLU", state)
+    assert with_export > with_z
+    assert with_export == measured_fresh(state)
+
+    # Thêm run: dữ liệu thô mới + stream nhận thêm run
+    state["daily_df"] = _state(400)["daily_df"]
+    state["_rev"] += 1
+    qc_core.get_derived(state, "export_df")
+    assert qc_core._state_nbytes("GLU", state) == measured_fresh(state) > with_export
+
+    qc_core.running_qc_targets(state)
+    assert qc_core._state_nbytes("GLU", state) == measured_fresh(state)
@@ -0,0 +1,22 @@
+"""
+File tĩnh (CSS / ảnh) ghi vào static/ cạnh app.py – nơi Streamlit phục vụ – dù chạy app từ thư mục khác.
+"""
+import os
+
+import qc_core
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_static_url_writes_next_to_app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    name = "iqc_test_static_url.css"
+    path = os.path.join(APP_DIR, "static", name)
+    try:
+        assert qc_core._static_url(name, b"body{}") == f"app/static/{name}"
+        with open(path, "rb") as f:
+            assert f.read() == b"body{}"
+        assert not (tmp_path / "static").exists()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,137 @@
+"""
+utils.statistics: column_stats / mean_sd_cv so với np.nanmean / np.nanstd(ddof=1),
+RunningStats / RollingStats so với tính lại từ đầu.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.statistics import RollingStats, RunningStats, column_stats, mean_sd_cv
+
+
+def reference(col):
+    """(n, mean, sd, cv) bằng numpy; NaN khi n = 0 / n = 1 / mean = 0 (CV)."""
+    col = np.asarray(col, dtype=float)
+    n = int((~np.isnan(col)).sum())
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(col) if n else np.nan
+        sd = np.nanstd(col, ddof=1) if n > 1 else np.nan
+    cv = sd / mean * 100.0 if n > 1 and mean != 0 else np.nan
+    return n, mean, sd, cv
+
+
+def assert_close(got, expected):
+    assert got == pytest.approx(expected, rel=1e-12, abs=1e-12, nan_ok=True)
+
+
+COLUMNS = {
+    "n0": [],
+    "n1": [5.0],
+    "n2": [1.0, 3.0],
+    "all_nan": [np.nan, np.nan, np.nan],
+    "gaps": [1.5, np.nan, 2.5, 3.0, np.nan],
+    "mean0": [-2.0, 2.0, -1.0, 1.0],
+    "large": [1e9 + 1, 1e9 + 2, 1e9 + 3],
+}
+
+
+@pytest.mark.parametrize("name", list(COLUMNS))
+def test_mean_sd_cv_matches_numpy(name):
+    col = COLUMNS[name]
+    _, mean, sd, cv = reference(col)
+    got = mean_sd_cv(col)
+    assert_close(got, (mean, sd, cv))
+    assert_close(mean_sd_cv(pd.Series(col, dtype=float)), (mean, sd, cv))
+
+
+def test_mean_sd_cv_mean_zero_has_no_cv():
+    mean, sd, cv = mean_sd_cv([-2.0, 2.0, -1.0, 1.0])
+    assert mean == 0 and sd > 0 and np.isnan(cv)
+
+
+def test_mean_sd_cv_non_numeric_cells():
+    # None, "", chữ -> bỏ qua; chuỗi số vẫn được đọc
+    assert_close(mean_sd_cv([1.0, None, "", "abc", "3", 2.0]), reference([1.0, 3.0, 2.0])[1:])
+    assert_close(mean_sd_cv(pd.Series(["x", None, ""], dtype=object)), (np.nan, np.nan, np.nan))
+
+
+def test_mean_sd_cv_single_column_frame():
+    df = pd.DataFrame({"Ctrl 1": [1.0, 2.0, 4.0]})
+    assert_close(mean_sd_cv(df), reference(df["Ctrl 1"])[1:])
+
+
+def test_mean_sd_cv_rejects_several_columns():
+    with pytest.raises(ValueError):
+        mean_sd_cv(pd.DataFrame({"Ctrl 1": [1.0, 2.0], "Ctrl 2": [3.0, 4.0]}))
+    with pytest.raises(ValueError):
+        mean_sd_cv(np.ones((3, 2)))
+
+
+def test_column_stats_matches_numpy():
+    rng = np.random.default_rng(0)
+    n = 50
+    df = pd.DataFrame(
+        {
+            "Ctrl 1": rng.normal(100, 3, n),
+            "Ctrl 2": np.where(rng.random(n) < 0.3, np.nan, rng.normal(5, 0.5, n)),
+            "Ctrl 3": np.full(n, np.nan),
+            "Ctrl 4": [np.nan] * (n - 1) + [7.0],
+            "Ctrl 5": np.tile([-1.0, 1.0], n // 2),
+        }
+    )
+    stats = column_stats(df)
+    assert stats.columns == tuple(df.columns)
+    for j, c in enumerate(df.columns):
+        n_ref, mean, sd, cv = reference(df[c])
+        assert stats.n[j] == n_ref
+        assert_close((stats.mean[j], stats.sd[j], stats.cv[j]), (mean, sd, cv))
+        assert_close(stats.get(c), (mean, sd, cv))
+    assert_close(stats.get("Ctrl 9"), (np.nan, np.nan, np.nan))
+
+    frame = stats.to_frame()
+    assert list(frame["Control"]) == list(df.columns)
+    assert list(frame["N"]) == [reference(df[c])[0] for c in df.columns]
+
+
+def test_column_stats_empty_and_non_numeric():
+    empty = column_stats(pd.DataFrame({"Ctrl 1": pd.Series([], dtype=float)}))
+    assert empty.n[0] == 0 and np.isnan(empty.mean[0]) and np.isnan(empty.sd[0])
+
+    df = pd.DataFrame({"Ctrl 1": ["1", "", None, "2.5", "x"], "Ctrl 2": [1, 2, 3, 4, 5]})
+    stats = column_stats(df)
+    assert_close(stats.get("Ctrl 1"), reference([1.0, 2.5])[1:])
+    assert_close(stats.get("Ctrl 2"), reference([1, 2, 3, 4, 5])[1:])
+
+
+def test_column_stats_dict_matches_single():
+    rng = np.random.default_rng(1)
+    tables = {
+        "Glucose": pd.DataFrame({"Ctrl 1": rng.normal(5, 0.2, 20), "Ctrl 2": rng.normal(15, 0.5, 20)}),
+        "ALT": pd.DataFrame({"Ctrl 1": rng.normal(40, 2, 7)}),
+        "Empty": pd.DataFrame({"Ctrl 1": pd.Series([], dtype=float)}),
+    }
+    out = column_stats(tables)
+    assert list(out) == list(tables)
+    for key, df in tables.items():
+        single = column_stats(df)
+        for c in df.columns:
+            assert_close(out[key].get(c), single.get(c))
+    assert column_stats({}) == {}
+
+
+def test_running_and_rolling_match_recompute():
+    rng = np.random.default_rng(2)
+    values = list(rng.normal(10, 2, 60))
+    running, rolling = RunningStats(), RollingStats(8)
+    for i, v in enumerate(values):
+        running.add(v)
+        rolling.add(v)
+        assert_close(running.result(), reference(values[: i + 1])[1:])
+        assert_close(rolling.result(), reference(values[max(0, i - 7) : i + 1])[1:])
+    for v in values[:30]:
+        running.remove(v)
+    assert running.n == 30
+    assert running.result() == pytest.approx(reference(values[30:])[1:], rel=1e-9)
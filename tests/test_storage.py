@@ -0,0 +1,171 @@
+"""
+SupabaseStorage với client PostgREST giả (không cần mạng): dò cột version, ghi state.
+"""
+import pytest
+
+from storage import SupabaseStorage, VersionConflict
+
+
+class APIError(Exception):
+    def __init__(self, code, message=""):
+        super().__init__(message or code)
+        self.code = code
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class Query:
+    def __init__(self, client, table):
+        self.client, self.table = client, table
+        self.op, self.values, self.filters = "select", None, {}
+
+    def select(self, cols):
+        self.cols = cols
+        return self
+
+    def eq(self, col, value):
+        self.filters[col] = value
+        return self
+
+    def limit(self, n):
+        return self
+
+    def insert(self, values):
+        self.op, self.values = "insert", values
+        return self
+
+    def update(self, values):
+        self.op, self.values = "update", values
+        return self
+
+    def upsert(self, values, on_conflict=None):
+        self.op, self.values = "upsert", values
+        return self
+
+    def execute(self):
+        return self.client.execute(self)
+
+
+class FakeClient:
+    """Bảng iqc_state trong dict; probe_errors: lỗi lần lượt cho các lần select('version')."""
+
+    def __init__(self, versioned=True, probe_errors=()):
+        self.rows = {}
+        self.versioned = versioned
+        self.probe_errors = list(probe_errors)
+        self.probes = 0
+        self.before_update = None  # gọi trước mỗi update (giả lập phiên khác ghi chen vào)
+
+    def table(self, name):
+        assert name == "iqc_state"
+        return Query(self, name)
+
+    def execute(self, q):
+        key = (q.filters.get("lab_id"), q.filters.get("analyte_key"))
+        if q.op == "select":
+            if q.cols == "version" and not q.filters:
+                self.probes += 1
+                if self.probe_errors:
+                    raise self.probe_errors.pop(0)
+                if not self.versioned:
+                    raise APIError("42703", "column iqc_state.version does not exist")
+            row = self.rows.get(key)
+            return Response([dict(row)] if row else [])
+        if q.op == "insert":
+            key = (q.values["lab_id"], q.values["analyte_key"])
+            if key in self.rows:
+                raise APIError("23505", "duplicate key value violates unique constraint")
+            self.rows[key] = dict(q.values)
+            return Response([q.values])
+        if q.op == "update":
+            if self.before_update is not None:
+                self.before_update()
+            row = self.rows.get(key)
+            if row is None or row.get("version", 0) != q.filters["version"]:
+                return Response([])
+            row.update(q.values)
+            return Response([row])
+        if q.op == "upsert":
+            key = (q.values["lab_id"], q.values["analyte_key"])
+            self.rows.setdefault(key, {}).update(q.values)
+            return Response([q.values])
+        raise AssertionError(q.op)
+
+
+def test_versioned_probe_caches_result():
+    client = FakeClient(versioned=True)
+    storage = SupabaseStorage(client)
+    assert storage.versioned and storage.versioned
+    assert client.probes == 1
+
+
+def test_missing_column_is_cached_as_unversioned():
+    client = FakeClient(versioned=False)
+    storage = SupabaseStorage(client)
+    assert not storage.versioned and not storage.versioned
+    assert client.probes == 1
+
+
+def test_transient_probe_error_is_not_cached():
+    client = FakeClient(versioned=True, probe_errors=[ConnectionError("timeout"), APIError("42501", "permission denied")])
+    storage = SupabaseStorage(client)
+    with pytest.raises(ConnectionError):
+        storage.versioned
+    with pytest.raises(APIError):
+        storage.versioned
+    assert storage.versioned
+    assert client.probes == 3
+
+
+def test_save_state_inserts_then_bumps_version():
+    client = FakeClient()
+    storage = SupabaseStorage(client)
+    storage.save_state("lab", "GLU", {"a": 1})
+    assert storage.load_state("lab", "GLU") == ({"a": 1}, 1)
+    storage.save_state("lab", "GLU", {"a": 2})
+    assert storage.load_state("lab", "GLU") == ({"a": 2}, 2)
+
+
+def test_save_state_retries_when_another_session_writes_in_between():
+    client = FakeClient()
+    storage = SupabaseStorage(client)
+    storage.save_state("lab", "GLU", {"a": 1})
+    other = SupabaseStorage(client)
+    racing = [2]
+
+    def other_session_writes():
+        # Phiên khác ghi ngay sau khi phiên này đọc version (2 lần liên tiếp)
+        if racing[0]:
+            racing[0] -= 1
+            client.before_update = None
+            other.cas_state("lab", "GLU", other.get_version("lab", "GLU"), {"other": True})
+            client.before_update = other_session_writes
+
+    client.before_update = other_session_writes
+    storage.save_state("lab", "GLU", {"a": 2})
+    # 2 lần ghi của phiên kia (v2, v3) + lần ghi này (v4): không lần nào trùng version
+    assert storage.load_state("lab", "GLU") == ({"a": 2}, 4)
+
+
+def test_save_state_gives_up_after_retries():
+    client = FakeClient()
+    storage = SupabaseStorage(client)
+    storage.save_state("lab", "GLU", {"a": 1})
+
+    def always_bump():
+        client.rows[("lab", "GLU")]["version"] += 1
+
+    client.before_update = always_bump
+    with pytest.raises(VersionConflict):
+        storage.save_state("lab", "GLU", {"a": 2})
+
+
+def test_save_state_unversioned_upserts():
+    client = FakeClient(versioned=False)
+    storage = SupabaseStorage(client)
+    storage.save_state("lab", "GLU", {"a": 1})
+    storage.save_state("lab", "GLU", {"a": 2})
+    assert client.rows[("lab", "GLU")] == {"lab_id": "lab", "analyte_key": "GLU", "state": {"a": 2}}
@@ -0,0 +1,211 @@
+"""
+Engine Westgard vector hoá (iqc.westgard) phải cho kết quả giống hệt bản vòng lặp gốc
+(tests/westgard_reference.py): evaluate_westgard, evaluate_westgard_violations,
+WestgardStream (push / edit / sync) và evaluate_westgard_batch.
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from iqc.westgard import (
+    WestgardStream,
+    cached_westgard_stream,
+    clear_westgard_cache,
+    evaluate_westgard,
+    evaluate_westgard_batch,
+    evaluate_westgard_violations,
+    extract_rule_short,
+    render_westgard_frames,
+    westgard_cache_stats,
+)
+from westgard_reference import evaluate_westgard_loop
+
+SIGMAS = [None, 0, 3.0, 4.2, 5.5, 6.0]
+N_RUNS = [0, 1, 2, 3, 5, 10, 11, 30, 80]
+LEVELS = [1, 2, 3, 4]
+# (độ lệch chuẩn, độ dịch) của z: nhiễu thường, lệch dương, lệch âm rộng, hẹp
+SHAPES = [(1.5, 0.0), (1.0, 1.2), (2.5, -1.0), (0.8, 0.0)]
+
+
+def make_z_df(rng, n, levels, scale=1.5, shift=0.0, nan=0.1, runs=None):
+    Z = rng.normal(shift, scale, (n, levels))
+    Z[rng.random((n, levels)) < nan] = np.nan
+    if rng.random() < 0.3:
+        Z = np.round(Z)  # trúng đúng biên 1s / 2s / 3s và 0
+    data = {"Ngày/Lần": runs if runs is not None else list(range(1, n + 1))}
+    for j in range(levels):
+        data[f"z_Ctrl {j + 1}"] = Z[:, j]
+    return pd.DataFrame(data)
+
+
+def assert_same(expected, actual):
+    assert expected[0] == actual[0]
+    assert expected[1] == actual[1]
+    pd.testing.assert_frame_equal(expected[2], actual[2])
+    pd.testing.assert_frame_equal(expected[3], actual[3])
+
+
+def fuzz_cases(seed):
+    rng = np.random.default_rng(seed)
+    for n, levels, sigma, num_levels, (scale, shift) in itertools.product(N_RUNS, LEVELS, SIGMAS, [2, 3], SHAPES):
+        yield make_z_df(rng, n, levels, scale, shift), num_levels, sigma
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache():
+    clear_westgard_cache()
+    yield
+    clear_westgard_cache()
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_evaluate_westgard_matches_loop(seed):
+    for z_df, num_levels, sigma in fuzz_cases(seed):
+        assert_same(evaluate_westgard_loop(z_df, num_levels, sigma), evaluate_westgard(z_df, num_levels, sigma))
+
+
+def test_evaluate_westgard_cached_result_is_not_shared():
+    z_df = make_z_df(np.random.default_rng(2), 40, 3, 1.3, 0.5)
+    first = evaluate_westgard(z_df, 3, 3.0)
+    first[2]["Trạng thái"] = "x"
+    assert_same(evaluate_westgard_loop(z_df, 3, 3.0), evaluate_westgard(z_df, 3, 3.0))
+
+
+def test_string_run_labels():
+    rng = np.random.default_rng(3)
+    for n in [12, 40]:
+        z_df = make_z_df(rng, n, 2, 1.3, 0.5, runs=[f"d{i}" for i in range(n)])
+        assert_same(evaluate_westgard_loop(z_df, 2, 3.0), evaluate_westgard(z_df, 2, 3.0))
+
+
+@pytest.mark.parametrize("seed", [4])
+def test_violations_render_to_loop_frames(seed):
+    for z_df, num_levels, sigma in fuzz_cases(seed):
+        cat, rules, violations = evaluate_westgard_violations(z_df, num_levels, sigma)
+        summary_df, point_df = render_westgard_frames(z_df, violations)
+        assert_same(evaluate_westgard_loop(z_df, num_levels, sigma), (cat, rules, summary_df, point_df))
+
+
+def _z_rows(z_df):
+    cols = sorted((c for c in z_df.columns if c.startswith("z_Ctrl")), key=lambda c: int(c.split("Ctrl ")[1]))
+    return z_df["Ngày/Lần"].tolist(), z_df[cols].to_numpy(dtype=float)
+
+
+@pytest.mark.parametrize("levels", LEVELS)
+@pytest.mark.parametrize("sigma", [3.0, 4.5, 5.5, 6.0])
+@pytest.mark.parametrize("num_levels", [2, 3])
+def test_stream_push_edit_sync(levels, sigma, num_levels):
+    rng = np.random.default_rng(levels * 100 + int(sigma * 10) + num_levels)
+    z_df = make_z_df(rng, 60, levels, 1.2, 0.6)
+    runs, Z = _z_rows(z_df)
+
+    # push từng run
+    stream = WestgardStream(num_levels, sigma)
+    for run, z in zip(runs, Z):
+        stream.push(run, z)
+    assert_same(evaluate_westgard_loop(z_df, num_levels, sigma), stream.result())
+
+    # edit run cũ (kể cả run đầu / cuối, thành NaN)
+    for idx in [0, 7, 30, 59]:
+        z = rng.normal(0.5, 2.5, levels)
+        z[rng.random(levels) < 0.2] = np.nan
+        z_df.iloc[idx, 1:] = z
+        stream.edit(idx, z)
+        assert_same(evaluate_westgard_loop(z_df, num_levels, sigma), stream.result())
+
+    # sync: thêm dần (1 run / nhiều run), sửa giữa, cắt bớt, đổi nhãn run
+    stream = WestgardStream(num_levels, sigma)
+    for n in [0, 1, 5, 5, 6, 20, 60]:
+        part = z_df.iloc[:n].reset_index(drop=True)
+        assert_same(evaluate_westgard_loop(part, num_levels, sigma), stream.sync(part).result())
+    edited = z_df.copy()
+    edited.iloc[25, 1:] = rng.normal(0, 3, levels)
+    assert_same(evaluate_westgard_loop(edited, num_levels, sigma), stream.sync(edited).result())
+    cut = edited.iloc[:33].reset_index(drop=True)
+    assert_same(evaluate_westgard_loop(cut, num_levels, sigma), stream.sync(cut).result())
+    relabeled = cut.assign(**{"Ngày/Lần": [f"r{i}" for i in range(len(cut))]})
+    assert_same(evaluate_westgard_loop(relabeled, num_levels, sigma), stream.sync(relabeled).result())
+
+
+def test_cached_stream_hits_and_copies():
+    rng = np.random.default_rng(6)
+    z_df = make_z_df(rng, 50, 2, 1.3, 0.5)
+    expected = evaluate_westgard_loop(z_df, 2, 4.5)
+
+    first = cached_westgard_stream(z_df, 2, 4.5)
+    assert westgard_cache_stats()["misses"] == 1
+    second = cached_westgard_stream(z_df, 2, 4.5)
+    assert westgard_cache_stats()["hits"] == 1
+    assert first is not second
+    assert_same(expected, second.result())
+
+    # Sửa / thêm run trên 1 bản không ảnh hưởng bản trong cache
+    edited = z_df.copy()
+    edited.iloc[10, 1:] = [3.5, -3.5]
+    first.sync(edited)
+    first.push(99, [0.1, 0.2])
+    assert_same(expected, cached_westgard_stream(z_df, 2, 4.5).result())
+    assert westgard_cache_stats()["hits"] == 2
+
+    # Sigma khác cùng nhóm sigma -> khoá khác
+    cached_westgard_stream(z_df, 2, 4.6)
+    assert westgard_cache_stats()["misses"] == 2
+
+
+def _overview_from_loop(key, z_df, num_levels, sigma):
+    cat, _, summary_df, point_df = evaluate_westgard_loop(z_df, num_levels, sigma)
+    _, Z = _z_rows(z_df)
+    has_data = ~np.isnan(Z).all(axis=1) if Z.size else np.zeros(len(z_df), dtype=bool)
+    row = {
+        "Xét nghiệm": key,
+        "Nhóm sigma": cat,
+        "Số lần chạy": int(has_data.sum()),
+        "Lần chạy cuối": "",
+        "Trạng thái lần cuối": "Chưa có dữ liệu",
+        "Quy tắc vi phạm": set(),
+        "Số lần Reject": int((summary_df["Trạng thái"] == "Không đạt (Reject QC)").sum()) if len(summary_df) else 0,
+        "Số lần cảnh báo": int((summary_df["Trạng thái"] == "Cảnh báo (1_2s)").sum()) if len(summary_df) else 0,
+    }
+    if has_data.any():
+        last = int(np.flatnonzero(has_data)[-1])
+        row["Lần chạy cuối"] = z_df["Ngày/Lần"].iloc[last]
+        row["Trạng thái lần cuối"] = summary_df["Trạng thái"].iloc[last]
+        run = z_df["Ngày/Lần"].iloc[last]
+        codes = point_df.loc[point_df["Ngày/Lần"] == run, "rule_codes"].map(extract_rule_short)
+        row["Quy tắc vi phạm"] = {c for text in codes for c in text.split(", ") if c}
+    return row
+
+
+def test_batch_matches_loop():
+    rng = np.random.default_rng(5)
+    analytes = {}
+    for i, (n, levels) in enumerate(itertools.product([0, 1, 9, 25, 70], LEVELS)):
+        z_df = make_z_df(rng, n, levels, 1.4, [0.0, 1.0, -1.2][i % 3], nan=0.15)
+        if n and i % 5 == 0:
+            z_df.iloc[-3:, 1:] = np.nan  # lần chạy cuối có dữ liệu không phải dòng cuối
+        analytes[f"XN{i}"] = (z_df, [2, 3][i % 2], SIGMAS[i % len(SIGMAS)])
+
+    overview, violations = evaluate_westgard_batch(analytes)
+    assert list(overview["Xét nghiệm"]) == list(analytes)
+    for b, (key, (z_df, num_levels, sigma)) in enumerate(analytes.items()):
+        got = overview.iloc[b].to_dict()
+        expected = _overview_from_loop(key, z_df, num_levels, sigma)
+        got["Quy tắc vi phạm"] = {c for c in got["Quy tắc vi phạm"].split(", ") if c}
+        for col in expected:
+            assert got[col] == expected[col], (key, col)
+
+        # Vi phạm của từng xét nghiệm = vi phạm khi đánh giá riêng
+        _, _, single = evaluate_westgard_violations(z_df, num_levels, sigma)
+        mine = violations[violations["analyte_idx"] == b].drop(columns="analyte_idx")
+        pd.testing.assert_frame_equal(
+            mine.sort_values(list(mine.columns)).reset_index(drop=True),
+            single.sort_values(list(single.columns)).reset_index(drop=True),
+            check_dtype=False,
+        )
+
+
+def test_batch_empty():
+    overview, violations = evaluate_westgard_batch({})
+    assert overview.empty and violations.empty
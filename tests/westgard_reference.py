@@ -0,0 +1,299 @@
+"""
+Bản gốc đánh giá Westgard bằng vòng lặp từng ô (run, level) – chỉ dùng làm chuẩn đối chiếu
+trong test cho engine vector hoá (iqc.westgard).
+"""
+import numpy as np
+import pandas as pd
+
+from iqc.westgard import get_sigma_category_and_rules
+
+
+def evaluate_westgard_loop(z_df, num_levels, sigma):
+    """
+    Bản gốc đánh giá Westgard bằng vòng lặp từng ô (run, level).
+    """
+    runs = z_df["Ngày/Lần"].tolist()
+    z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
+    z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
+    Z = z_df[z_cols].to_numpy(dtype=float)
+    n_runs, n_levels = Z.shape
+
+    sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
+
+    warn_by_run = [set() for _ in range(n_runs)]
+    rej_by_run = [set() for _ in range(n_runs)]
+    warn_point = [[set() for _ in range(n_levels)] for _ in range(n_runs)]
+    rej_point = [[set() for _ in range(n_levels)] for _ in range(n_runs)]
+
+    def add_warn(i, msg, levels=None):
+        warn_by_run[i].add(msg)
+        if levels is not None:
+            for l in levels:
+                warn_point[i][l].add(msg)
+
+    def add_rej(i, msg, levels=None):
+        rej_by_run[i].add(msg)
+        if levels is not None:
+            for l in levels:
+                rej_point[i][l].add(msg)
+
+    # 1_2s
+    for i in range(n_runs):
+        for l in range(n_levels):
+            z = Z[i, l]
+            if np.isnan(z):
+                continue
+            if 2 <= abs(z) < 3:
+                msg = f"1_2s (Ctrl {l+1}, z={z:.2f})"
+                add_warn(i, msg, levels=[l])
+
+    # 1_3s
+    if "1_3s" in active_rules:
+        for i in range(n_runs):
+            for l in range(n_levels):
+                z = Z[i, l]
+                if np.isnan(z):
+                    continue
+                if abs(z) >= 3:
+                    msg = f"1_3s (Ctrl {l+1}, z={z:.2f})"
+                    add_rej(i, msg, levels=[l])
+
+    # 2_2s
+    if "2_2s" in active_rules:
+        # cùng lần chạy, 2 mức khác nhau
+        for i in range(n_runs):
+            idxs = []
+            signs = []
+            for l in range(n_levels):
+                z = Z[i, l]
+                if np.isnan(z):
+                    continue
+                if 2 <= abs(z) < 3:
+                    idxs.append(l)
+                    signs.append(np.sign(z) or 1)
+            for s in (+1, -1):
+                levels = [l for l, sgn in zip(idxs, signs) if sgn == s]
+                if len(levels) >= 2:
+                    msg = (
+                        "2_2s (cùng lần chạy, "
+                        + ", ".join(f"Ctrl {l+1}" for l in levels)
+                        + " cùng phía 2–3SD)"
+                    )
+                    add_rej(i, msg, levels=levels)
+
+        # cùng mức, 2 lần liên tiếp
+        for l in range(n_levels):
+            for i in range(1, n_runs):
+                z1, z2 = Z[i - 1, l], Z[i, l]
+                if any(np.isnan([z1, z2])):
+                    continue
+                if (
+                    2 <= abs(z1) < 3
+                    and 2 <= abs(z2) < 3
+                    and np.sign(z1) == np.sign(z2)
+                ):
+                    msg = f"2_2s (Ctrl {l+1}, runs {runs[i-1]}–{runs[i]})"
+                    add_rej(i, msg, levels=[l])
+
+    # 2/3_2s
+    if "2of3_2s" in active_rules:
+        # cùng mức, 3 lần liên tiếp
+        for l in range(n_levels):
+            for i in range(2, n_runs):
+                window_idx = [i - 2, i - 1, i]
+                vals = [Z[j, l] for j in window_idx]
+                if all(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    cnt = sum(
+                        (not np.isnan(v)) and abs(v) >= 2 and np.sign(v) == s
+                        for v in vals
+                    )
+                    if cnt >= 2:
+                        msg = f"2/3_2s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})"
+                        add_rej(i, msg, levels=[l])
+                        break
+
+        # cùng lần chạy, nhiều mức
+        for i in range(n_runs):
+            vals = [Z[i, l] for l in range(n_levels)]
+            for s in (+1, -1):
+                levels = [
+                    l
+                    for l, v in enumerate(vals)
+                    if (not np.isnan(v)) and abs(v) >= 2 and np.sign(v) == s
+                ]
+                if len(levels) >= 2:
+                    msg = f"2/3_2s (run {runs[i]}, ≥2 mức QC cùng phía ≥2SD)"
+                    add_rej(i, msg, levels=levels)
+                    break
+
+    # R_4s
+    if "R_4s" in active_rules:
+        for i in range(n_runs):
+            vals = [Z[i, l] for l in range(n_levels) if not np.isnan(Z[i, l])]
+            if len(vals) < 2:
+                continue
+            maxz = max(vals)
+            minz = min(vals)
+            if (maxz - minz) >= 4 and maxz >= 2 and minz <= -2:
+                levels = []
+                for l in range(n_levels):
+                    if np.isnan(Z[i, l]):
+                        continue
+                    if Z[i, l] == maxz or Z[i, l] == minz:
+                        levels.append(l)
+                msg = f"R_4s (run {runs[i]}, chênh lệch ≥4SD giữa các mức QC)"
+                add_rej(i, msg, levels=levels)
+
+    # 3_1s
+    if "3_1s" in active_rules:
+        for l in range(n_levels):
+            for i in range(2, n_runs):
+                window_idx = [i - 2, i - 1, i]
+                vals = [Z[j, l] for j in window_idx]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
+                        msg = f"3_1s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})"
+                        add_rej(i, msg, levels=[l])
+                        break
+
+        if n_levels >= 3:
+            for i in range(n_runs):
+                vals = [Z[i, l] for l in range(n_levels)]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    levels = [
+                        l for l, v in enumerate(vals) if abs(v) >= 1 and np.sign(v) == s
+                    ]
+                    if len(levels) >= 3:
+                        msg = f"3_1s (run {runs[i]}, ≥3 mức QC cùng phía ≥1SD)"
+                        add_rej(i, msg, levels=levels)
+                        break
+
+    # 4_1s
+    if "4_1s" in active_rules:
+        for l in range(n_levels):
+            for i in range(3, n_runs):
+                window_idx = [i - 3, i - 2, i - 1, i]
+                vals = [Z[j, l] for j in window_idx]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
+                        msg = f"4_1s (Ctrl {l+1}, runs {runs[i-3]}–{runs[i]})"
+                        add_rej(i, msg, levels=[l])
+                        break
+
+        if n_levels == 2:
+            for i in range(1, n_runs):
+                idxs = [i - 1, i]
+                vals = [Z[j, l] for j in idxs for l in range(n_levels)]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(abs(v) >= 1 and np.sign(v) == s for v in vals):
+                        msg = "4_1s (2 lần chạy x 2 mức QC, tất cả cùng phía ≥1SD)"
+                        add_rej(i, msg, levels=[0, 1])
+                        break
+
+    # 9x
+    if "9x" in active_rules:
+        for l in range(n_levels):
+            for i in range(8, n_runs):
+                window_idx = list(range(i - 8, i + 1))
+                vals = [Z[j, l] for j in window_idx]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(np.sign(v) == s for v in vals):
+                        msg = f"9x (Ctrl {l+1}, 9 kết quả liên tiếp cùng phía)"
+                        add_rej(i, msg, levels=[l])
+                        break
+
+        if n_levels == 3:
+            for i in range(2, n_runs):
+                window_idx = [i - 2, i - 1, i]
+                vals = [Z[j, l] for j in window_idx for l in range(n_levels)]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(np.sign(v) == s for v in vals):
+                        msg = "9x (3 lần chạy x 3 mức QC, tất cả cùng phía)"
+                        add_rej(i, msg, levels=[0, 1, 2])
+                        break
+
+    # 10x
+    if "10x" in active_rules and n_levels == 2:
+        for l in range(n_levels):
+            for i in range(9, n_runs):
+                window_idx = list(range(i - 9, i + 1))
+                vals = [Z[j, l] for j in window_idx]
+                if any(np.isnan(v) for v in vals):
+                    continue
+                for s in (+1, -1):
+                    if all(np.sign(v) == s for v in vals):
+                        msg = f"10x (Ctrl {l+1}, 10 kết quả liên tiếp cùng phía)"
+                        add_rej(i, msg, levels=[l])
+                        break
+
+        for i in range(4, n_runs):
+            window_idx = list(range(i - 4, i + 1))
+            vals = [Z[j, l] for j in window_idx for l in range(n_levels)]
+            if any(np.isnan(v) for v in vals):
+                continue
+            for s in (+1, -1):
+                if all(np.sign(v) == s for v in vals):
+                    msg = "10x (5 lần chạy x 2 mức QC, tất cả cùng phía)"
+                    add_rej(i, msg, levels=[0, 1])
+                    break
+
+    # Tổng hợp theo run
+    rows = []
+    for i, run in enumerate(runs):
+        warns = sorted(warn_by_run[i])
+        rejs = sorted(rej_by_run[i])
+        if rejs:
+            status = "Không đạt (Reject QC)"
+        elif warns:
+            status = "Cảnh báo (1_2s)"
+        else:
+            status = "Đạt"
+        all_msgs = rejs + warns
+        rows.append(
+            {
+                "Ngày/Lần": run,
+                "Trạng thái": status,
+                "Vi phạm loại bỏ": "; ".join(all_msgs),
+                "Người thực hiện": "",
+            }
+        )
+    summary_df = pd.DataFrame(rows)
+
+    # Tổng hợp theo điểm
+    point_rows = []
+    for i, run in enumerate(runs):
+        for l in range(n_levels):
+            warns = sorted(warn_point[i][l])
+            rejs = sorted(rej_point[i][l])
+            if rejs:
+                p_status = "Không đạt (Reject QC)"
+            elif warns:
+                p_status = "Cảnh báo (1_2s)"
+            else:
+                p_status = "Đạt"
+            all_msgs = rejs + warns
+            point_rows.append(
+                {
+                    "Ngày/Lần": run,
+                    "Control": f"Ctrl {l+1}",
+                    "point_status": p_status,
+                    "rule_codes": "; ".join(all_msgs),
+                }
+            )
+    point_df = pd.DataFrame(point_rows)
+
+    return sigma_cat, active_rules, summary_df, point_df
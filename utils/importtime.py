@@ -0,0 +1,83 @@
+"""
+Báo cáo thời gian import lúc khởi động (python -X importtime).
+
+    python -m utils.importtime            # top 15 module
+    python -m utils.importtime --top 30
+
+Import các module mà app.py / pages nạp ở mỗi lượt chạy trong 1 tiến trình con
+sạch, rồi in tổng thời gian, các module tốn nhất và thư viện nặng nào đã bị nạp
+sớm (matplotlib, docx, openpyxl, supabase, altair chỉ nên nạp khi dùng lần đầu).
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Module trên đường import của app.py và các trang
+APP_MODULES = (
+    "streamlit",
+    "pandas",
+    "numpy",
+    "qc_core",
+    "export.report_meta",
+    "export.export_cstk_word",
+    "export.export_so_gn_dg_word",
+    "export.export_lj_png",
+    "export.bulk_word",
+)
+
+HEAVY_MODULES = ("matplotlib", "docx", "openpyxl", "supabase", "altair")
+
+
+def measure(modules=APP_MODULES, cwd=None):
+    """Chạy `-X importtime` và trả về list (module, self_us, cumulative_us)."""
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "; ".join(f"import {m}" for m in modules)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import lỗi")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        # "import time:       123 |       4567 |   package.module"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+            rows.append((name.strip(), int(self_us), int(cum_us)))
+        except ValueError:
+            continue
+    return rows
+
+
+def report(rows, top=15, modules=APP_MODULES):
+    """In tổng thời gian, top module theo cumulative và thư viện nặng đã nạp."""
+    by_name = {name: cum for name, _, cum in rows}
+    total = sum(by_name.get(m, 0) for m in modules)
+    print(f"Tổng thời gian import ({len(rows)} module): {total / 1000:.1f} ms")
+    for m in modules:
+        print(f"  {m:<32} {by_name.get(m, 0) / 1000:8.1f} ms")
+
+    print(f"\nTop {top} module (cumulative):")
+    for name, _, cum in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"  {name:<48} {cum / 1000:8.1f} ms")
+
+    print("\nThư viện nặng bị nạp lúc khởi động:")
+    loaded = set(by_name)
+    for lib in HEAVY_MODULES:
+        state = f"CÓ ({by_name[lib] / 1000:.1f} ms)" if lib in loaded else "không"
+        print(f"  {lib:<12} {state}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+    report(measure(), top=args.top)
+
+
+if __name__ == "__main__":
+    main()
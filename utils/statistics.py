@@ -1,13 +1,204 @@
 
+from collections import deque
+from dataclasses import dataclass
+
 import numpy as np
 import pandas as pd
 
+@dataclass(frozen=True)
+class ColumnStats:
+    """Mean / SD (ddof=1) / CV% theo từng cột; mỗi mảng dài bằng số cột."""
+
+    columns: tuple
+    n: np.ndarray
+    mean: np.ndarray
+    sd: np.ndarray
+    cv: np.ndarray
+
+    def get(self, column):
+        """(mean, sd, cv) của 1 cột (NaN nếu không có cột đó)."""
+        if column not in self.columns:
+            return np.nan, np.nan, np.nan
+        j = self.columns.index(column)
+        return float(self.mean[j]), float(self.sd[j]), float(self.cv[j])
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "Control": list(self.columns),
+                "N": self.n,
+                "Mean_X": self.mean,
+                "SD_empirical": self.sd,
+                "CV_empirical_%": self.cv,
+            }
+        )
+
+
+def _numeric_matrix(values):
+    """Bảng / mảng / dãy -> (tên cột, ma trận float); ô rỗng / không phải số -> NaN."""
+    if isinstance(values, pd.Series):
+        values = values.to_frame()
+    if isinstance(values, pd.DataFrame):
+        if not all(pd.api.types.is_numeric_dtype(t) for t in values.dtypes):
+            values = values.apply(
+                lambda c: c if pd.api.types.is_numeric_dtype(c) else pd.to_numeric(c, errors="coerce")
+            )
+        return tuple(values.columns), values.to_numpy(dtype=float, na_value=np.nan)
+    arr = np.asarray(values)
+    if arr.ndim == 1:
+        arr = arr[:, None]
+    if arr.dtype.kind not in "fiub":
+        arr = pd.DataFrame(arr).apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    return tuple(range(arr.shape[1])), arr.astype(float)
+
+
+def _stats_kernel(X):
+    """(n, mean, sd, cv) theo cột của ma trận float, bỏ qua NaN; tính 2 lượt cho SD ổn định."""
+    ok = ~np.isnan(X)
+    n = ok.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(ok, X, 0.0).sum(axis=0) / n
+        dev = np.where(ok, X - mean, 0.0)
+        sd = np.sqrt((dev * dev).sum(axis=0) / (n - 1))
+        cv = sd / mean * 100.0
+    mean = np.where(n > 0, mean, np.nan)
+    sd = np.where(n > 1, sd, np.nan)
+    cv = np.where((n > 1) & (mean != 0), cv, np.nan)
+    return n, mean, sd, cv
+
+
+def column_stats(values):
+    """
+    Mean / SD / CV% của mọi cột trong 1 lần (vd. cả bảng thiết lập CSTK, mọi mức).
+    values: DataFrame / mảng 2 chiều / dãy 1 chiều (= 1 cột); ô None, "" hay không phải số được bỏ qua.
+    Nhiều xét nghiệm: values = {xét nghiệm: bảng} -> {xét nghiệm: ColumnStats}, tính chung 1 lần.
+    """
+    if isinstance(values, dict):
+        parts = {k: _numeric_matrix(v) for k, v in values.items()}
+        if not parts:
+            return {}
+        rows = max(X.shape[0] for _, X in parts.values())
+        block = np.full((rows, sum(X.shape[1] for _, X in parts.values())), np.nan)
+        start = 0
+        for _, X in parts.values():
+            block[: X.shape[0], start : start + X.shape[1]] = X
+            start += X.shape[1]
+        n, mean, sd, cv = _stats_kernel(block)
+        out, start = {}, 0
+        for k, (cols, X) in parts.items():
+            sl = slice(start, start + X.shape[1])
+            out[k] = ColumnStats(cols, n[sl], mean[sl], sd[sl], cv[sl])
+            start += X.shape[1]
+        return out
+    cols, X = _numeric_matrix(values)
+    return ColumnStats(cols, *_stats_kernel(X))
+
+
 def mean_sd_cv(values):
-    arr = np.asarray(values, dtype=float)
-    arr = arr[~np.isnan(arr)]
-    if arr.size == 0:
+    """(mean, sd, cv) của 1 dãy giá trị (bỏ qua ô trống / NaN). Nhiều cột -> ValueError (dùng column_stats)."""
+    cols, X = _numeric_matrix(values)
+    if len(cols) > 1:
+        raise ValueError(f"mean_sd_cv nhận 1 dãy giá trị, nhận {len(cols)} cột; dùng column_stats cho nhiều cột")
+    n, mean, sd, cv = _stats_kernel(X)
+    if n.size == 0:
         return np.nan, np.nan, np.nan
-    mean = float(np.mean(arr))
-    sd = float(np.std(arr, ddof=1)) if arr.size > 1 else np.nan
-    cv = (sd/mean*100.0) if mean not in (0.0, np.nan) and not np.isnan(mean) and not np.isnan(sd) else np.nan
-    return mean, sd, cv
+    return float(mean[0]), float(sd[0]), float(cv[0])
+
+
+class RunningStats:
+    """Mean/SD/CV cộng dồn (Welford): add / remove 1 giá trị O(1), không cần giữ lại dữ liệu."""
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self, values=()):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        for v in values:
+            self.add(v)
+
+    def add(self, x):
+        x = float(x)
+        if np.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        """Bỏ 1 giá trị đã add trước đó (vd. dòng bị sửa / xoá)."""
+        x = float(x)
+        if np.isnan(x) or self.n == 0:
+            return
+        if self.n == 1:
+            self.n, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        old_mean = self.mean
+        self.n -= 1
+        self.mean = old_mean - (x - old_mean) / self.n
+        self.m2 = max(self.m2 - (x - old_mean) * (x - self.mean), 0.0)
+
+    @property
+    def sd(self):
+        return float(np.sqrt(self.m2 / (self.n - 1))) if self.n > 1 else np.nan
+
+    @property
+    def cv(self):
+        sd = self.sd
+        return sd / self.mean * 100.0 if self.n and self.mean != 0 and not np.isnan(sd) else np.nan
+
+    def result(self):
+        """(mean, sd, cv) như mean_sd_cv."""
+        return (float(self.mean) if self.n else np.nan), self.sd, self.cv
+
+
+class RollingStats(RunningStats):
+    """RunningStats của N giá trị gần nhất (vd. 20 run đạt gần nhất)."""
+
+    __slots__ = ("window", "_values")
+
+    def __init__(self, window, values=()):
+        self.window = int(window)
+        self._values = deque()
+        super().__init__(values)
+
+    def add(self, x):
+        x = float(x)
+        if np.isnan(x):
+            return
+        super().add(x)
+        self._values.append(x)
+        if len(self._values) > self.window:
+            super().remove(self._values.popleft())
+
+    def remove(self, x):
+        x = float(x)
+        try:
+            self._values.remove(x)
+        except ValueError:
+            return
+        super().remove(x)
+
+
+def _benchmark(sizes=(20, 1_000, 100_000), levels=3, repeat=200):
+    """Thời gian / lần gọi: column_stats cả bảng vs. mean_sd_cv cũ từng cột (python -m utils.statistics)."""
+    import timeit
+
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        df = pd.DataFrame({f"Ctrl {i}": rng.normal(10 * i, 1, size) for i in range(1, levels + 1)})
+        number = max(1, repeat * 20 // size) if size > 20 else repeat
+        t_kernel = min(timeit.repeat(lambda: column_stats(df), number=number, repeat=5)) / number
+
+        def per_column():
+            for c in df.columns:
+                arr = np.array([v for v in df[c].tolist() if v not in (None, "")]).astype(float)
+                arr.mean(), arr.std(ddof=1)
+
+        t_loop = min(timeit.repeat(per_column, number=number, repeat=5)) / number
+        print(f"{size:>7} giá trị x {levels} mức: kernel {t_kernel * 1e6:9.1f} µs | từng cột {t_loop * 1e6:9.1f} µs")
+
+
+if __name__ == "__main__":
+    _benchmark()
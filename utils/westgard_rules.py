@@ -1,5 +1,5 @@
 
 """
-Placeholder module: the app uses qc_core.evaluate_westgard for rules.
+Placeholder module: the app uses iqc.westgard (evaluate_westgard) for rules.
 This file is kept for structure clarity.
 """